@@ -0,0 +1,231 @@
+import os
+import importlib
+import itertools
+import multiprocessing
+import queue
+import time
+import traceback
+
+# job states
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+ACTIVE_STATES = [QUEUED, RUNNING]
+
+# a cancelled job stops at its next log message; it is terminated if it has not stopped after this many seconds
+CANCEL_TIMEOUT_S = 5
+
+# spawn on every platform: a fresh interpreter per job, so matplotlib figures and
+# image stacks are freed with the process instead of piling up in the GUI
+mp_context = multiprocessing.get_context('spawn')
+
+class AnalysisJob:
+    '''
+    One phantom analysis: the arguments of phantoms.<phantom>.run_analysis and its state in the queue.
+    input_path is the input file for 2D phantoms and the input folder for 3D phantoms.
+    '''
+    def __init__(self, device_id, phantom, dim, input_path, output_dir, config, notes, metadata):
+        self.id = None
+        self.device_id = device_id
+        self.phantom = phantom
+        self.dim = dim
+        self.input_path = input_path
+        self.output_dir = output_dir
+        self.config = config
+        self.notes = notes
+        self.metadata = metadata
+        self.status = QUEUED
+        self.error = None
+        self.process = None
+        # each job has its own channel: a terminated process can only break its own queue
+        self.messages = None
+        self.cancel_event = None
+        self.cancel_deadline = None
+
+    def get_run_analysis_args(self):
+        args = {
+            'device_id': self.device_id,
+            'output_dir': self.output_dir,
+            'config': self.config,
+            'notes': self.notes,
+            'metadata': self.metadata,
+        }
+        if self.dim == 2:
+            args['input_file'] = self.input_path
+        else: # 3d phantom
+            args['input_dir'] = self.input_path
+        return args
+
+def run_analysis(phantom, run_analysis_args, log_message):
+    module = importlib.import_module(f'phantoms.{phantom.lower()}')
+    module.run_analysis(**run_analysis_args, log_message=log_message)
+
+class JobCancelled(BaseException):
+    # a BaseException, so the analysis code catching Exception does not swallow it
+    pass
+
+def run_job_process(job_id, phantom, run_analysis_args, messages, cancel_event):
+    # Entry point of the job process; everything goes back to the GUI through the messages queue of the job
+    import matplotlib
+    matplotlib.use('Agg')
+
+    def log_message(message):
+        # the analysis logs between its steps, where it can stop cleanly when cancelled
+        if cancel_event.is_set():
+            raise JobCancelled()
+        messages.put(('log', job_id, str(message)))
+
+    try:
+        run_analysis(phantom, run_analysis_args, log_message)
+        messages.put(('status', job_id, DONE, None))
+    except JobCancelled:
+        messages.put(('status', job_id, CANCELLED, None))
+    except Exception as e:
+        log_message(traceback.format_exc())
+        messages.put(('status', job_id, FAILED, str(e)))
+
+def warm_up_process():
+    # Imports pylinac in a throwaway process, so the first job starts from a warm disk cache
+    import matplotlib
+    matplotlib.use('Agg')
+    # imported for its side effect only
+    importlib.import_module('pylinac')
+
+class JobQueue:
+    '''
+    Runs analysis jobs in separate processes, at most max_concurrency at a time.
+    poll() must be called periodically (e.g. from Tk after()); it starts queued jobs,
+    collects finished ones and forwards the job logs to log_message.
+    '''
+    def __init__(self, max_concurrency=2, log_message=print):
+        self.max_concurrency = max_concurrency
+        self.log_message = log_message
+        self.jobs = []
+        self.job_ids = itertools.count(1)
+
+    def submit(self, job):
+        # the same case folder cannot be analyzed twice at the same time
+        output_dir = os.path.normcase(os.path.abspath(job.output_dir))
+        for other in self.get_active_jobs():
+            if os.path.normcase(os.path.abspath(other.output_dir)) == output_dir:
+                raise Exception(f'Job {other.id} is already {other.status} for {job.output_dir}')
+
+        job.id = next(self.job_ids)
+        job.status = QUEUED
+        self.jobs.append(job)
+        self.log_message(f'Job {job.id} queued: {job.phantom} {job.device_id} {job.output_dir}')
+        return job
+
+    def cancel(self, job_id):
+        # A running job is asked to stop; poll() terminates it if it has not stopped after CANCEL_TIMEOUT_S
+        job = self.find_job(job_id)
+        if job is None or job.status not in ACTIVE_STATES:
+            return
+
+        if job.status == RUNNING:
+            job.cancel_event.set()
+            job.cancel_deadline = time.monotonic() + CANCEL_TIMEOUT_S
+        job.status = CANCELLED
+        self.log_message(f'Job {job.id} cancelled.')
+
+    def stop_cancelled(self, wait=False):
+        # Cancelled processes still running past their deadline (or now, with wait after a join) are terminated
+        for job in self.jobs:
+            if job.status != CANCELLED or job.process is None or job.messages is None:
+                continue
+            if wait and job.process.is_alive():
+                self.drain(job)
+                job.process.join(max(0, job.cancel_deadline - time.monotonic()))
+            if job.process.is_alive() and (wait or time.monotonic() > job.cancel_deadline):
+                self.log_message(f'Job {job.id} did not stop, terminating it.')
+                job.process.terminate()
+                job.process.join()
+            if not job.process.is_alive():
+                self.drain(job)
+                self.close(job)
+
+    def find_job(self, job_id):
+        for job in self.jobs:
+            if job.id == job_id:
+                return job
+        return None
+
+    def get_active_jobs(self):
+        return [job for job in self.jobs if job.status in ACTIVE_STATES]
+
+    def is_busy(self):
+        return len(self.get_active_jobs()) > 0
+
+    def poll(self):
+        self.read_messages()
+        self.stop_cancelled()
+
+        # processes that ended without reporting (e.g. crashed)
+        for job in self.jobs:
+            if job.status == RUNNING and not job.process.is_alive():
+                self.read_messages()
+                if job.status == RUNNING:
+                    job.status = FAILED
+                    job.error = f'process exited with code {job.process.exitcode}'
+                    self.log_message(f'Job {job.id} failed: {job.error}')
+            if job.status in [DONE, FAILED] and job.messages is not None and not job.process.is_alive():
+                self.close(job)
+
+        # start queued jobs
+        num_running = len([job for job in self.jobs if job.status == RUNNING])
+        for job in self.jobs:
+            if num_running >= self.max_concurrency:
+                break
+            if job.status == QUEUED:
+                self.start(job)
+                num_running += 1
+
+    def start(self, job):
+        self.log_message(f'Job {job.id} started.')
+        job.messages = mp_context.Queue()
+        job.cancel_event = mp_context.Event()
+        job.process = mp_context.Process(target=run_job_process,
+                                         args=(job.id, job.phantom, job.get_run_analysis_args(), job.messages, job.cancel_event))
+        job.process.start()
+        job.status = RUNNING
+
+    def drain(self, job):
+        # messages of a cancelled job are dropped; reading them lets its process exit
+        while True:
+            try:
+                job.messages.get_nowait()
+            except (queue.Empty, OSError, EOFError):
+                return
+
+    def close(self, job):
+        job.messages.close()
+        job.messages = None
+
+    def read_messages(self):
+        for job in self.jobs:
+            if job.status == RUNNING and job.messages is not None:
+                self.read_job_messages(job)
+
+    def read_job_messages(self, job):
+        while True:
+            try:
+                message = job.messages.get_nowait()
+            except queue.Empty:
+                return
+
+            if message[0] == 'log':
+                self.log_message(f'[job {job.id}] {message[2]}')
+            else:
+                job.status, job.error = message[2], message[3]
+                if job.status == DONE:
+                    self.log_message(f'Job {job.id} completed.')
+                else:
+                    self.log_message(f'Job {job.id} failed: {job.error}')
+
+    def shutdown(self):
+        for job in self.get_active_jobs():
+            self.cancel(job.id)
+        self.stop_cancelled(wait=True)
@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import obj_helper
+import staging_helper
+
+BATCH_MANIFEST_FILE = 'batch_manifest.json'
+SUMMARY_JSON = 'summary.json'
+CASE_LOG_FILE = 'log.txt'
+
+# case states in the batch manifest
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+def load_batch_manifest(output_root):
+    manifest_file = os.path.join(output_root, BATCH_MANIFEST_FILE)
+    if not os.path.exists(manifest_file):
+        return {'cases': {}}
+    with open(manifest_file, 'r') as file:
+        return json.load(file)
+
+def save_batch_manifest(output_root, manifest):
+    # written to a temporary file and renamed, so an interrupted run never leaves a truncated manifest
+    manifest_file = os.path.join(output_root, BATCH_MANIFEST_FILE)
+    temp_file = manifest_file + '.tmp'
+    with open(temp_file, 'w') as file:
+        json.dump(manifest, file, indent=4)
+    os.replace(temp_file, manifest_file)
+
+def init_worker(phantom_names):
+    # pylinac and the phantom modules are imported once per worker process, not once per case
+    import importlib
+    import matplotlib
+    matplotlib.use('Agg')
+    importlib.import_module('pylinac')
+    for phantom in phantom_names:
+        importlib.import_module(f'phantoms.{phantom.lower()}')
+
+def run_case(case_folder, phantom, run_analysis_args, staged_files=None):
+    # Runs in a worker process; the case log goes to the case folder. Returns (status, error, seconds).
+    import analysis_jobs
+
+    start_time = time.perf_counter()
+    with open(os.path.join(case_folder, CASE_LOG_FILE), 'w') as log_file:
+        def log_message(message):
+            log_file.write(f'{message}\n')
+
+        try:
+            if staged_files is not None:
+                # the files stay where they are, the case folder only lists them
+                staging_helper.stage_input_files(staged_files, case_folder, mode='manifest', log_message=log_message)
+
+            analysis_jobs.run_analysis(phantom, run_analysis_args, log_message)
+
+            if not os.path.exists(os.path.join(run_analysis_args['output_dir'], 'result.json')):
+                raise Exception(f'No result.json, see {CASE_LOG_FILE}')
+            status, error = DONE, None
+
+        except Exception as e:
+            log_message(traceback.format_exc())
+            status, error = FAILED, str(e)
+
+    return status, error, round(time.perf_counter() - start_time, 2)
+
+def run_cases(tasks, manifest, output_root, workers, phantom_names, log_message=print):
+    '''
+    Runs run_case(**task) for each {case_id: task} on a spawn process pool.
+    The manifest entry of each case is updated and saved as soon as it finishes.
+    '''
+    if not tasks:
+        return
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(tasks)),
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker,
+                             initargs=(phantom_names,)) as executor:
+        futures = {executor.submit(run_case, **task): case_id for case_id, task in tasks.items()}
+
+        for i, future in enumerate(as_completed(futures), 1):
+            case_id = futures[future]
+            entry = manifest['cases'][case_id]
+            try:
+                entry['status'], entry['error'], entry['seconds'] = future.result()
+            except Exception as e:
+                # the worker process died
+                entry['status'], entry['error'], entry['seconds'] = FAILED, str(e), None
+            entry['finished'] = time.strftime('%Y-%m-%d %H:%M:%S')
+            save_batch_manifest(output_root, manifest)
+
+            message = f"[{i}/{len(tasks)}] {case_id}: {entry['status']}"
+            if entry['error']:
+                message += f" ({entry['error']})"
+            log_message(message)
+
+def get_case_entries(manifest, case_ids):
+    return [dict(manifest['cases'][case_id], case_id=case_id) for case_id in case_ids]
+
+def count_states(entries):
+    return {status: len([entry for entry in entries if entry['status'] == status]) for status in [DONE, FAILED, PENDING]}
+
+def write_summary_json(output_root, entries, log_message=print):
+    # the state of each case
+    summary_json = os.path.join(output_root, SUMMARY_JSON)
+    log_message(f'Saving batch summary: {summary_json}')
+    with open(summary_json, 'w') as file:
+        json.dump({'counts': count_states(entries), 'cases': entries}, file, indent=4)
+
+def write_summary_csv(summary_csv, entries, columns, log_message=print):
+    # one row per case: the given entry columns, then the numbers and strings of its result.json
+    columns = list(columns)
+    rows = []
+    for entry in entries:
+        row = {column: entry.get(column) for column in columns}
+        result_json = os.path.join(entry['case_folder'], 'result.json')
+        if entry['status'] == DONE and os.path.exists(result_json):
+            with open(result_json, 'r') as file:
+                result_data = json.load(file)
+            # the config is the same for every case of a phantom
+            result_data.pop('config', None)
+            for item in obj_helper.traverse_and_collect_numbers_strings(result_data):
+                if item['key'] not in columns:
+                    columns.append(item['key'])
+                row[item['key']] = item['value']
+        rows.append(row)
+
+    log_message(f'Saving batch summary: {summary_csv}')
+    with open(summary_csv, 'w') as file:
+        file.write(','.join(columns) + '\n')
+        for row in rows:
+            values = ['' if row.get(column) is None else str(row[column]).replace(',', '[comma]').replace('\n', '[newline]') for column in columns]
+            file.write(','.join(values) + '\n')
+
+def log_batch_completed(entries, log_message=print):
+    counts = count_states(entries)
+    log_message(f"Batch completed: {counts[DONE]} done, {counts[FAILED]} failed, {counts[PENDING]} pending")
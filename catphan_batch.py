@@ -0,0 +1,129 @@
+import os
+import glob
+
+import dicom_helper
+import batch_helper
+import results_db
+from batch_helper import DONE, PENDING
+
+SUMMARY_CSV = 'summary.csv'
+
+# series with fewer files are not CatPhan scans (e.g. scouts)
+DEFAULT_MIN_SLICES = 10
+
+def find_input_folders(root_or_glob):
+    # a root folder, or a glob pattern matching folders (** is recursive)
+    if glob.has_magic(root_or_glob):
+        return sorted(path for path in glob.glob(root_or_glob, recursive=True) if os.path.isdir(path))
+    if not os.path.isdir(root_or_glob):
+        raise Exception(f'Input folder not found: {root_or_glob}')
+    return [root_or_glob]
+
+def get_case_id(series_datetime, series_uid):
+    # sorts by acquisition, unique by series
+    return f"{series_datetime.replace(' ', '_')}_{series_uid}"
+
+def get_performed_date(series_datetime):
+    # 'YYYYMMDD HHMMSS' -> 'YYYY-MM-DD', the date format of the GUI
+    date = series_datetime.split(' ')[0]
+    if len(date) != 8 or not date.isdigit():
+        return ''
+    return f'{date[0:4]}-{date[4:6]}-{date[6:8]}'
+
+def discover_series(root_or_glob, modality='CT', min_slices=DEFAULT_MIN_SLICES, index_file=None, workers=1, log_message=print):
+    '''
+    Finds the series to analyze under the root folder (or the folders matching the glob), including subfolders.
+    Returns {case_id: {'series_uid', 'patient_name', 'series_datetime', 'files'}}.
+    '''
+    cases = {}
+    for folder in find_input_folders(root_or_glob):
+        log_message(f'scanning {folder}...')
+        dicom_tree = dicom_helper.parse_dicom_directory(folder, include_subfolders=True, index_file=index_file, workers=workers, log_message=log_message)
+        for patient_name, studies in dicom_tree.items():
+            for study_uid, series in studies.items():
+                for series_uid, series_data in series.items():
+                    if series_data['modality'] != modality:
+                        continue
+                    case_id = get_case_id(series_data['series_datetime'], series_uid)
+                    case = cases.setdefault(case_id, {
+                        'series_uid': series_uid,
+                        'patient_name': str(patient_name),
+                        'series_datetime': series_data['series_datetime'],
+                        'files': [],
+                    })
+                    # overlapping glob matches list the same files more than once
+                    case['files'] = sorted(set(case['files'] + series_data['files']))
+
+    for case_id in [case_id for case_id, case in cases.items() if len(case['files']) < min_slices]:
+        log_message(f'skipping {case_id}: {len(cases[case_id]["files"])} files')
+        del cases[case_id]
+
+    return cases
+
+def run_batch(root_or_glob, output_root, config, device_id='', performed_by='', notes='', workers=None,
+              min_slices=DEFAULT_MIN_SLICES, index_file=None, log_message=print):
+    '''
+    Analyzes every CatPhan series found under root_or_glob on a process pool, one case folder per series in output_root.
+    The batch manifest in output_root records the state of each case, so an interrupted batch resumes
+    where it stopped: done cases are skipped, failed ones are retried. A summary is written at the end.
+    '''
+    if not os.path.exists(output_root):
+        os.makedirs(output_root)
+    workers = workers or os.cpu_count() or 1
+
+    # the cases run in parallel, each one renders serially and never opens its PDF
+    config = dict(config)
+    config['render_workers'] = 1
+    config['publish_pdf_params'] = dict(config['publish_pdf_params'], open_file=False)
+    # a deferred.pkl per case would double the writes the output profiles save
+    config['defer_outputs'] = False
+    results_db.set_results_db_folder(config, output_root)
+    config_metadata = config['publish_pdf_params'].get('metadata', {})
+
+    cases = discover_series(root_or_glob, min_slices=min_slices, index_file=index_file, workers=min(workers, 8), log_message=log_message)
+
+    manifest = batch_helper.load_batch_manifest(output_root)
+    for case_id, case in cases.items():
+        entry = manifest['cases'].setdefault(case_id, {'status': PENDING, 'error': None, 'seconds': None})
+        entry.update({
+            'series_uid': case['series_uid'],
+            'patient_name': case['patient_name'],
+            'series_datetime': case['series_datetime'],
+            'num_files': len(case['files']),
+            'case_folder': os.path.join(output_root, case_id),
+        })
+    batch_helper.save_batch_manifest(output_root, manifest)
+
+    todo = [case_id for case_id in sorted(cases) if manifest['cases'][case_id]['status'] != DONE]
+    log_message(f'{len(cases)} series found, {len(cases) - len(todo)} already done, {len(todo)} to analyze on {workers} processes')
+
+    tasks = {}
+    for case_id in todo:
+        entry = manifest['cases'][case_id]
+        if not os.path.exists(entry['case_folder']):
+            os.makedirs(entry['case_folder'])
+        metadata = dict(config_metadata)
+        metadata['Performed By'] = performed_by
+        metadata['Performed Date'] = get_performed_date(entry['series_datetime'])
+        tasks[case_id] = {
+            'case_folder': entry['case_folder'],
+            'phantom': 'CatPhan',
+            'run_analysis_args': {
+                'device_id': device_id,
+                'input_dir': entry['case_folder'],
+                'output_dir': entry['case_folder'],
+                'config': config,
+                'notes': notes,
+                'metadata': metadata,
+            },
+            'staged_files': cases[case_id]['files'],
+        }
+    batch_helper.run_cases(tasks, manifest, output_root, workers, ['CatPhan'], log_message)
+
+    # summary.json: the state of each case; summary.csv: one row per case with the numbers and strings of its result.json
+    entries = batch_helper.get_case_entries(manifest, sorted(cases))
+    batch_helper.write_summary_json(output_root, entries, log_message)
+    batch_helper.write_summary_csv(os.path.join(output_root, SUMMARY_CSV), entries,
+                                   ['case_id', 'status', 'error', 'seconds', 'series_datetime', 'num_files'], log_message)
+    batch_helper.log_batch_completed(entries, log_message)
+    return manifest
@@ -0,0 +1,202 @@
+import os
+import sys
+import copy
+import json
+import time
+import pickle
+import argparse
+import importlib
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from util import log, read_json_file
+import obj_helper
+import result_serializer
+import staging_helper
+
+SWEEP_TABLE_FILE = 'sweep.csv'
+
+# metrics of the table when none are given (flattened result keys, see obj_helper); the ones missing from the results are left out
+DEFAULT_METRICS = [
+    'ctp404_hu_linearity_passed',
+    'ctp404_thickness_passed',
+    'ctp404_geometry_passed',
+    'ctp404_low_contrast_visibility',
+    'ctp486_passed',
+    'ctp486_uniformity_index',
+    'ctp515_num_rois_seen',
+]
+
+def parse_grid(items):
+    # ['hu_tolerance=30,40,50', 'contrast_method=Michelson,Weber'] -> {'hu_tolerance': [30, 40, 50], 'contrast_method': ['Michelson', 'Weber']}
+    grid = {}
+    for item in items:
+        if '=' not in item:
+            raise Exception(f'Invalid grid parameter: {item} (expected name=value1,value2,...)')
+        name, values = item.split('=', 1)
+        grid[name.strip()] = [parse_value(value.strip()) for value in values.split(',')]
+    return grid
+
+def parse_value(value):
+    # numbers and booleans as JSON, anything else as a string
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+def get_combinations(grid):
+    # one dict of parameter values per point of the grid
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+def get_result_items(phantom):
+    # the numbers and strings of the results, flattened as in the csv files
+    result_dict = result_serializer.to_serializable(vars(phantom.results_data()))
+    return {item['key']: item['value'] for item in obj_helper.traverse_and_collect_numbers_strings(result_dict)}
+
+def is_passed(items):
+    # every '..._passed' result; None if the results have none
+    passed = [value for key, value in items.items() if key.endswith('passed')]
+    if not passed:
+        return None
+    return all(value is True or value == 'True' for value in passed)
+
+def evaluate(phantom, base_params, combination):
+    # Analyzes the loaded phantom with the base parameters overridden by the combination; returns a row of the table
+    import phantoms.catphan
+
+    params = dict(base_params)
+    params.update(combination)
+    start_time = time.perf_counter()
+    try:
+        phantoms.catphan.analyze_catphan(phantom, params)
+        items = get_result_items(phantom)
+        return {'params': combination, 'passed': is_passed(items), 'error': None,
+                'seconds': round(time.perf_counter() - start_time, 2), 'results': items}
+    except Exception as e:
+        return {'params': combination, 'passed': False, 'error': str(e),
+                'seconds': round(time.perf_counter() - start_time, 2), 'results': {}}
+
+# the loaded (not analyzed) phantom, kept pickled in each worker process
+worker_phantom_bytes = None
+
+def init_worker(phantom_bytes):
+    global worker_phantom_bytes
+    import matplotlib
+    matplotlib.use('Agg')
+    # pylinac is imported once per worker, before the first combination
+    importlib.import_module('phantoms.catphan')
+    worker_phantom_bytes = phantom_bytes
+
+def evaluate_in_worker(base_params, combination):
+    # a fresh copy of the loaded phantom for each combination, no state left by the previous analysis
+    return evaluate(pickle.loads(worker_phantom_bytes), base_params, combination)
+
+def run_sweep(input_files, config, grid, workers=None, log_message=print):
+    '''
+    Loads the CatPhan volume once and analyzes it with every combination of the grid, e.g.
+        run_sweep('case_folder', config, {'hu_tolerance': [30, 40], 'cnr_threshold': [10, 15]})
+    The parameters not in the grid are those of config['analysis_params'].
+    With workers > 1, the loaded phantom is pickled once into each worker process (one copy of the volume per worker).
+    Each combination analyzes a fresh copy of the loaded phantom, in the workers and serially.
+    Returns one row per combination: {'params', 'passed', 'error', 'seconds', 'results'}.
+    '''
+    import phantoms.catphan
+
+    base_params = config['analysis_params']
+    for name in grid:
+        if name not in base_params:
+            raise Exception(f'Unknown analysis parameter: {name}')
+    combinations = get_combinations(grid)
+    workers = min(workers or os.cpu_count() or 1, len(combinations))
+
+    log_message(f"loading CatPhan{config['catphan_model']}...")
+    start_time = time.perf_counter()
+    phantom = phantoms.catphan.load_catphan(config['catphan_model'], input_files)
+    if phantom is None:
+        raise Exception(f"Unknown CatPhan model: {config['catphan_model']}")
+    log_message(f'loaded in {time.perf_counter() - start_time:.1f} s')
+
+    phantom_bytes = None
+    if workers > 1:
+        try:
+            phantom_bytes = pickle.dumps(phantom, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            log_message(f'phantom cannot be sent to worker processes ({e}), analyzing serially...')
+
+    log_message(f'analyzing {len(combinations)} combinations on {workers if phantom_bytes else 1} processes...')
+    start_time = time.perf_counter()
+    if phantom_bytes:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=init_worker,
+                                 initargs=(phantom_bytes,)) as executor:
+            rows = list(executor.map(evaluate_in_worker, itertools.repeat(base_params), combinations))
+    else:
+        rows = []
+        for combination in combinations:
+            # a fresh copy for each combination as in the workers, so the results do not depend on the number of processes
+            try:
+                fresh_phantom = copy.deepcopy(phantom)
+            except Exception as e:
+                log_message(f'phantom cannot be copied ({e}), reloading it...')
+                fresh_phantom = phantoms.catphan.load_catphan(config['catphan_model'], input_files)
+            rows.append(evaluate(fresh_phantom, base_params, combination))
+    log_message(f'{len(combinations)} combinations analyzed in {time.perf_counter() - start_time:.1f} s')
+
+    return rows
+
+def get_table(rows, metrics=None):
+    # (columns, values): the swept parameters, passed, the metrics and the error of each combination
+    if metrics is None:
+        present = set(key for row in rows for key in row['results'])
+        metrics = [metric for metric in DEFAULT_METRICS if metric in present]
+    param_names = list(rows[0]['params']) if rows else []
+    columns = param_names + ['passed'] + metrics + ['error']
+    values = []
+    for row in rows:
+        values.append([row['params'][name] for name in param_names] + [row['passed']]
+                      + [row['results'].get(metric) for metric in metrics] + [row['error']])
+    return columns, values
+
+def format_table(columns, values):
+    # fixed-width text table for the console
+    cells = [[str(column) for column in columns]] + [['' if value is None else str(value) for value in row] for row in values]
+    widths = [max(len(row[i]) for row in cells) for i in range(len(columns))]
+    return '\n'.join('  '.join(cell.ljust(width) for cell, width in zip(row, widths)) for row in cells)
+
+def save_table(columns, values, table_file):
+    with open(table_file, 'w') as file:
+        file.write(','.join(columns) + '\n')
+        for row in values:
+            file.write(','.join('' if value is None else str(value).replace(',', '[comma]').replace('\n', '[newline]') for value in row) + '\n')
+
+def main():
+    parser = argparse.ArgumentParser(description="CatPhan parameter sweep: load the images once, analyze them with a grid of analysis_params")
+    parser.add_argument("-i", "--input_folder", required=True, help="The path to the folder with input dicom files (or a staged case folder)")
+    parser.add_argument("-c", "--config_file", required=True, help="Configuration file path; its analysis_params are used for the parameters not in the grid")
+    parser.add_argument("-g", "--grid", nargs='+', required=True, help="Parameter values, e.g. hu_tolerance=30,40,50 cnr_threshold=10,15 contrast_method=Michelson,Weber")
+    parser.add_argument("-m", "--metrics", nargs='+', help="Result keys shown in the table (flattened as in results.csv). Default: the main pass/fail and image quality metrics.")
+    parser.add_argument("-o", "--output_file", default=SWEEP_TABLE_FILE, help=f"CSV file of the table (default {SWEEP_TABLE_FILE})")
+    parser.add_argument("-w", "--workers", type=int, help="Number of processes (default: number of CPUs)")
+    args = parser.parse_args()
+
+    config = read_json_file(args.config_file)
+    grid = parse_grid(args.grid)
+    input_files = staging_helper.read_staged_input(args.input_folder)
+
+    rows = run_sweep(input_files, config, grid, workers=args.workers, log_message=log)
+
+    columns, values = get_table(rows, args.metrics)
+    log(format_table(columns, values))
+    log(f'saving sweep table: {args.output_file}')
+    save_table(columns, values, args.output_file)
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    try:
+        main()
+    except Exception as e:
+        log(f'Error: {e}')
+        sys.exit(1)
@@ -6,107 +6,163 @@ import argparse
 
 import json
 import os
-from util import log, obj_serializer, read_json_file
+import multiprocessing
+from util import log, read_json_file
 from pylinac import CatPhan604, CatPhan600, CatPhan504, CatPhan503
+import phantoms.artifacts
+import catphan_batch
+import result_serializer
 
 __version__ = "1.0.0"
 
-# Create the parser
-parser = argparse.ArgumentParser(description="CTQA using CatPhans")
-
-# Define the arguments
-parser.add_argument("-i", "--input_folder", required=True, help="The path to the folder with input dicom files")
-parser.add_argument("-o", "--output_folder", required=False, help="The path to the folder where all the output files will be saved. If not given, the files will be saved to the 'out' folder under the input folder.")
-parser.add_argument("-c", "--config_file", required=True, help="Configuration file path")
-parser.add_argument("-v", "--verbose", action="store_true", help="Increase output verbosity")
-
-# Parse the arguments
-args = parser.parse_args()
-
-################
-# input_dir
-input_dir = args.input_folder
-log(f'input_dir={input_dir}')
-
-###############
-# output_dir
-if not args.output_folder:
-    output_dir = os.path.join(input_dir, 'out')
-else:
-    output_dir = args.output_folder
-log(f'output_dir={output_dir}')
-if not os.path.exists(output_dir):
-    log('outout_dir not found. creating...')
-    os.makedirs(output_dir)
-
-##############
-#config_file
-config_file = args.config_file
-log(f'config_file={config_file}')
-log(f'loading config file...')
-config = read_json_file(config_file)
-
-# result files
-result_json = os.path.join(output_dir, 'result.json')
-result_pdf = os.path.join(output_dir, 'result.pdf')
-result_txt = os.path.join(output_dir, 'result.txt')
-
-catphan_model = config['catphan_model']
-log(f'phantom_model={catphan_model}')
-
-log('creating CatPhan604...')
-if catphan_model == '604':
-    ct = CatPhan604(input_dir)
-elif catphan_model == '600':
-    ct = CatPhan600(input_dir)
-elif catphan_model == '504':
-    ct = CatPhan504(input_dir)
-elif catphan_model == '503':
-    ct = CatPhan503(input_dir)
-else:
-    log(f'Unknown catphan model: {catphan_model}')
-
-log('analizing...')
-params = config['analysis_params']
-ct.analyze(
-    hu_tolerance=params['hu_tolerance'],
-    scaling_tolerance=params['scaling_tolerance'],
-    thickness_tolerance=params['thickness_tolerance'],
-    low_contrast_tolerance=params['low_contrast_tolerance'],
-    cnr_threshold=params['cnr_threshold'],
-    zip_after=params['zip_after'],
-    contrast_method=params['contrast_method'],
-    visibility_threshold=params['visibility_threshold'],
-    thickness_slice_straddle=params['thickness_slice_straddle'],
-    expected_hu_values=params['expected_hu_values'])
-
-###############
-# result_pdf
-params = config['publish_pdf_params']
-result_pdf = os.path.join(output_dir, params['filename'])
-log(f'saving result pdf file, {result_pdf}...')
-ct.publish_pdf(filename=result_pdf, 
-               notes=params['notes'], 
-               open_file=params['open_file'], 
-               metadata=params['metadata'], 
-               logo=params['logo'] )
-############
-# result txt
-result = ct.results_data()
-log(ct.results())
-log(f'saving result txt file: {result_txt}...')
-with open(result_txt, 'w') as file:
-    file.write(ct.results())
-
-##############
-# result json
-# Convert result object to a dictionary, applying custom serialization
-result_dict = json.loads(json.dumps(vars(result), default=obj_serializer))
-
-# Specify the path to save the JSON file
-log(f'savin results json file:{result_json}...')
-# Save the serialized result to the JSON file
-with open(result_json, "w") as json_file:
-    json.dump(result_dict, json_file, indent=4)
-    
-log('done')
\ No newline at end of file
+def parse_args():
+    # Create the parser
+    parser = argparse.ArgumentParser(description="CTQA using CatPhans")
+
+    # Define the arguments
+    input_group = parser.add_mutually_exclusive_group(required=True)
+    input_group.add_argument("-i", "--input_folder", help="The path to the folder with input dicom files")
+    input_group.add_argument("-b", "--batch", help="Batch mode: a root folder or a glob pattern (e.g. 'archive/**/CatPhan*'). Every CT series found under it is analyzed in its own case folder under --output_folder. An interrupted batch resumes where it stopped.")
+    parser.add_argument("-o", "--output_folder", required=False, help="The path to the folder where all the output files will be saved. If not given, the files will be saved to the 'out' folder under the input folder. Required in batch mode.")
+    parser.add_argument("-c", "--config_file", required=True, help="Configuration file path")
+    parser.add_argument("-p", "--output_profile", required=False, choices=list(phantoms.artifacts.OUTPUT_PROFILES), help="Outputs to produce: minimal (result.json), standard (adds result.txt, and the images in batch mode) or full (adds the PDF). If not given, the output_profile of the config file is used (default full). Batch mode also adds each result to the results database, the single folder mode does not. With defer_outputs set in the config (not in batch mode), skipped outputs can be produced later with 'python -m phantoms.artifacts <output_folder>'.")
+    parser.add_argument("-w", "--workers", type=int, required=False, help="Batch mode: number of cases analyzed in parallel (default: number of CPUs)")
+    parser.add_argument("--device_id", default='', help="Batch mode: device id saved in the results")
+    parser.add_argument("--performed_by", default='', help="Batch mode: 'Performed By' saved in the results")
+    parser.add_argument("--min_slices", type=int, default=catphan_batch.DEFAULT_MIN_SLICES, help="Batch mode: CT series with fewer files are skipped")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Increase output verbosity")
+
+    # Parse the arguments
+    return parser.parse_args()
+
+def load_config(args):
+    ##############
+    #config_file
+    config_file = args.config_file
+    log(f'config_file={config_file}')
+    log(f'loading config file...')
+    config = read_json_file(config_file)
+    return config
+
+def analyze_folder(args, config):
+    ################
+    # input_dir
+    input_dir = args.input_folder
+    log(f'input_dir={input_dir}')
+
+    ###############
+    # output_dir
+    if not args.output_folder:
+        output_dir = os.path.join(input_dir, 'out')
+    else:
+        output_dir = args.output_folder
+    log(f'output_dir={output_dir}')
+    if not os.path.exists(output_dir):
+        log('outout_dir not found. creating...')
+        os.makedirs(output_dir)
+
+    # result files
+    result_json = os.path.join(output_dir, 'result.json')
+    result_pdf = os.path.join(output_dir, 'result.pdf')
+    result_txt = os.path.join(output_dir, 'result.txt')
+
+    output_kinds = phantoms.artifacts.get_output_kinds(config, args.output_profile)
+    log(f'outputs={output_kinds}')
+
+    catphan_model = config['catphan_model']
+    log(f'phantom_model={catphan_model}')
+
+    log('creating CatPhan604...')
+    if catphan_model == '604':
+        ct = CatPhan604(input_dir)
+    elif catphan_model == '600':
+        ct = CatPhan600(input_dir)
+    elif catphan_model == '504':
+        ct = CatPhan504(input_dir)
+    elif catphan_model == '503':
+        ct = CatPhan503(input_dir)
+    else:
+        log(f'Unknown catphan model: {catphan_model}')
+
+    log('analizing...')
+    params = config['analysis_params']
+    ct.analyze(
+        hu_tolerance=params['hu_tolerance'],
+        scaling_tolerance=params['scaling_tolerance'],
+        thickness_tolerance=params['thickness_tolerance'],
+        low_contrast_tolerance=params['low_contrast_tolerance'],
+        cnr_threshold=params['cnr_threshold'],
+        zip_after=params['zip_after'],
+        contrast_method=params['contrast_method'],
+        visibility_threshold=params['visibility_threshold'],
+        thickness_slice_straddle=params['thickness_slice_straddle'],
+        expected_hu_values=params['expected_hu_values'])
+
+    ###############
+    # result_pdf
+    params = config['publish_pdf_params']
+    if 'pdf' in output_kinds:
+        result_pdf = os.path.join(output_dir, params['filename'])
+        log(f'saving result pdf file, {result_pdf}...')
+        ct.publish_pdf(filename=result_pdf, 
+                       notes=params['notes'], 
+                       open_file=params['open_file'], 
+                       metadata=params['metadata'], 
+                       logo=params['logo'] )
+    ############
+    # result txt
+    result = ct.results_data()
+    log(ct.results())
+    if 'txt' in output_kinds:
+        log(f'saving result txt file: {result_txt}...')
+        with open(result_txt, 'w') as file:
+            file.write(ct.results())
+
+    ##############
+    # result json
+    # Specify the path to save the JSON file
+    log(f'savin results json file:{result_json}...')
+    # Save the result object to the JSON file, serialized in one pass
+    with open(result_json, "w") as json_file:
+        result_serializer.dump(vars(result), json_file, **result_serializer.get_options(config))
+
+    ##############
+    # deferred outputs
+    skipped = [kind for kind in phantoms.artifacts.get_deferred_kinds(config, output_kinds) if kind in ['pdf', 'txt']]
+    if skipped:
+        phantoms.artifacts.save_deferred(phantom=ct, skipped=skipped, output_dir=output_dir, device_id=None, config=config,
+                                         notes=params['notes'], metadata=params['metadata'], log_message=log)
+
+    log('done')
+
+def analyze_batch(args, config):
+    if not args.output_folder:
+        raise Exception('--output_folder is required in batch mode')
+
+    if args.output_profile:
+        config['output_profile'] = args.output_profile
+
+    catphan_batch.run_batch(root_or_glob=args.batch,
+                            output_root=args.output_folder,
+                            config=config,
+                            device_id=args.device_id,
+                            performed_by=args.performed_by,
+                            notes=config['publish_pdf_params'].get('notes', ''),
+                            workers=args.workers,
+                            min_slices=args.min_slices,
+                            index_file=os.path.join(args.output_folder, 'dicom_index.db'),
+                            log_message=log)
+
+def main():
+    args = parse_args()
+    config = load_config(args)
+
+    if args.batch:
+        analyze_batch(args, config)
+    else:
+        analyze_folder(args, config)
+
+if __name__ == '__main__':
+    # the batch workers are spawned processes, also in the frozen build
+    multiprocessing.freeze_support()
+    main()
@@ -4,7 +4,12 @@ from tkinter import messagebox
 from tkinter import ttk
 from PIL import Image, ImageTk  # For displaying DICOM images as 2D previews
 
-from dicom_helper import parse_dicom_directory, read_dicom_image
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from util import LRUCache
+from dicom_helper import iter_dicom_directory, add_to_dicom_tree, get_dicom_thumbnail
 import pydicom
 from enum import Enum
 
@@ -12,14 +17,52 @@ class SelectionMode(Enum):
     SERIES = 1
     FILE = 2
 
+# time budget (ms) for handling scan results per after() tick, and the delay between ticks
+SCAN_QUEUE_BATCH_MS = 50
+SCAN_QUEUE_INTERVAL_MS = 20
+
+# minimum time (s) between two progress updates sent by the scan thread
+SCAN_PROGRESS_INTERVAL = 0.1
+
+# file nodes inserted per page when a series node is expanded
+FILE_PAGE_SIZE = 500
+
+# size of the image preview canvas
+PREVIEW_WIDTH = 400
+PREVIEW_HEIGHT = 300
+
+# number of decoded datasets/thumbnails and of PhotoImages kept in memory
+PREVIEW_CACHE_SIZE = 32
+
+# number of instances before and after the selected one that are loaded in the background
+PREFETCH_COUNT = 3
+
 class DicomChooser:
-    def __init__(self, root, input_dir, selection_mode=SelectionMode.SERIES):
+    def __init__(self, root, input_dir, selection_mode=SelectionMode.SERIES, index_file=None, workers=1, streaming=False, thumbnail_cache=None):
         self.root = root
         self.input_dir = input_dir
+        self.index_file = index_file  # persistent header index (None to always read all headers)
+        self.workers = workers  # number of threads reading headers
+        self.streaming = streaming  # insert tree nodes in batches as the headers are read
+        self.scan_queue = queue.Queue()  # results from the scan thread
+        self.scan_cancel_event = threading.Event()
+        self.scan_thread = None
+        self.scan_finished = False  # set once the scan thread has sent its last record
+        self.thumbnail_cache = thumbnail_cache  # folder for cached preview thumbnails (None for no cache)
+        self.study_nodes = {}  # (patient_name, study_uid) -> treeview node
+        self.series_nodes = {}  # (patient_name, study_uid, series_uid) -> treeview node
+        self.loaded_file_counts = {}  # series node -> number of file nodes inserted so far
+        self.more_nodes = {}  # placeholder/"load more" node -> its series node
         self.selected_name = None
         self.selected_files = []
         self.dicom_tree = None  # Store the parsed DICOM structure
         self.tk_image = None  # Store the Tkinter image object
+        self.dataset_cache = LRUCache(PREVIEW_CACHE_SIZE)  # file_path -> decoded dataset, for thumbnail cache misses
+        self.headers = LRUCache(PREVIEW_CACHE_SIZE)  # file_path -> dataset without pixel data, for the properties
+        self.thumbnails = LRUCache(PREVIEW_CACHE_SIZE)  # file_path -> uint8 thumbnail
+        self.photo_images = LRUCache(PREVIEW_CACHE_SIZE)  # file_path -> PhotoImage (Tk thread only)
+        self.prefetch_executor = ThreadPoolExecutor(max_workers=1)
+        self.prefetch_generation = 0  # bumped on every selection, so stale prefetches are skipped
         self.selection_mode = selection_mode
 
     def show(self):
@@ -38,6 +81,19 @@ class DicomChooser:
         self.series_tree = ttk.Treeview(self.window)
         self.series_tree.pack(fill="both", expand=True, padx=10, pady=10)
 
+        # Scan progress, with a button to stop the scan
+        self.scan_frame = tk.Frame(self.window)
+        self.scan_frame.pack(fill="x", padx=10)
+
+        self.scan_progress_bar = ttk.Progressbar(self.scan_frame, orient=tk.HORIZONTAL, mode='determinate')
+        self.scan_progress_bar.pack(side="left", fill="x", expand=True)
+
+        self.scan_status_label = tk.Label(self.scan_frame, text="", width=25, anchor="w")
+        self.scan_status_label.pack(side="left", padx=5)
+
+        self.scan_cancel_button = tk.Button(self.scan_frame, text="Cancel", command=self.on_cancel_scan_clicked)
+        self.scan_cancel_button.pack(side="left")
+
         # Button to confirm selection
         button_label = "Select Series" if self.selection_mode == SelectionMode.SERIES else 'Select File'
         select_button = tk.Button(self.window, text=button_label, command=self.on_select_clicked)
@@ -48,7 +104,7 @@ class DicomChooser:
         self.image_properties_frame.pack(fill="both", expand=True)
 
         # Add a canvas to preview the image
-        self.preview_canvas = tk.Canvas(self.image_properties_frame, width=400, height=300)
+        self.preview_canvas = tk.Canvas(self.image_properties_frame, width=PREVIEW_WIDTH, height=PREVIEW_HEIGHT)
         self.preview_canvas.pack(side='left')
 
         # Create a frame for the DICOM properties on the right
@@ -71,60 +127,281 @@ class DicomChooser:
         self.properties_tree.column('Description', anchor='w', width=150)
         self.properties_tree.column('Value', anchor='w', width=150)
 
-        # Load series into the treeview
+        # Load series into the treeview (in the background)
         self.load_series_tree()
 
         # Bind selection event to display preview
         self.series_tree.bind("<<TreeviewSelect>>", self.on_treeview_select)
 
+        # File nodes are inserted only when a series is expanded
+        self.series_tree.bind("<<TreeviewOpen>>", self.on_treeview_open)
+
     def load_series_tree(self):
         # Parse the DICOM files to build the study and series list
         if not self.input_dir:
             messagebox.showerror("Error", "Please select the input folder.")
             return
 
-        self.dicom_tree = parse_dicom_directory(self.input_dir)
+        # the directory is parsed on a worker thread; results come back through scan_queue
+        self.dicom_tree = {}
+        self.window.bind("<Destroy>", self.on_window_destroyed, add="+")
+        self.scan_thread = threading.Thread(target=self.scan_directory, daemon=True)
+        self.scan_thread.start()
+        self.window.after(SCAN_QUEUE_INTERVAL_MS, self.process_scan_queue)
+
+    def scan_directory(self):
+        # runs on the scan thread, must not touch any widget
+        last_progress_time = 0
+
+        def on_progress(num_scanned, num_files):
+            nonlocal last_progress_time
+            now = time.perf_counter()
+            if num_scanned == num_files or now - last_progress_time > SCAN_PROGRESS_INTERVAL:
+                last_progress_time = now
+                self.scan_queue.put(('progress', num_scanned, num_files))
+
+        try:
+            for record in iter_dicom_directory(self.input_dir, index_file=self.index_file, workers=self.workers,
+                                               progress=on_progress, cancel_event=self.scan_cancel_event):
+                self.scan_queue.put(('record', record))
+            self.scan_queue.put(('done', None))
+        except Exception as e:
+            self.scan_queue.put(('done', e))
+
+    def process_scan_queue(self):
+        if not self.window.winfo_exists():
+            return
+
+        # handle as many results as fit in the time budget, then give the event loop a turn
+        deadline = time.perf_counter() + SCAN_QUEUE_BATCH_MS / 1000
+        updated_series = set()
+        done = False
+        error = None
+        while time.perf_counter() < deadline:
+            try:
+                message = self.scan_queue.get_nowait()
+            except queue.Empty:
+                break
+
+            if message[0] == 'record':
+                record = message[1]
+                add_to_dicom_tree(self.dicom_tree, record.header, record.file_path)
+                if self.streaming:
+                    updated_series.add(self.insert_record(record))
+            elif message[0] == 'progress':
+                num_scanned, num_files = message[1:]
+                self.scan_progress_bar.config(maximum=max(num_files, 1), value=num_scanned)
+                self.scan_status_label.config(text=f"{num_scanned} / {num_files} files")
+            else:
+                done = True
+                error = message[1]
+                break
+
+        for series_key in updated_series:
+            self.update_series_node_text(series_key)
+
+        if done:
+            self.on_scan_finished(error)
+        else:
+            self.window.after(SCAN_QUEUE_INTERVAL_MS, self.process_scan_queue)
+
+    def on_scan_finished(self, error):
+        self.scan_finished = True
+        if not self.streaming:
+            self.populate_series_tree()
+
+        self.scan_cancel_button.config(state=tk.DISABLED)
+        if error is not None:
+            self.scan_status_label.config(text="Scan failed")
+            messagebox.showerror("Error", f"Failed to read the input folder: {error}")
+        elif self.scan_cancel_event.is_set():
+            self.scan_status_label.config(text=self.scan_status_label.cget("text") + " (cancelled)")
+
+    def on_cancel_scan_clicked(self):
+        self.scan_cancel_event.set()
 
+    def populate_series_tree(self):
         # Populate the treeview with study and series information
         for patient_name, studies in self.dicom_tree.items():
             for study_uid, series_dict in studies.items():
                 study_node = self.series_tree.insert('', 'end', text=f"{patient_name} - {study_uid}", open=True)
 
                 # Add series under the study node
-                for series_uid, series_data in series_dict.items():
-                    modality = series_data.get('modality', 'Unknown')
-                    series_datetime = series_data.get('series_datetime', 'Unknown')
-                    num_files = len(series_data['files'])
-                    # Format series display text to include Modality and DateTime
-                    series_display = f"{modality} - {series_datetime} - {series_uid} ({num_files} files)"
-
-                    # Insert the series information as a child node of the study node, with values for lookup
-                    series_node = self.series_tree.insert(study_node, 'end', text=series_display, values=(patient_name, study_uid, series_uid))
+                for series_uid in series_dict:
+                    self.insert_series_node(study_node, (patient_name, study_uid, series_uid))
+
+    def insert_series_node(self, study_node, series_key):
+        # Insert the series information as a child node of the study node, with values for lookup
+        series_uid = series_key[2]
+        series_data = self.get_series_data(series_key)
+        series_node = self.series_tree.insert(study_node, 'end', text=self.get_series_display(series_uid, series_data), values=series_key)
+        self.series_nodes[series_key] = series_node
+
+        # placeholder child, so the series can be expanded; the file nodes are inserted on open
+        self.insert_more_node(series_node, 'Loading...')
+        return series_node
+
+    def insert_more_node(self, series_node, text):
+        more_node = self.series_tree.insert(series_node, 'end', text=text)
+        self.more_nodes[more_node] = series_node
+
+    def get_series_data(self, series_key):
+        patient_name, study_uid, series_uid = series_key
+        return self.dicom_tree[patient_name][study_uid][series_uid]
+
+    def load_series_files(self, series_node):
+        # Insert the next page of file nodes of the series
+        for child in self.series_tree.get_children(series_node):
+            if child in self.more_nodes:
+                del self.more_nodes[child]
+                self.series_tree.delete(child)
+
+        files = self.get_series_data(self.series_tree.item(series_node, 'values'))['files']
+        loaded = self.loaded_file_counts.get(series_node, 0)
+
+        # Add individual DICOM files as children of the series node
+        for dicom_file in files[loaded:loaded + FILE_PAGE_SIZE]:
+            filename = os.path.basename(dicom_file)
+            self.series_tree.insert(series_node, 'end', text=filename, values=(dicom_file,), open=False)
+
+        self.loaded_file_counts[series_node] = min(len(files), loaded + FILE_PAGE_SIZE)
+        self.update_more_node(series_node)
+
+    def update_more_node(self, series_node):
+        # Add a "load more" node if the series has files that are not shown yet
+        if series_node not in self.loaded_file_counts or series_node in self.more_nodes.values():
+            return
 
-                    # Add individual DICOM files as children of the series node
-                    for dicom_file in series_data['files']:
-                        filename = os.path.basename(dicom_file)
-                        self.series_tree.insert(series_node, 'end', text=filename, values=(dicom_file,), open=False)
+        files = self.get_series_data(self.series_tree.item(series_node, 'values'))['files']
+        remaining = len(files) - self.loaded_file_counts[series_node]
+        if remaining > 0:
+            self.insert_more_node(series_node, f'Load more... ({remaining} files)')
+
+    def on_treeview_open(self, event):
+        series_node = self.series_tree.focus()
+        if series_node in self.series_nodes.values() and series_node not in self.loaded_file_counts:
+            self.load_series_files(series_node)
+
+    def insert_record(self, record):
+        # Insert the study/series nodes of one record (if new), returns the series key
+        study_key = (record.patient_name, record.study_uid)
+        if study_key not in self.study_nodes:
+            self.study_nodes[study_key] = self.series_tree.insert('', 'end', text=f"{record.patient_name} - {record.study_uid}", open=True)
+
+        series_key = (record.patient_name, record.study_uid, record.series_uid)
+        if series_key not in self.series_nodes:
+            self.insert_series_node(self.study_nodes[study_key], series_key)
+
+        return series_key
+
+    def update_series_node_text(self, series_key):
+        series_node = self.series_nodes[series_key]
+        series_data = self.get_series_data(series_key)
+        self.series_tree.item(series_node, text=self.get_series_display(series_key[2], series_data))
+
+        # files that arrived after the series was expanded
+        self.update_more_node(series_node)
+
+    def get_series_display(self, series_uid, series_data):
+        modality = series_data.get('modality', 'Unknown')
+        series_datetime = series_data.get('series_datetime', 'Unknown')
+        num_files = len(series_data['files'])
+        # Format series display text to include Modality and DateTime
+        return f"{modality} - {series_datetime} - {series_uid} ({num_files} files)"
+
+    def on_window_destroyed(self, event):
+        # stop the scan (the scan thread saves the index) when the window is closed
+        if event.widget is self.window:
+            self.scan_cancel_event.set()
+            self.prefetch_generation += 1
+            self.prefetch_executor.shutdown(wait=False, cancel_futures=True)
 
     def on_treeview_select(self, event):
         selected_item = self.series_tree.selection()
 
         if selected_item:
+            if selected_item[0] in self.more_nodes:
+                self.load_series_files(self.more_nodes[selected_item[0]])
+                return
+
+            item_values = self.series_tree.item(selected_item, 'values')
+            if not item_values:
+                return
+
             # Get the file path if a file is selected
-            file_path = self.series_tree.item(selected_item, 'values')[0]
+            file_path = item_values[0]
 
             # If it's a DICOM file, preview the image
             if os.path.isfile(file_path):
                 self.preview_dicom_image(file_path)
                 self.update_dicom_properties(file_path)
+                self.prefetch_neighbors(selected_item[0])
+
+    def load_dataset(self, file_path):
+        # Decoded dataset of a file, cached; safe to call from the prefetch thread
+        dicom_data = self.dataset_cache.get(file_path)
+        if dicom_data is None:
+            dicom_data = pydicom.dcmread(file_path)
+            self.dataset_cache.put(file_path, dicom_data)
+        return dicom_data
+
+    def load_header(self, file_path):
+        # Dataset without the pixel data, cached; safe to call from the prefetch thread
+        dicom_data = self.dataset_cache.get(file_path)
+        if dicom_data is not None:
+            return dicom_data
+        header = self.headers.get(file_path)
+        if header is None:
+            header = pydicom.dcmread(file_path, stop_before_pixels=True)
+            self.headers.put(file_path, header)
+        return header
+
+    def load_thumbnail(self, file_path):
+        # Thumbnail of a file, cached; safe to call from the prefetch thread
+        thumbnail = self.thumbnails.get(file_path)
+        if thumbnail is None:
+            thumbnail = get_dicom_thumbnail(file_path, (PREVIEW_WIDTH, PREVIEW_HEIGHT), cache_folder=self.thumbnail_cache,
+                                            load_dicom_data=lambda: self.load_dataset(file_path))
+            self.thumbnails.put(file_path, thumbnail)
+        return thumbnail
+
+    def prefetch_neighbors(self, file_node):
+        # Load the next and previous instances of the series in the background
+        self.prefetch_generation += 1
+        series_node = self.series_tree.parent(file_node)
+        if series_node not in self.loaded_file_counts:
+            return
+
+        files = self.get_series_data(self.series_tree.item(series_node, 'values'))['files']
+        file_path = self.series_tree.item(file_node, 'values')[0]
+        if file_path not in files:
+            return
+        i = files.index(file_path)
+
+        # nearest first, next before previous
+        neighbors = []
+        for offset in range(1, PREFETCH_COUNT + 1):
+            neighbors += [files[j] for j in (i + offset, i - offset) if 0 <= j < len(files)]
+
+        for neighbor in neighbors:
+            self.prefetch_executor.submit(self.prefetch, neighbor, self.prefetch_generation)
+
+    def prefetch(self, file_path, generation):
+        if generation != self.prefetch_generation:
+            return  # the selection has moved on
+        try:
+            self.load_thumbnail(file_path)
+            self.load_header(file_path)
+        except Exception as e:
+            print(f"Error prefetching {file_path}: {e}")
 
     def update_dicom_properties(self, file_path):
         # Clear the current properties
         for item in self.properties_tree.get_children():
             self.properties_tree.delete(item)
 
-        # Read DICOM file
-        dicom_data = pydicom.dcmread(file_path)
+        # Read the header only (usually already cached by the prefetch), the pixel data is not listed
+        dicom_data = self.load_header(file_path)
 
         for elem in dicom_data:
             tag = elem.tag
@@ -135,18 +412,21 @@ class DicomChooser:
 
     def preview_dicom_image(self, file_path):
         try:
-            # Read the DICOM file as a 2D image (utility function needed)
-            image = read_dicom_image(file_path)
+            self.tk_image = self.photo_images.get(file_path)
+            if self.tk_image is None:
+                # Read the DICOM file as a 2D image, downsampled to the canvas size
+                image = self.load_thumbnail(file_path)
 
-            # Convert the image for display in Tkinter (assuming grayscale or RGB)
-            pil_image = Image.fromarray(image)
-            self.tk_image = ImageTk.PhotoImage(pil_image)
+                # Convert the image for display in Tkinter (assuming grayscale or RGB)
+                pil_image = Image.fromarray(image)
+                self.tk_image = ImageTk.PhotoImage(pil_image)
+                self.photo_images.put(file_path, self.tk_image)
 
             # Clear previous image
             self.preview_canvas.delete("all")
 
             # Display the image in the canvas
-            self.preview_canvas.create_image(200, 150, image=self.tk_image, anchor="center")
+            self.preview_canvas.create_image(PREVIEW_WIDTH // 2, PREVIEW_HEIGHT // 2, image=self.tk_image, anchor="center")
         except Exception as e:
             messagebox.showerror("Error", f"Failed to load DICOM image: {e}")
 
@@ -172,7 +452,15 @@ class DicomChooser:
             patient_name, study_uid, series_uid = item_values[:3]
         
             # Fetch the actual files for the selected series from the stored DICOM tree
-            self.selected_files = self.dicom_tree[patient_name][study_uid][series_uid]['files']
+            files = self.dicom_tree[patient_name][study_uid][series_uid]['files']
+
+            # while streaming, the scan may still be adding files to the series, and closing the window cancels it
+            if not self.scan_finished and not messagebox.askyesno(
+                    "Scan in progress",
+                    f"The folder is still being scanned, the series may be incomplete ({len(files)} files so far).\n\n"
+                    "Select it anyway?", parent=self.window):
+                return
+            self.selected_files = list(files)
 
             # Get the label of the selected series
             self.selected_name = self.series_tree.item(selected_item)['text']
@@ -180,6 +468,9 @@ class DicomChooser:
         else:
             # selected filename
             selected_item_value = self.series_tree.item(selected_item, 'values')
+            if not selected_item_value or not os.path.isfile(selected_item_value[0]):
+                messagebox.showwarning("Selection", "Invalid selection. Please select a file node.")
+                return
             self.selected_file = selected_item_value[0]
 
         # Close the popup window
@@ -1,83 +1,426 @@
 # util.py
 import os
+import io
+import time
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import pydicom
+import pydicom.filereader
+import pydicom.multival
+from pydicom.tag import Tag
 import numpy as np
 from datetime import datetime
+from dicom_index import DicomIndex, normalize_path
 
-def parse_dicom_directory(directory, include_subfolders=False):
+# header fields collected during directory scans, and the DICOM keyword each one comes from
+HEADER_TAGS = {
+    'patient_name': 'PatientName',
+    'study_uid': 'StudyInstanceUID',
+    'series_uid': 'SeriesInstanceUID',
+    'modality': 'Modality',
+    'series_date': 'SeriesDate',
+    'series_time': 'SeriesTime',
+    'study_date': 'StudyDate',
+    'study_time': 'StudyTime',
+    'acquisition_date': 'AcquisitionDate',
+    'acquisition_time': 'AcquisitionTime',
+    'sop_instance_uid': 'SOPInstanceUID',
+}
+# optional fields and their value when the tag is missing
+OPTIONAL_HEADER_FIELDS = {
+    'series_date': 'Unknown',
+    'series_time': 'Unknown',
+    'study_date': '',
+    'study_time': '',
+    'acquisition_date': '',
+    'acquisition_time': '',
+    'sop_instance_uid': '',
+}
+
+# read_partial matches specific_tags against Tag objects, not keywords
+HEADER_TAG_LIST = [Tag(keyword) for keyword in HEADER_TAGS.values()]
+
+# parsing stops after this tag, so the private groups (e.g. Varian sequences) are never read
+LAST_HEADER_TAG = max(HEADER_TAG_LIST)
+
+def header_from_dataset(ds):
+    # Returns the header fields, or None if a required tag is missing
+    header = {}
+    for field, keyword in HEADER_TAGS.items():
+        value = ds.get(keyword, None)
+        if value is None:
+            if field not in OPTIONAL_HEADER_FIELDS:
+                return None
+            value = OPTIONAL_HEADER_FIELDS[field]
+        header[field] = f'{value}'  # Convert to string
+    return header
+
+def read_dicom_header_tags(fp):
+    # Read only the header tags, skipping the values of all other elements
+    ds = pydicom.filereader.read_partial(fp,
+                                         stop_when=lambda tag, vr, length: tag > LAST_HEADER_TAG,
+                                         defer_size=256,
+                                         specific_tags=HEADER_TAG_LIST)
+    return header_from_dataset(ds)
+
+def read_dicom_header_full(fp):
+    # Read the whole DICOM header (no pixel data)
+    ds = pydicom.dcmread(fp, stop_before_pixels=True)
+    header = header_from_dataset(ds)
+    if header is None:
+        raise Exception('Required DICOM tags not found.')
+    return header
+
+def read_dicom_header(file_path):
+    with open(file_path, 'rb') as fp:
+        header = read_dicom_header_tags(fp)
+
+        if header is None:
+            # a tag was not found by the subset read, fall back to a full header read
+            fp.seek(0)
+            header = read_dicom_header_full(fp)
+
+    return header
+
+# headers seen in this process, {file_path: (size, mtime_ns, header)}
+# filled by the directory scans, so later lookups on the chosen files need no file reads
+header_cache = {}
+header_cache_lock = threading.Lock()
+
+def remember_header(file_path, size, mtime_ns, header):
+    with header_cache_lock:
+        header_cache[file_path] = (size, mtime_ns, header)
+
+def get_dicom_header(file_path):
+    # Header fields of a file, memoized per path, size and mtime
+    stat = os.stat(file_path)
+    with header_cache_lock:
+        cached = header_cache.get(file_path)
+    if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns and cached[2]:
+        return cached[2]
+
+    header = read_dicom_header(file_path)
+    remember_header(file_path, stat.st_size, stat.st_mtime_ns, header)
+    return header
+
+def add_to_dicom_tree(dicom_tree, header, file_path):
+    patient_name = header['patient_name']
+    study_uid = header['study_uid']
+    series_uid = header['series_uid']
+
+    # Organize files by patient, study, and series
+    if patient_name not in dicom_tree:
+        dicom_tree[patient_name] = {}
+    if study_uid not in dicom_tree[patient_name]:
+        dicom_tree[patient_name][study_uid] = {}
+    if series_uid not in dicom_tree[patient_name][study_uid]:
+        dicom_tree[patient_name][study_uid][series_uid] = {
+            'files': [], 
+            'modality': header['modality'], 
+            # Combine date and time for the label
+            'series_datetime': f"{header['series_date']} {header['series_time']}"
+        }
+
+    dicom_tree[patient_name][study_uid][series_uid]['files'].append(file_path)
+
+def list_directory_files(directory, include_subfolders=False):
+    # os.scandir caches the file type from the listing, so no extra stat per file
+    file_paths = []
+    folders = [directory]
+    while folders:
+        folder = folders.pop(0)
+        with os.scandir(folder) as it:
+            for entry in it:
+                if entry.is_file():
+                    file_paths.append(os.path.join(folder, entry.name))
+                elif include_subfolders and entry.is_dir():
+                    # Traverse through all its subdirectories for DICOM files
+                    folders.append(os.path.join(folder, entry.name))
+    return file_paths
+
+def merge_dicom_trees(dicom_tree, partial_tree):
+    # Merge a partial tree (e.g. from one worker) into dicom_tree, keeping file order
+    for patient_name, studies in partial_tree.items():
+        dst_studies = dicom_tree.setdefault(patient_name, {})
+        for study_uid, series_dict in studies.items():
+            dst_series_dict = dst_studies.setdefault(study_uid, {})
+            for series_uid, series_data in series_dict.items():
+                if series_uid in dst_series_dict:
+                    dst_series_dict[series_uid]['files'].extend(series_data['files'])
+                else:
+                    dst_series_dict[series_uid] = series_data
+
+def scan_file(file_path, entries):
+    '''
+    entries are the indexed headers ({path: entry}); the file is read only if missing there or changed.
+    Returns (header, update): header is None for non-DICOM files,
+    update is the (path, size, mtime_ns, header) row to index, or None if the indexed entry was used.
+    '''
+    try:
+        stat = os.stat(file_path)
+    except OSError as e:
+        print(f"Error reading file {file_path}: {e}")
+        return None, None
+
+    entry = entries.get(normalize_path(file_path))
+    if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+        # unchanged since the last scan
+        header = entry['header']
+        update = None
+    else:
+        try:
+            header = read_dicom_header(file_path)
+        except Exception as e:
+            print(f"Error reading DICOM file {file_path}: {e}")
+            header = None
+        update = (file_path, stat.st_size, stat.st_mtime_ns, header)
+
+    if header:
+        remember_header(file_path, stat.st_size, stat.st_mtime_ns, header)
+    return header, update
+
+def scan_files(file_paths, entries):
+    '''
+    Builds a partial dicom_tree for the given files.
+    Returns (partial_tree, updates), updates being the rows to index.
+    '''
+    partial_tree = {}
+    updates = []
+
+    for file_path in file_paths:
+        header, update = scan_file(file_path, entries)
+        if update:
+            updates.append(update)
+        if header:
+            add_to_dicom_tree(partial_tree, header, file_path)
+
+    return partial_tree, updates
+
+def split_into_chunks(items, num_chunks):
+    chunk_size = max(1, -(-len(items) // num_chunks))
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+def open_dicom_index(index_file, directory, include_subfolders):
+    # Returns (index, entries); (None, {}) when no index file is used
+    if not index_file:
+        return None, {}
+    index = DicomIndex(index_file)
+    return index, index.load_entries(directory, include_subfolders)
+
+def close_dicom_index(index, entries, file_paths, updates):
+    index.put_many(updates)
+    # files that are gone since the last scan
+    index.remove_many(entries.keys() - {normalize_path(file_path) for file_path in file_paths})
+    index.close()
+
+def log_scan_rate(log_message, num_files, num_read, start_time, workers):
+    elapsed = time.perf_counter() - start_time
+    files_per_second = num_files / elapsed if elapsed > 0 else 0
+    log_message(f'Scanned {num_files} files ({num_read} read) in {elapsed:.2f} s - {files_per_second:.0f} files/s, workers={workers}')
+
+def parse_dicom_directory(directory, include_subfolders=False, index_file=None, workers=1, log_message=print):
+    '''
+    Returns {patient_name: {study_uid: {series_uid: {'files', 'modality', 'series_datetime'}}}}.
+    If index_file is given, headers are cached there and only new or changed files are read.
+    With workers > 1, the headers are read on a thread pool (the work is mostly blocking I/O).
+    '''
+    start_time = time.perf_counter()
     dicom_tree = {}
+    directory = os.path.normpath(directory)
+
+    index, entries = open_dicom_index(index_file, directory, include_subfolders)
 
-    # Determine the function to use for traversing the directory
-    if include_subfolders:
-        # Traverse through the directory and all its subdirectories for DICOM files
-        directory_iterator = os.walk(directory)
+    file_paths = list_directory_files(directory, include_subfolders)
+
+    if workers > 1 and len(file_paths) > 1:
+        # contiguous chunks, merged back in order so the file order matches a serial scan
+        chunks = split_into_chunks(file_paths, workers * 4)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda chunk: scan_files(chunk, entries), chunks))
     else:
-        # Only list files in the specified directory (no subdirectories)
-        directory_iterator = [(directory, [], os.listdir(directory))]
+        results = [scan_files(file_paths, entries)]
 
-    for root, _, files in directory_iterator:
-        for file in files:
-            file_path = os.path.join(root, file)
+    updates = []
+    for partial_tree, partial_updates in results:
+        merge_dicom_trees(dicom_tree, partial_tree)
+        updates.extend(partial_updates)
 
-            try:
-                # Read the DICOM file
-                ds = pydicom.dcmread(file_path, stop_before_pixels=True)
-
-                # Extract required information
-                patient_name = f'{ds.PatientName}'  # Convert to string
-                study_uid = f'{ds.StudyInstanceUID}'
-                series_uid = f'{ds.SeriesInstanceUID}'
-                modality = f'{ds.Modality}'
-                series_date = f"{ds.get('SeriesDate', 'Unknown')}"  # Get SeriesDate or set as 'Unknown' if not available
-                series_time = f"{ds.get('SeriesTime', 'Unknown')}"  # Get SeriesTime or set as 'Unknown' if not available
-
-                # Combine date and time for the label
-                series_datetime = f"{series_date} {series_time}"
-
-                # Organize files by patient, study, and series
-                if patient_name not in dicom_tree:
-                    dicom_tree[patient_name] = {}
-                if study_uid not in dicom_tree[patient_name]:
-                    dicom_tree[patient_name][study_uid] = {}
-                if series_uid not in dicom_tree[patient_name][study_uid]:
-                    dicom_tree[patient_name][study_uid][series_uid] = {
-                        'files': [], 
-                        'modality': modality, 
-                        'series_datetime': series_datetime
-                    }
-
-                dicom_tree[patient_name][study_uid][series_uid]['files'].append(file_path)
-
-            except Exception as e:
-                print(f"Error reading DICOM file {file_path}: {e}")
-                continue
+    if index:
+        close_dicom_index(index, entries, file_paths, updates)
+
+    log_scan_rate(log_message, len(file_paths), len(updates), start_time, workers)
 
     return dicom_tree
+
+# one record per DICOM file found by iter_dicom_directory
+DicomRecord = namedtuple('DicomRecord', ['patient_name', 'study_uid', 'series_uid', 'file_path', 'header'])
+
+def iter_dicom_directory(directory, include_subfolders=False, index_file=None, workers=1, log_message=print,
+                         progress=None, cancel_event=None):
+    '''
+    Streaming variant of parse_dicom_directory: yields a DicomRecord for each DICOM file as soon as its header is known.
+    Records come in directory order. The index (if any) is updated when the generator finishes or is closed.
+    progress(num_scanned, num_files) is called after each file; setting cancel_event (threading.Event) stops the scan.
+    '''
+    def is_cancelled():
+        return cancel_event is not None and cancel_event.is_set()
+
+    def scan_chunk(chunk):
+        results = []
+        for file_path in chunk:
+            if is_cancelled():
+                break
+            results.append(scan_file(file_path, entries))
+        return results
+
+    start_time = time.perf_counter()
+    directory = os.path.normpath(directory)
+
+    index, entries = open_dicom_index(index_file, directory, include_subfolders)
+
+    file_paths = list_directory_files(directory, include_subfolders)
+
+    executor = None
+    num_scanned = 0
+    updates = []
+    try:
+        if workers > 1 and len(file_paths) > 1:
+            # small chunks so the first records are available quickly
+            executor = ThreadPoolExecutor(max_workers=workers)
+            chunks = split_into_chunks(file_paths, max(workers * 4, len(file_paths) // 64))
+            chunk_results = executor.map(scan_chunk, chunks)
+            results = (result for chunk_result in chunk_results for result in chunk_result)
+        else:
+            results = (scan_file(file_path, entries) for file_path in file_paths)
+
+        for file_path, (header, update) in zip(file_paths, results):
+            if is_cancelled():
+                break
+            num_scanned += 1
+            if progress:
+                progress(num_scanned, len(file_paths))
+            if update:
+                updates.append(update)
+            if header:
+                yield DicomRecord(header['patient_name'], header['study_uid'], header['series_uid'], file_path, header)
+    finally:
+        if executor:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        if index:
+            close_dicom_index(index, entries, file_paths, updates)
+
+        log_scan_rate(log_message, num_scanned, len(updates), start_time, workers)
+
 def read_dicom_image(file_path):
     # Read the DICOM file
     dicom_data = pydicom.dcmread(file_path)
 
     return get_dicom_image(dicom_data)
 
-def get_dicom_image(dicom_data):
-    
-    # Extract pixel data and apply any necessary transformations
+def get_dicom_image(dicom_data, max_size=None):
+    '''
+    Returns the image as uint8 for display: rescaled (RescaleSlope/Intercept) and windowed.
+    If max_size (width, height) is given, the image is block-mean downsampled to fit in it first.
+    '''
+    # Extract pixel data, the middle frame of multi-frame images
     image_array = dicom_data.pixel_array
+    is_color = dicom_data.get('SamplesPerPixel', 1) > 1
+    if image_array.ndim == (4 if is_color else 3):
+        image_array = image_array[len(image_array) // 2]
+
+    if max_size:
+        image_array = downsample_image(image_array, max_size[0], max_size[1])
+
+    if is_color:
+        return np.clip(image_array, 0, 255).astype(np.uint8)
+
+    # modality LUT (e.g. CT numbers in HU)
+    image_array = image_array.astype(np.float32)
+    slope = float(dicom_data.get('RescaleSlope', 1) or 1)
+    intercept = float(dicom_data.get('RescaleIntercept', 0) or 0)
+    if slope != 1 or intercept != 0:
+        image_array = image_array * np.float32(slope) + np.float32(intercept)
+
+    center, width = get_display_window(dicom_data, image_array)
+    image_array = window_image(image_array, center, width)
 
-    # Optionally, normalize or convert to grayscale/RGB if needed
-    # For example, normalize to 0-255 for 8-bit display
-    image_array = (image_array - np.min(image_array)) / (np.max(image_array) - np.min(image_array)) * 255
-    image_array = image_array.astype(np.uint8)
+    if dicom_data.get('PhotometricInterpretation', '') == 'MONOCHROME1':
+        image_array = 255 - image_array
 
     return image_array
 
+def downsample_image(image_array, max_width, max_height):
+    # Block-mean downsampling by an integer factor so the image fits in max_width x max_height
+    height, width = image_array.shape[:2]
+    factor = max(1, -(-height // max_height), -(-width // max_width))
+    if factor == 1:
+        return image_array
+
+    height, width = height // factor * factor, width // factor * factor
+    blocks = image_array[:height, :width].reshape(height // factor, factor, width // factor, factor, *image_array.shape[2:])
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+def get_display_window(dicom_data, image_array):
+    # (center, width) from the WindowCenter/WindowWidth tags, or from the 1st-99th percentiles of the image
+    center = dicom_data.get('WindowCenter', None)
+    width = dicom_data.get('WindowWidth', None)
+    if center is not None and width is not None:
+        # the tags can hold several windows, use the first one
+        center = float(center[0] if isinstance(center, pydicom.multival.MultiValue) else center)
+        width = float(width[0] if isinstance(width, pydicom.multival.MultiValue) else width)
+        if width > 0:
+            return center, width
+
+    low, high = np.percentile(image_array, [1, 99])
+    return (low + high) / 2, max(high - low, 1)
+
+def window_image(image_array, center, width):
+    lower = center - width / 2
+    image_array = (image_array - np.float32(lower)) * np.float32(255 / width)
+    np.clip(image_array, 0, 255, out=image_array)
+    return image_array.astype(np.uint8)
+
+def get_dicom_thumbnail(file_path, max_size, cache_folder=None, dicom_data=None, load_dicom_data=None):
+    '''
+    Display image of a file downsampled to fit in max_size (width, height).
+    If cache_folder is given, the uint8 thumbnails are cached there keyed by SOPInstanceUID.
+    dicom_data is the already read dataset of the file, if any; load_dicom_data returns it,
+    and is only called when the thumbnail is not cached.
+    '''
+    cache_file = None
+    if cache_folder:
+        sop_instance_uid = get_dicom_header(file_path).get('sop_instance_uid')
+        if sop_instance_uid:
+            cache_file = os.path.join(cache_folder, f'{sop_instance_uid}_{max_size[0]}x{max_size[1]}.npy')
+
+    if cache_file and os.path.exists(cache_file):
+        try:
+            return np.load(cache_file)
+        except Exception as e:
+            print(f"Error reading thumbnail {cache_file}: {e}")
+
+    # decode once, then downsample before any float work
+    if dicom_data is None and load_dicom_data is not None:
+        dicom_data = load_dicom_data()
+    if dicom_data is None:
+        dicom_data = pydicom.dcmread(file_path)
+    thumbnail = get_dicom_image(dicom_data, max_size)
+
+    if cache_file:
+        os.makedirs(cache_folder, exist_ok=True)
+        np.save(cache_file, thumbnail)
+
+    return thumbnail
+
 def get_acquisition_datetime(dicom_file_path):
-    # Read the DICOM file
-    dicom_data = pydicom.dcmread(dicom_file_path)
+    # Header only, and no file read at all if the file was seen by a directory scan
+    header = get_dicom_header(dicom_file_path)
 
     # Extract the acquisition date and time
-    acquisition_date = dicom_data.get('AcquisitionDate', None)
-    acquisition_time = dicom_data.get('AcquisitionTime', None)
+    acquisition_date = header['acquisition_date']
+    acquisition_time = header['acquisition_time']
 
     if acquisition_date and acquisition_time:
         # Pad the time string to ensure it is always 6 characters long (HHMMSS)
@@ -100,12 +443,12 @@ def get_acquisition_datetime_str(dicom_file_path):
     return dt.strftime('%Y%m%d_%H%M%S')
 
 def get_study_datetime(dicom_file_path):
-    # Read the DICOM file
-    dicom_data = pydicom.dcmread(dicom_file_path)
+    # Header only, and no file read at all if the file was seen by a directory scan
+    header = get_dicom_header(dicom_file_path)
 
     # Extract the study date and time
-    study_date = dicom_data.get('StudyDate', None)
-    study_time = dicom_data.get('StudyTime', None)
+    study_date = header['study_date']
+    study_time = header['study_time']
 
     if study_date and study_time:
         # Pad the study time to ensure it's always 6 characters long (HHMMSS)
@@ -124,4 +467,46 @@ def get_study_datetime_str(dicom_file_path):
     dt = get_study_datetime(dicom_file_path)
     
     # Return formatted string 'yyyyMMdd_HHmmss'
-    return dt.strftime('%Y%m%d_%H%M%S')
\ No newline at end of file
+    return dt.strftime('%Y%m%d_%H%M%S')
+
+class CountingFileIO(io.FileIO):
+    # Raw file that counts the bytes actually fetched from disk (or the network share)
+    def __init__(self, file_path):
+        super().__init__(file_path, 'rb')
+        self.bytes_read = 0
+
+    def readinto(self, buffer):
+        n = super().readinto(buffer)
+        self.bytes_read += n or 0
+        return n
+
+def benchmark_header_reads(directory, max_files=200):
+    # Compares bytes read per file by the full header read and the tag-subset read
+    file_paths = list_directory_files(directory)[:max_files]
+
+    for name, read_header in [('full header', read_dicom_header_full), ('tag subset', read_dicom_header_tags)]:
+        num_files = 0
+        total_bytes = 0
+        start_time = time.perf_counter()
+        for file_path in file_paths:
+            raw = CountingFileIO(file_path)
+            try:
+                with io.BufferedReader(raw) as fp:
+                    header = read_header(fp)
+                if header is None:
+                    # the tag subset read found no header, it is not a successful read
+                    continue
+                num_files += 1
+                total_bytes += raw.bytes_read
+            except Exception:
+                continue
+        elapsed = time.perf_counter() - start_time
+
+        if num_files == 0:
+            print(f'{name}: no DICOM files found in {directory}')
+            continue
+        print(f'{name}: {num_files} files, {total_bytes / num_files:.0f} bytes/file, {elapsed / num_files * 1000:.2f} ms/file')
+
+if __name__ == '__main__':
+    import sys
+    benchmark_header_reads(sys.argv[1])
@@ -0,0 +1,82 @@
+import os
+import sqlite3
+
+# default index file, kept next to settings.json
+INDEX_FILE = 'dicom_index.db'
+
+# bump this when the header columns change; older index files are rebuilt
+SCHEMA_VERSION = 4
+
+# header fields stored per file (in addition to path, size and mtime)
+HEADER_FIELDS = ['patient_name', 'study_uid', 'series_uid', 'modality', 'series_date', 'series_time',
+                 'study_date', 'study_time', 'acquisition_date', 'acquisition_time', 'sop_instance_uid']
+
+def normalize_path(path):
+    # one spelling per file: '.', relative and absolute paths of the same file share a row (case-insensitive on Windows)
+    return os.path.normcase(os.path.abspath(path))
+
+class DicomIndex:
+    '''
+    Persistent index of DICOM headers keyed by file path, size and mtime.
+    Files that are not DICOM are recorded too (is_dicom=0) so they are not re-opened on every scan.
+    '''
+    def __init__(self, db_file=INDEX_FILE):
+        self.db_file = db_file
+        self.conn = sqlite3.connect(db_file)
+        self.create_tables()
+
+    def create_tables(self):
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            # schema changed, start over (the index is only a cache)
+            self.conn.execute('DROP TABLE IF EXISTS files')
+
+        columns = ', '.join(f'{field} TEXT' for field in HEADER_FIELDS)
+        self.conn.execute(f'''CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            folder TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            is_dicom INTEGER NOT NULL,
+            {columns})''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_files_folder ON files(folder)')
+        self.conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        self.conn.commit()
+
+    def load_entries(self, directory, include_subfolders=False):
+        # returns {path: entry} for all indexed files in the directory, keyed by normalize_path
+        directory = normalize_path(directory)
+        select = f'SELECT path, size, mtime_ns, is_dicom, {", ".join(HEADER_FIELDS)} FROM files'
+        if include_subfolders:
+            prefix = os.path.join(directory, '')
+            rows = self.conn.execute(f'{select} WHERE folder = ? OR substr(folder, 1, ?) = ?',
+                                     (directory, len(prefix), prefix))
+        else:
+            rows = self.conn.execute(f'{select} WHERE folder = ?', (directory,))
+
+        entries = {}
+        for row in rows:
+            path, size, mtime_ns, is_dicom = row[:4]
+            header = dict(zip(HEADER_FIELDS, row[4:])) if is_dicom else None
+            entries[path] = {'size': size, 'mtime_ns': mtime_ns, 'header': header}
+        return entries
+
+    def put_many(self, items):
+        # items: list of (path, size, mtime_ns, header or None)
+        rows = []
+        for path, size, mtime_ns, header in items:
+            path = normalize_path(path)
+            folder = os.path.dirname(path)
+            values = [header.get(field) for field in HEADER_FIELDS] if header else [None] * len(HEADER_FIELDS)
+            rows.append((path, folder, size, mtime_ns, 1 if header else 0, *values))
+
+        placeholders = ', '.join(['?'] * (5 + len(HEADER_FIELDS)))
+        with self.conn:
+            self.conn.executemany(f'INSERT OR REPLACE INTO files VALUES ({placeholders})', rows)
+
+    def remove_many(self, paths):
+        with self.conn:
+            self.conn.executemany('DELETE FROM files WHERE path = ?', [(normalize_path(path),) for path in paths])
+
+    def close(self):
+        self.conn.close()
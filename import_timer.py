@@ -0,0 +1,92 @@
+import os
+import sys
+import time
+import threading
+import importlib.abc
+
+# turn the report on with this environment variable, or with --import-report on the command line
+ENV_VAR = 'CTQA_IMPORT_REPORT'
+ARG = '--import-report'
+
+class TimedLoader(importlib.abc.Loader):
+    # Wraps a module loader and records how long the module takes to execute
+    def __init__(self, loader, timer):
+        self.loader = loader
+        self.timer = timer
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        self.timer.enter()
+        start_time = time.perf_counter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            self.timer.exit(module.__name__, time.perf_counter() - start_time)
+
+    def __getattr__(self, name):
+        # get_code, get_source, is_package, ... of the wrapped loader
+        return getattr(self.loader, name)
+
+class ImportTimer(importlib.abc.MetaPathFinder):
+    '''
+    Meta path finder that times the execution of every module imported after install().
+    The cumulative time includes the imports done by the module, the self time does not.
+    '''
+    def __init__(self):
+        self.times = {}  # module name -> (cumulative seconds, self seconds)
+        # the stack of the time spent in nested imports, one per thread (the warm-up thread imports while the Tk thread does)
+        self.local = threading.local()
+
+    def get_child_times(self):
+        if not hasattr(self.local, 'child_times'):
+            self.local.child_times = []
+        return self.local.child_times
+
+    def install(self):
+        sys.meta_path.insert(0, self)
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = TimedLoader(spec.loader, self)
+                return spec
+        return None
+
+    def enter(self):
+        self.get_child_times().append(0.0)
+
+    def exit(self, name, elapsed):
+        child_times = self.get_child_times()
+        nested = child_times.pop()
+        self.times[name] = (elapsed, elapsed - nested)
+        if child_times:
+            child_times[-1] += elapsed
+
+    def report(self, max_lines=30):
+        lines = [f'{"module":<50}{"cumulative ms":>15}{"self ms":>10}']
+        for name, (cumulative, self_time) in sorted(self.times.items(), key=lambda item: -item[1][0])[:max_lines]:
+            lines.append(f'{name:<50}{cumulative * 1000:>15.1f}{self_time * 1000:>10.1f}')
+        return '\n'.join(lines)
+
+# the installed timer, None when the report is off
+timer = None
+
+def is_enabled():
+    return os.environ.get(ENV_VAR, '') not in ('', '0') or ARG in sys.argv
+
+def install_if_enabled():
+    global timer
+    if timer is None and is_enabled():
+        timer = ImportTimer()
+        timer.install()
+    return timer
+
+def report(log_message=print):
+    if timer is not None:
+        log_message('Import times:\n' + timer.report())
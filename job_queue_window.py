@@ -0,0 +1,77 @@
+import tkinter as tk
+from tkinter import ttk
+
+# refresh interval of the job list (ms)
+REFRESH_INTERVAL_MS = 500
+
+class JobQueueWindow:
+    '''
+    Panel listing the jobs of a JobQueue with their status.
+    The selected job can be cancelled, and the number of concurrent jobs can be changed.
+    '''
+    def __init__(self, root, job_queue):
+        self.root = root
+        self.job_queue = job_queue
+        self.window = None
+
+    def show(self):
+        if self.window is not None and self.window.winfo_exists():
+            self.window.lift()
+            return
+
+        self.window = tk.Toplevel(self.root)
+        self.window.title("Analysis Jobs")
+        self.window.geometry("800x300")
+
+        # Create a treeview listing the jobs
+        self.jobs_tree = ttk.Treeview(self.window, columns=('Id', 'Phantom', 'Device', 'Folder', 'Status'), show='headings')
+        for column, width in [('Id', 40), ('Phantom', 80), ('Device', 120), ('Folder', 400), ('Status', 120)]:
+            self.jobs_tree.heading(column, text=column)
+            self.jobs_tree.column(column, anchor='w', width=width)
+        self.jobs_tree.pack(fill="both", expand=True, padx=10, pady=10)
+
+        # Buttons and concurrency
+        self.buttons_frame = tk.Frame(self.window)
+        self.buttons_frame.pack(fill="x", padx=10, pady=5)
+
+        self.cancel_button = tk.Button(self.buttons_frame, text="Cancel Job", command=self.on_cancel_clicked)
+        self.cancel_button.pack(side="left", padx=5)
+
+        tk.Label(self.buttons_frame, text="Concurrent jobs:").pack(side="left", padx=5)
+        self.concurrency_var = tk.IntVar(value=self.job_queue.max_concurrency)
+        self.concurrency_spinbox = tk.Spinbox(self.buttons_frame, from_=1, to=16, width=5,
+                                              textvariable=self.concurrency_var, command=self.on_concurrency_changed)
+        self.concurrency_spinbox.pack(side="left")
+
+        self.refresh()
+
+    def refresh(self):
+        if not self.window.winfo_exists():
+            return
+
+        for job in self.job_queue.jobs:
+            status = job.status if not job.error else f'{job.status}: {job.error}'
+            values = (job.id, job.phantom, job.device_id, job.output_dir, status)
+            item = str(job.id)
+            if self.jobs_tree.exists(item):
+                self.jobs_tree.item(item, values=values)
+            else:
+                self.jobs_tree.insert('', 'end', iid=item, values=values)
+
+        self.window.after(REFRESH_INTERVAL_MS, self.refresh)
+
+    def on_cancel_clicked(self):
+        for item in self.jobs_tree.selection():
+            self.job_queue.cancel(int(item))
+        self.refresh_now()
+
+    def refresh_now(self):
+        for job in self.job_queue.jobs:
+            if self.jobs_tree.exists(str(job.id)):
+                self.jobs_tree.set(str(job.id), 'Status', job.status)
+
+    def on_concurrency_changed(self):
+        try:
+            self.job_queue.max_concurrency = max(1, int(self.concurrency_var.get()))
+        except (ValueError, tk.TclError):
+            pass
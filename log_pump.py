@@ -0,0 +1,42 @@
+import queue
+import tkinter as tk
+
+class LogPump:
+    '''
+    Thread-safe logger for a Tk Text widget.
+    log() can be called from any thread; the messages are queued and flushed to the widget
+    in one batch every interval_ms by the Tk thread. Only the last max_lines lines are kept.
+    '''
+    def __init__(self, text_widget, interval_ms=100, max_lines=5000):
+        self.text_widget = text_widget
+        self.interval_ms = interval_ms
+        self.max_lines = max_lines
+        self.messages = queue.Queue()
+
+    def log(self, message):
+        self.messages.put(message)
+
+    def start(self):
+        self.text_widget.after(self.interval_ms, self.flush)
+
+    def flush(self):
+        lines = []
+        while True:
+            try:
+                lines.append(self.messages.get_nowait())
+            except queue.Empty:
+                break
+
+        if lines:
+            # keep only what can end up in the scrollback
+            lines = lines[-self.max_lines:]
+            self.text_widget.insert(tk.END, '\n'.join(lines) + '\n')
+
+            # trim the scrollback (the Text widget always ends with an empty line)
+            num_lines = int(self.text_widget.index('end-1c').split('.')[0]) - 1
+            if num_lines > self.max_lines:
+                self.text_widget.delete('1.0', f'{num_lines - self.max_lines + 1}.0')
+
+            self.text_widget.see(tk.END)
+
+        self.text_widget.after(self.interval_ms, self.flush)
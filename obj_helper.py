@@ -1,78 +1,182 @@
 import json
 import re
+from functools import lru_cache
 
+# characters not allowed in result keys (series ids on the server, csv columns, database keys)
+INVALID_KEY_CHARS = re.compile(r'[^a-zA-Z0-9_]')
+
+# how flatten handles lists and numpy arrays:
+#   'skip'    leaves them out (the behavior of the traverse_and_collect functions)
+#   'index'   one item per element, key_0, key_1, ...; lists longer than max_list_items are summarized
+#   'summary' key_count, key_mean, key_min and key_max of lists of numbers; other lists are indexed
+LIST_MODES = ['skip', 'index', 'summary']
+DEFAULT_MAX_LIST_ITEMS = 32
+
+@lru_cache(maxsize=4096)
 def python_compatible_key(key):
     # Replace non-alphanumeric characters and spaces with underscores
-    return re.sub(r'[^a-zA-Z0-9_]', '_', key)
+    return INVALID_KEY_CHARS.sub('_', key)
+
+def is_number(value):
+    # bool is an int, numbers include the pass/fail flags as before
+    return isinstance(value, (int, float))
+
+def summarize(values, key, result):
+    # count, mean, min and max of a list of numbers
+    numbers = [value for value in values if is_number(value)]
+    result.append({'key': f'{key}_count', 'value': len(values)})
+    if numbers:
+        result.append({'key': f'{key}_mean', 'value': sum(numbers) / len(numbers)})
+        result.append({'key': f'{key}_min', 'value': min(numbers)})
+        result.append({'key': f'{key}_max', 'value': max(numbers)})
+
+def flatten(obj, numbers=True, strings=True, list_mode='skip', max_list_items=DEFAULT_MAX_LIST_ITEMS, parent_key=''):
+    '''
+    Numbers and strings of a nested result (e.g. result.json) in one pass: [{'key', 'value'}] sorted by key,
+    the keys being the path joined by '_' (see python_compatible_key).
+    Lists and numpy arrays, including the base64 arrays of result_serializer, are handled according to list_mode.
+    '''
+    result = []
+
+    def add_list(values, key):
+        if list_mode == 'summary' and all(is_number(value) for value in values):
+            summarize(values, key, result)
+        elif len(values) > max_list_items:
+            summarize(values, key, result)
+        else:
+            for i, value in enumerate(values):
+                add(value, f'{key}_{i}')
+
+    def add(value, key):
+        if isinstance(value, str):
+            if strings:
+                result.append({'key': key, 'value': value})
+        elif is_number(value):
+            if numbers:
+                result.append({'key': key, 'value': value})
+        elif isinstance(value, dict):
+            if '__ndarray__' in value:
+                # an array encoded by result_serializer
+                if list_mode != 'skip' and numbers:
+                    import result_serializer
+                    add_list(result_serializer.decode_array(value).ravel().tolist(), key)
+                return
+            for child_key, child in value.items():
+                child_key = python_compatible_key(str(child_key))
+                add(child, f'{key}_{child_key}' if key else child_key)
+        elif list_mode == 'skip':
+            return
+        elif isinstance(value, (list, tuple)):
+            add_list(value, key)
+        elif hasattr(value, 'tolist') and hasattr(value, 'ndim'):
+            # numpy arrays and scalars
+            value = value.tolist()
+            if isinstance(value, list):
+                add_list(value, key)
+            else:
+                add(value, key)
+
+    add(obj, python_compatible_key(parent_key))
+    result.sort(key=lambda item: item['key'])
+    return result
+
+def split_numbers_strings(items):
+    # the numbers and the strings of flattened items, each still sorted by key
+    numbers = [item for item in items if not isinstance(item['value'], str)]
+    strings = [item for item in items if isinstance(item['value'], str)]
+    return numbers, strings
+
+def get_options(config):
+    # 'result_flatten' settings of the app config: {"list_mode": "skip" | "index" | "summary", "max_list_items": 32}
+    settings = config.get('result_flatten', {})
+    list_mode = settings.get('list_mode', 'skip')
+    if list_mode not in LIST_MODES:
+        raise Exception(f'Unknown list mode: {list_mode}. Use one of {LIST_MODES}')
+    return {
+        'list_mode': list_mode,
+        'max_list_items': settings.get('max_list_items', DEFAULT_MAX_LIST_ITEMS),
+    }
 
-def traverse_and_collect_numbers(obj, parent_key='', result=None):
+def collect(items, result):
+    # the traverse_and_collect functions append to the given list and return all its items sorted
     if result is None:
-        result = []
+        return items
+    result.extend(items)
+    return sorted(result, key=lambda x: x['key'])
 
-    for key, value in obj.items():
-        full_key = f"{parent_key}_{key}" if parent_key else key
-        full_key = python_compatible_key(full_key)
-
-        if isinstance(value, (int, float)):  # Check if the value is a number
-            result.append({'key': full_key, 'value': value})
-        elif isinstance(value, dict):  # Recursively traverse dictionaries
-            traverse_and_collect_numbers(value, full_key, result)
-
-    return  sorted(result, key=lambda x: x['key'])
+def traverse_and_collect_numbers(obj, parent_key='', result=None):
+    return collect(flatten(obj, strings=False, parent_key=parent_key), result)
 
 def traverse_and_collect_strings(obj, parent_key='', result=None):
-    if result is None:
-        result = []
-
-    for key, value in obj.items():
-        full_key = f"{parent_key}_{key}" if parent_key else key
-        full_key = python_compatible_key(full_key)
-
-        if isinstance(value, str):  # Check if the value is a string
-            result.append({'key': full_key, 'value': value})
-        elif isinstance(value, dict):  # Recursively traverse dictionaries
-            traverse_and_collect_strings(value, full_key, result)
-
-    return  sorted(result, key=lambda x: x['key'])
+    return collect(flatten(obj, numbers=False, parent_key=parent_key), result)
 
 def traverse_and_collect_numbers_strings(obj, parent_key='', result=None):
+    return collect(flatten(obj, parent_key=parent_key), result)
+
+# the previous implementation, kept for the benchmark below
+def legacy_traverse(obj, types, parent_key='', result=None):
     if result is None:
         result = []
 
     for key, value in obj.items():
         full_key = f"{parent_key}_{key}" if parent_key else key
-        full_key = python_compatible_key(full_key)
+        full_key = re.sub(r'[^a-zA-Z0-9_]', '_', full_key)
 
-        if isinstance(value, (int, float, str)):  # Check if the value is a number
+        if isinstance(value, types):
             result.append({'key': full_key, 'value': value})
-        elif isinstance(value, dict):  # Recursively traverse dictionaries
-            traverse_and_collect_numbers_strings(value, full_key, result)
+        elif isinstance(value, dict):
+            legacy_traverse(value, types, full_key, result)
 
     return  sorted(result, key=lambda x: x['key'])
 
-
 if __name__ == '__main__':
-    # Example usage with a result.json object
-    result_json = {
-        "measurement": {
-            "temperature": 25.4,
-            "pressure": 101.3,
-            "details": {
-                "humidity": 60,
-                "altitude": 300.2,
-                "location_name": "Room A",
-                "complex_data": {
-                    "value-1": 42.0,
-                    "value 2": 19.5,
-                    "Value!": 37
-                }
-            }
-        }
-    }
-
-    # Traverse the result.json and collect the key-value pairs
-    key_value_pairs = traverse_and_collect(result_json)
-
-    # Print the result
-    for pair in key_value_pairs:
-        print(pair)
+    # Benchmark: python obj_helper.py [result.json ...] (a synthetic CatPhan-like result if no file is given)
+    import sys
+    import time
+    import random
+
+    if len(sys.argv) > 1:
+        results = []
+        for file in sys.argv[1:]:
+            with open(file, 'r') as json_file:
+                results.append(json.load(json_file))
+    else:
+        random.seed(0)
+        roi = lambda name: {'name': name, 'value': random.gauss(0, 10), 'stdev': random.random(), 'difference': random.random(),
+                            'nominal_value': 0, 'passed': True}
+        results = [{
+            'catphan_model': 'CatPhan604', 'catphan_roll_deg': 0.1, 'origin_slice': 40, 'num_images': 80,
+            'ctp404': {'hu_linearity_passed': True, 'hu_tolerance': 40, 'low_contrast_visibility': 3.1,
+                       'line_distances_mm': [random.gauss(50, 0.1) for _ in range(4)],
+                       'hu_rois': {name: roi(name) for name in ['Air', 'PMP', 'LDPE', 'Poly', 'Acrylic', 'Delrin', 'Teflon', 'Bone 20%', 'Bone 50%']}},
+            'ctp486': {'uniformity_index': 1.2, 'integral_non_uniformity': 0.01, 'passed': True,
+                       'rois': {name: roi(name) for name in ['Top', 'Right', 'Bottom', 'Left', 'Center']}},
+            'ctp528': {'mtf_lp_mm': {str(p): random.random() for p in range(10, 100, 10)},
+                       'profile': [random.random() for _ in range(500)]},
+            'ctp515': {'num_rois_seen': 6, 'roi_results': {f'{size}': roi(f'{size}') for size in [2, 3, 4, 5, 6, 7, 8, 9, 15]}},
+            'device_id': 'SBUH|TrueBeam', 'performed_by': 'me', 'performed_on': '2024-01-01', 'notes': 'notes',
+        } for _ in range(20)]
+
+    def measure(function, repeat=50):
+        start_time = time.perf_counter()
+        for _ in range(repeat):
+            for result_data in results:
+                output = function(result_data)
+        return (time.perf_counter() - start_time) / repeat / len(results) * 1000, output
+
+    print(f'{len(results)} results')
+    print(f'{"method":<52}{"ms/result":>12}{"items":>8}')
+    for name, function in [
+            ('previous: numbers, then strings (2 walks)', lambda obj: legacy_traverse(obj, (int, float)) + legacy_traverse(obj, str)),
+            ('flatten: numbers and strings (1 walk)', lambda obj: split_numbers_strings(flatten(obj))),
+            ('flatten, lists indexed (max 32 items)', lambda obj: split_numbers_strings(flatten(obj, list_mode='index'))),
+            ('flatten, lists summarized', lambda obj: split_numbers_strings(flatten(obj, list_mode='summary')))]:
+        ms, output = measure(function)
+        count = len(output) if isinstance(output, list) else sum(len(part) for part in output)
+        print(f'{name:<52}{ms:>12.3f}{count:>8}')
+
+    # the wrappers return what the previous implementation did
+    for result_data in results:
+        assert traverse_and_collect_numbers(result_data) == legacy_traverse(result_data, (int, float))
+        assert traverse_and_collect_strings(result_data) == legacy_traverse(result_data, str)
+        assert traverse_and_collect_numbers_strings(result_data) == legacy_traverse(result_data, (int, float, str))
@@ -0,0 +1,175 @@
+import os
+import sys
+import csv
+import json
+import argparse
+import multiprocessing
+
+from util import log, read_json_file
+import dicom_helper
+import batch_helper
+import results_db
+from batch_helper import DONE, PENDING
+import phantoms.artifacts
+
+def get_app_dir():
+    return os.path.dirname(os.path.abspath(__file__))
+
+def read_job_list(job_file):
+    # CSV with a header, or a JSON list of objects; columns device_id ('SITE|DEVICE'), phantom, input_file
+    if job_file.lower().endswith('.json'):
+        with open(job_file, 'r') as file:
+            rows = json.load(file)
+    else:
+        with open(job_file, 'r', newline='') as file:
+            rows = list(csv.DictReader(file))
+    return [(row['device_id'].strip(), row['phantom'].strip(), row['input_file'].strip()) for row in rows]
+
+def load_phantom_config(device_id, phantom, config_dir):
+    # config.<site>.<device>.<phantom>.json, as in the GUI
+    site, device = device_id.split('|', 1)
+    config_file = os.path.join(config_dir, f'config.{site.lower()}.{device.lower()}.{phantom.lower()}.json')
+    if not os.path.exists(config_file):
+        raise Exception(f'Phantom config file not found. {config_file}')
+    return read_json_file(config_file)
+
+def get_phantom_dim(phantom, config_dir):
+    app_config = read_json_file(os.path.join(config_dir, 'config.json'))
+    for item in app_config.get('phantoms', []):
+        if item['id'].lower() == phantom.lower():
+            return item['dim']
+    raise Exception(f'Unknown phantom: {phantom}')
+
+def get_image_datetime_str(input_file):
+    # 'yyyyMMdd_HHmmss' of the study, the case folder name used by the GUI; the file name if it is not readable
+    try:
+        return dicom_helper.get_study_datetime_str(input_file)
+    except Exception:
+        return os.path.splitext(os.path.basename(input_file))[0]
+
+def get_performed_date(datetime_str):
+    # 'yyyyMMdd_HHmmss' -> 'YYYY-MM-DD'
+    date = datetime_str.split('_')[0]
+    if len(date) != 8 or not date.isdigit():
+        return ''
+    return f'{date[0:4]}-{date[4:6]}-{date[6:8]}'
+
+def get_cases(jobs, output_root):
+    '''
+    One case per (device_id, phantom, input_file), in <output_root>/<site>_<device>_<phantom>/<study datetime> as in the GUI.
+    Returns {case_id: {'device_id', 'phantom', 'input_file', 'datetime', 'case_folder'}}.
+    '''
+    cases = {}
+    for device_id, phantom, input_file in jobs:
+        site, device = device_id.split('|', 1)
+        phantom_dir = f'{site.lower()}_{device.lower()}_{phantom.lower()}'
+        datetime_str = get_image_datetime_str(input_file)
+        case_id = f'{phantom_dir}/{datetime_str}'
+        # images of the same study
+        n = 2
+        while case_id in cases:
+            case_id = f'{phantom_dir}/{datetime_str}_{n}'
+            n += 1
+        cases[case_id] = {
+            'device_id': device_id,
+            'phantom': phantom,
+            'input_file': os.path.abspath(input_file),
+            'datetime': datetime_str,
+            'case_folder': os.path.join(output_root, *case_id.split('/')),
+        }
+    return cases
+
+def run_batch(jobs, output_root, config_dir=None, performed_by='', workers=None, output_profile=None, log_message=print):
+    '''
+    Analyzes (device_id, phantom, input_file) 2D phantom images on a process pool that imports pylinac once per worker.
+    Each image gets its case folder with the usual outputs. The batch manifest makes the batch resumable;
+    summary.json lists every case and summary_<phantom>.csv has one row of results per image.
+    '''
+    config_dir = config_dir or get_app_dir()
+    if not os.path.exists(output_root):
+        os.makedirs(output_root)
+    workers = workers or os.cpu_count() or 1
+
+    # one config per device and phantom; the images run in parallel, so each renders serially and never opens its PDF
+    configs = {}
+    for device_id, phantom, input_file in jobs:
+        if (device_id, phantom) in configs:
+            continue
+        if get_phantom_dim(phantom, config_dir) != 2:
+            raise Exception(f'{phantom} is not a 2D phantom')
+        config = load_phantom_config(device_id, phantom, config_dir)
+        config['render_workers'] = 1
+        config['publish_pdf_params'] = dict(config['publish_pdf_params'], open_file=False)
+        # a deferred.pkl per case would double the writes the output profiles save
+        config['defer_outputs'] = False
+        results_db.set_results_db_folder(config, output_root)
+        if output_profile:
+            config['output_profile'] = output_profile
+        configs[(device_id, phantom)] = config
+
+    cases = get_cases(jobs, output_root)
+
+    manifest = batch_helper.load_batch_manifest(output_root)
+    for case_id, case in cases.items():
+        entry = manifest['cases'].setdefault(case_id, {'status': PENDING, 'error': None, 'seconds': None})
+        entry.update(case)
+    batch_helper.save_batch_manifest(output_root, manifest)
+
+    todo = [case_id for case_id in cases if manifest['cases'][case_id]['status'] != DONE]
+    log_message(f'{len(cases)} images, {len(cases) - len(todo)} already done, {len(todo)} to analyze on {workers} processes')
+
+    tasks = {}
+    for case_id in todo:
+        case = cases[case_id]
+        if not os.path.exists(case['case_folder']):
+            os.makedirs(case['case_folder'])
+        config = configs[(case['device_id'], case['phantom'])]
+        metadata = dict(config['publish_pdf_params'].get('metadata', {}))
+        metadata['Performed By'] = performed_by
+        metadata['Performed Date'] = get_performed_date(case['datetime'])
+        tasks[case_id] = {
+            'case_folder': case['case_folder'],
+            'phantom': case['phantom'],
+            'run_analysis_args': {
+                'device_id': case['device_id'],
+                'input_file': case['input_file'],
+                'output_dir': case['case_folder'],
+                'config': config,
+                'notes': config['publish_pdf_params'].get('notes', ''),
+                'metadata': metadata,
+            },
+        }
+    phantom_names = sorted(set(case['phantom'].lower() for case in cases.values()))
+    batch_helper.run_cases(tasks, manifest, output_root, workers, phantom_names, log_message)
+
+    entries = batch_helper.get_case_entries(manifest, list(cases))
+    batch_helper.write_summary_json(output_root, entries, log_message)
+    # the results of each phantom have their own columns
+    for phantom in phantom_names:
+        phantom_entries = [entry for entry in entries if entry['phantom'].lower() == phantom]
+        batch_helper.write_summary_csv(os.path.join(output_root, f'summary_{phantom}.csv'), phantom_entries,
+                                       ['case_id', 'status', 'error', 'seconds', 'device_id', 'input_file'], log_message)
+    batch_helper.log_batch_completed(entries, log_message)
+    return manifest
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch analysis of 2D phantom images")
+    parser.add_argument("-j", "--job_file", required=True, help="CSV (with a header) or JSON list of the images: device_id (SITE|DEVICE), phantom, input_file")
+    parser.add_argument("-o", "--output_folder", required=True, help="The folder of the case folders, the batch manifest and the summaries")
+    parser.add_argument("--config_dir", help="Folder of config.json and the phantom config files (default: the folder of this script)")
+    parser.add_argument("--performed_by", default='', help="'Performed By' saved in the results")
+    parser.add_argument("-p", "--output_profile", choices=list(phantoms.artifacts.OUTPUT_PROFILES), help="Outputs to produce (default: the output_profile of each phantom config)")
+    parser.add_argument("-w", "--workers", type=int, help="Number of images analyzed in parallel (default: number of CPUs)")
+    args = parser.parse_args()
+
+    jobs = read_job_list(args.job_file)
+    run_batch(jobs, args.output_folder, config_dir=args.config_dir, performed_by=args.performed_by,
+              workers=args.workers, output_profile=args.output_profile, log_message=log)
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    try:
+        main()
+    except Exception as e:
+        log(f'Error: {e}')
+        sys.exit(1)
@@ -0,0 +1,258 @@
+import os
+import sys
+import pickle
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import phantoms.helper
+
+#* ``hu`` draws the HU linearity image.
+#* ``un`` draws the HU uniformity image.
+#* ``sp`` draws the Spatial Resolution image.
+#* ``lc`` draws the Low Contrast image (if applicable).
+#* ``mtf`` draws the RMTF plot.
+#* ``lin`` draws the HU linearity values. Used with ``delta``.
+#* ``prof`` draws the HU uniformity profiles.
+#* ``side`` draws the side view of the phantom with lines of the module locations.
+CATPHAN_SUBIMAGES = ['hu', 'un', 'sp', 'lc', 'mtf', 'lin', 'prof', 'side']
+
+# outputs of an analysis, by profile (config 'output_profile'); the json is always written
+# 'record' adds the result to the results database (and to results.csv if 'results_csv' is set in the config)
+OUTPUT_PROFILES = {
+    'minimal': ['json', 'record'],
+    'standard': ['image', 'txt', 'json', 'record'],
+    'full': ['image', 'pdf', 'txt', 'json', 'record'],
+}
+DEFAULT_OUTPUT_PROFILE = 'full'
+
+# the analyzed phantom and the arguments needed to produce the skipped outputs later,
+# written only if 'defer_outputs' is set in the config: the pickle holds the image volume and does not survive pylinac upgrades
+DEFERRED_FILE = 'deferred.pkl'
+
+# artifact names: 'image', 'subimage.<sub>' and 'pdf'
+def get_subimage_artifacts(sub_image_list):
+    return [f'subimage.{sub}' for sub in sub_image_list]
+
+def render_artifact(phantom, name, output_dir, config, notes, metadata, log_message):
+    # Render one artifact of an analyzed phantom; the files are the same whichever process renders them
+    if name == 'image':
+        file = os.path.join(output_dir, 'analyzed_image.png')
+        log_message(f'saving image: {file}')
+        phantom.save_analyzed_image(filename=file)
+
+    elif name.startswith('subimage.'):
+        sub = name.split('.', 1)[1]
+        dst = os.path.join(output_dir, f'analyzed_subimage.{sub}.png')
+        log_message(f'saving sub image: {dst}')
+        try:
+            phantom.save_analyzed_subimage(filename=dst, subimage=sub)
+        except Exception:
+            # not every subimage applies to every phantom (e.g. lc)
+            log_message(f'sub image not available: {sub}')
+
+    elif name == 'pdf':
+        phantoms.helper.copy_logo(config=config, output_dir=output_dir, log_message=log_message)
+        phantoms.helper.save_result_as_pdf(phantom=phantom, output_dir=output_dir, config=config, notes=notes, metadata=metadata, log_message=log_message)
+
+    else:
+        raise Exception(f'Unknown artifact: {name}')
+
+# the analyzed phantom, unpickled once per worker process
+worker_phantom = None
+
+def init_worker(phantom_bytes):
+    global worker_phantom
+    import matplotlib
+    matplotlib.use('Agg')
+    worker_phantom = pickle.loads(phantom_bytes)
+
+def render_in_worker(name, output_dir, config, notes, metadata):
+    # Returns the log lines, which are forwarded by the parent process
+    log_lines = []
+    render_artifact(worker_phantom, name, output_dir, config, notes, metadata, log_lines.append)
+    return log_lines
+
+def render_artifacts(phantom, names, output_dir, config, notes, metadata, log_message, workers=1):
+    '''
+    Renders the artifacts of an analyzed phantom.
+    With workers > 1 they are rendered concurrently in worker processes (Agg backend),
+    each worker unpickling the phantom once. Falls back to serial rendering if the phantom cannot be pickled.
+    '''
+    workers = min(workers, len(names))
+    if workers > 1:
+        try:
+            phantom_bytes = pickle.dumps(phantom, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            log_message(f'phantom cannot be sent to worker processes ({e}), rendering serially...')
+            workers = 1
+
+    if workers <= 1:
+        for name in names:
+            render_artifact(phantom, name, output_dir, config, notes, metadata, log_message)
+        return
+
+    log_message(f'rendering {len(names)} artifacts on {workers} processes...')
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker,
+                             initargs=(phantom_bytes,)) as executor:
+        futures = {executor.submit(render_in_worker, name, output_dir, config, notes, metadata): name for name in names}
+        errors = []
+        for future in as_completed(futures):
+            try:
+                for line in future.result():
+                    log_message(line)
+            except Exception as e:
+                errors.append(f'{futures[future]}: {e}')
+
+    if errors:
+        raise Exception('Failed rendering ' + ', '.join(errors))
+
+def get_output_kinds(config, profile=None):
+    # profile overrides the one in the config (e.g. from the command line)
+    if not profile:
+        profile = config.get('output_profile', DEFAULT_OUTPUT_PROFILE)
+    if profile not in OUTPUT_PROFILES:
+        raise Exception(f'Unknown output profile: {profile} (expected one of {", ".join(OUTPUT_PROFILES)})')
+    return OUTPUT_PROFILES[profile]
+
+def get_deferred_kinds(config, kinds):
+    # the outputs skipped by the profile that are deferred, none unless 'defer_outputs' is set in the config
+    if not config.get('defer_outputs', False):
+        return []
+    return [kind for kind in OUTPUT_PROFILES['full'] if kind not in kinds]
+
+def get_artifact_names(kinds, subimages):
+    names = []
+    if 'image' in kinds:
+        names += ['image'] + get_subimage_artifacts(subimages)
+    if 'pdf' in kinds:
+        names.append('pdf')
+    return names
+
+def save_output(phantom, kind, output_dir, device_id, config, notes, metadata, log_message, phantom_name=''):
+    # the text outputs; the images and PDF go through render_artifacts
+    if kind == 'txt':
+        phantoms.helper.save_result_as_txt(phantom=phantom, output_dir=output_dir, log_message=log_message)
+    elif kind == 'json':
+        phantoms.helper.save_result_as_json(phantom=phantom, output_dir=output_dir, device_id=device_id, notes=notes, config=config, metadata=metadata, log_message=log_message)
+    elif kind == 'record':
+        phantoms.helper.record_result(phantom_name=phantom_name, output_dir=output_dir, device_id=device_id, notes=notes, config=config, metadata=metadata, log_message=log_message)
+    else:
+        raise Exception(f'Unknown output: {kind}')
+
+def save_outputs(phantom, kinds, output_dir, device_id, config, notes, metadata, timer, log_message, subimages=[], phantom_name=''):
+    '''
+    Writes the outputs of an analyzed phantom listed in kinds, one timer stage each.
+    With render_workers > 1 in the config, the images and PDF are rendered concurrently in a single 'artifacts' stage.
+    '''
+    workers = config.get('render_workers', 1)
+    names = get_artifact_names(kinds, subimages)
+    if workers > 1 and len(names) > 1:
+        with timer.stage('artifacts'):
+            render_artifacts(phantom=phantom, names=names, output_dir=output_dir, config=config, notes=notes, metadata=metadata, log_message=log_message, workers=workers)
+    else:
+        for kind in ['image', 'pdf']:
+            if kind in kinds:
+                with timer.stage(kind):
+                    render_artifacts(phantom=phantom, names=get_artifact_names([kind], subimages), output_dir=output_dir, config=config, notes=notes, metadata=metadata, log_message=log_message)
+
+    # record after json, it is read back from result.json
+    for kind in ['txt', 'json', 'record']:
+        if kind in kinds:
+            with timer.stage(kind):
+                save_output(phantom, kind, output_dir, device_id, config, notes, metadata, log_message, phantom_name=phantom_name)
+
+def save_analysis_outputs(phantom, output_dir, device_id, config, notes, metadata, timer, log_message, subimages=[], profile=None, phantom_name=''):
+    '''
+    Writes the outputs selected by the output profile. With 'defer_outputs' in the config, the others are deferred:
+    the analyzed phantom is pickled to deferred.pkl so they can be produced later with render_deferred.
+    '''
+    kinds = get_output_kinds(config, profile)
+    save_outputs(phantom=phantom, kinds=kinds, output_dir=output_dir, device_id=device_id, config=config, notes=notes, metadata=metadata,
+                 timer=timer, log_message=log_message, subimages=subimages, phantom_name=phantom_name)
+
+    skipped = get_deferred_kinds(config, kinds)
+    if skipped:
+        with timer.stage('deferred'):
+            save_deferred(phantom=phantom, skipped=skipped, output_dir=output_dir, device_id=device_id, config=config, notes=notes, metadata=metadata,
+                          log_message=log_message, subimages=subimages, phantom_name=phantom_name)
+
+def save_deferred(phantom, skipped, output_dir, device_id, config, notes, metadata, log_message, subimages=[], phantom_name=''):
+    deferred_file = os.path.join(output_dir, DEFERRED_FILE)
+    state = {
+        'phantom': phantom,
+        'skipped': skipped,
+        'device_id': device_id,
+        'config': config,
+        'notes': notes,
+        'metadata': metadata,
+        'subimages': subimages,
+        'phantom_name': phantom_name,
+    }
+    log_message(f'Deferring {", ".join(skipped)}: {deferred_file}')
+    try:
+        with open(deferred_file, 'wb') as file:
+            pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        # e.g. a phantom that cannot be pickled; the skipped outputs need a new analysis
+        log_message(f'Could not save the analyzed phantom ({e}), {", ".join(skipped)} cannot be produced later.')
+        if os.path.exists(deferred_file):
+            os.remove(deferred_file)
+
+def load_deferred(output_dir):
+    deferred_file = os.path.join(output_dir, DEFERRED_FILE)
+    if not os.path.exists(deferred_file):
+        raise Exception(f'No deferred outputs in {output_dir}')
+    with open(deferred_file, 'rb') as file:
+        state = pickle.load(file)
+    # deferred before the results database: 'csv' was the results.csv line
+    state['skipped'] = ['record' if kind == 'csv' else kind for kind in state['skipped']]
+    state.setdefault('phantom_name', '')
+    return state
+
+def render_deferred(output_dir, kinds=None, log_message=print, workers=None):
+    '''
+    Produces outputs skipped by the output profile from deferred.pkl, without rerunning the analysis.
+    kinds defaults to all the skipped outputs; deferred.pkl is removed once none is left.
+    '''
+    state = load_deferred(output_dir)
+    if kinds is None:
+        kinds = state['skipped']
+    config = dict(state['config'])
+    if workers is not None:
+        config['render_workers'] = workers
+
+    from phantoms.timing import StageTimer
+    timer = StageTimer()
+    save_outputs(phantom=state['phantom'], kinds=kinds, output_dir=output_dir, device_id=state['device_id'], config=config,
+                 notes=state['notes'], metadata=state['metadata'], timer=timer, log_message=log_message, subimages=state['subimages'],
+                 phantom_name=state['phantom_name'])
+    log_message('Timings:\n' + timer.get_summary())
+
+    state['skipped'] = [kind for kind in state['skipped'] if kind not in kinds]
+    deferred_file = os.path.join(output_dir, DEFERRED_FILE)
+    if state['skipped']:
+        with open(deferred_file, 'wb') as file:
+            pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+    else:
+        log_message(f'All deferred outputs produced, removing {deferred_file}')
+        os.remove(deferred_file)
+
+if __name__ == '__main__':
+    # python -m phantoms.artifacts <output_dir> [--outputs pdf image] [--workers 4]
+    parser = argparse.ArgumentParser(description="Produce the outputs skipped by the output profile of an analysis")
+    parser.add_argument("output_dir", help="The output folder of the analysis (with deferred.pkl)")
+    parser.add_argument("--outputs", nargs='+', choices=OUTPUT_PROFILES['full'], help="The outputs to produce. All the skipped outputs if not given.")
+    parser.add_argument("--workers", type=int, help="Number of processes rendering the images and PDF")
+    args = parser.parse_args()
+
+    import matplotlib
+    matplotlib.use('Agg')
+
+    try:
+        render_deferred(args.output_dir, kinds=args.outputs, workers=args.workers)
+    except Exception as e:
+        print(f'Error: {e}')
+        sys.exit(1)
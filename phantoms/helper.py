@@ -2,8 +2,9 @@ import os
 import shutil
 import util 
 import json
-from util import obj_serializer
 import obj_helper
+import result_serializer
+import results_db
 
 def copy_logo(config, output_dir, log_message):
     # copy logo file
@@ -11,7 +12,7 @@ def copy_logo(config, output_dir, log_message):
     if not os.path.exists(logo_file):
         # check the current folder
         cwd = util.get_cwd()
-        log_file = os.path.join(cwd, log_file)
+        logo_file = os.path.join(cwd, os.path.basename(logo_file))
 
     if os.path.exists(logo_file):
         log_filename = os.path.basename(logo_file)
@@ -43,20 +44,25 @@ def save_result_as_txt(phantom, output_dir, log_message):
     with open(result_txt, 'w') as file:
         file.write(phantom.results())
 
-def save_result_as_json(phantom, output_dir, device_id, notes, config, metadata, log_message ):
-    result = phantom.results_data()
-    result_json = os.path.join(output_dir, 'result.json')
-
-    result_dict = json.loads(json.dumps(vars(result), default=obj_serializer))
+def set_run_fields(result_dict, device_id, notes, config, metadata):
+    # the fields of result.json that belong to this run rather than to the analysis
     result_dict['device_id'] = device_id
     result_dict['performed_by'] = metadata['Performed By']
     result_dict['performed_on'] = metadata['Performed Date']
-    result_dict['notes'] =notes 
+    result_dict['notes'] = notes
     result_dict['config'] = config
 
+def save_result_as_json(phantom, output_dir, device_id, notes, config, metadata, log_message ):
+    result = phantom.results_data()
+    result_json = os.path.join(output_dir, 'result.json')
+
+    # the result objects are serialized while writing, in one pass
+    result_dict = dict(vars(result))
+    set_run_fields(result_dict, device_id=device_id, notes=notes, config=config, metadata=metadata)
+
     log_message(f'Saving result JSON: {result_json}')
     with open(result_json, 'w') as json_file:
-        json.dump(result_dict, json_file, indent=4)
+        result_serializer.dump(result_dict, json_file, **result_serializer.get_options(config))
 
 def write_line(file, line):
     with open(file, 'w') as file:
@@ -98,7 +104,33 @@ def append_result_to_phantom_csv(phantom, output_dir, device_id, notes, metadata
 
     if not os.path.exists(csv_file):
         log_message('csv file not found. creating and adding the header...')
-        write_line(csv_file, header)
+        try:
+            # exclusive create: concurrent jobs must not truncate each other's lines
+            with open(csv_file, 'x') as file:
+                file.write(f'{header}\n')
+        except FileExistsError:
+            pass
     
     log_message('appending a result line to csv file')
     append_line(file=csv_file, line=line)
+
+def record_result(phantom_name, output_dir, device_id, notes, config, metadata, log_message):
+    # Adds result.json to the results database ('results_db' settings), and to results.csv if 'results_csv' is set
+    result_json = os.path.join(output_dir, 'result.json')
+    if not os.path.exists(result_json):
+        raise Exception("The result.json file does not exist. Run the analysis first.")
+    with open(result_json, 'r') as json_file:
+        result_data = json.load(json_file)
+
+    db_file = results_db.get_results_db_file(config, output_dir)
+    log_message(f'Adding the result to the results database: {db_file}')
+    db = results_db.open_results_db(config, output_dir)
+    if config.get('results_db', {}).get('wal', True) and not db.wal:
+        log_message('The results database is on a network share, WAL journal not used.')
+    try:
+        db.add_result(result_data, phantom=phantom_name, output_dir=output_dir)
+    finally:
+        db.close()
+
+    if config.get('results_csv', False):
+        append_result_to_phantom_csv(phantom=None, output_dir=output_dir, device_id=device_id, notes=notes, metadata=metadata, log_message=log_message)
@@ -7,6 +7,9 @@ from util import obj_serializer
 import util
 import webservice_helper
 import phantoms.helper
+import phantoms.artifacts
+import phantoms.result_cache
+from phantoms.timing import StageTimer
 
 def run_analysis(device_id, input_file, output_dir, config, notes, metadata, log_message):
 
@@ -26,42 +29,48 @@ def run_analysis(device_id, input_file, output_dir, config, notes, metadata, log
 
     # Catphan analysis logic
     log_message('Running analysis...')
-    phantom = LeedsTOR(input_file)
+    timer = StageTimer()
+
+    # a previous analysis of the same images with the same parameters
+    result_cache, cache_key, cached = phantoms.result_cache.lookup('leedstor', input_file, output_dir, device_id, config, notes, metadata, timer, log_message)
+    if cached:
+        timer.save(output_dir, log_message)
+        log_message('Analysis completed (cached result).')
+        return
+
+    with timer.stage('load'):
+        phantom = LeedsTOR(input_file)
     params = config['analysis_params']
     
-    phantom.analyze(low_contrast_threshold=params['low_contrast_threshold'],
-                high_contrast_threshold=params['high_contrast_threshold'],
-                #invert=False,
-                #angle_override=False,
-                #center_override=False,
-                #size_override=False,
-                ssd=params['ssd'],
-                low_contrast_method=params['low_contrast_method'],
-                visibility_threshold=params['visibility_threshold'],
-                #x_adjustment=params['x_adjustment'],
-                #y_adjustment=params['y_adjustment'],
-                #angle_adjustment=params['angle_adjustment'],
-                #roi_size_factor=params['roi_size_factor'],
-                #scaling_factor=params['scaling_factor']
-    )
+    with timer.stage('analyze'):
+        phantom.analyze(low_contrast_threshold=params['low_contrast_threshold'],
+                    high_contrast_threshold=params['high_contrast_threshold'],
+                    #invert=False,
+                    #angle_override=False,
+                    #center_override=False,
+                    #size_override=False,
+                    ssd=params['ssd'],
+                    low_contrast_method=params['low_contrast_method'],
+                    visibility_threshold=params['visibility_threshold'],
+                    #x_adjustment=params['x_adjustment'],
+                    #y_adjustment=params['y_adjustment'],
+                    #angle_adjustment=params['angle_adjustment'],
+                    #roi_size_factor=params['roi_size_factor'],
+                    #scaling_factor=params['scaling_factor']
+        )
 
     # print results
     log_message(phantom.results())
 
-    file = os.path.join(output_dir, 'analyzed_image.png')
-    log_message(f'saving image: {file}')
-    phantom.save_analyzed_image(filename=file)
-
-    phantoms.helper.copy_logo(config=config, output_dir=output_dir, log_message=log_message)
-    
-    phantoms.helper.save_result_as_pdf(phantom=phantom, output_dir=output_dir, config=config, notes=notes, metadata=metadata, log_message=log_message)
+    # the outputs selected by the output profile; the others can be produced later from the deferred phantom
+    phantoms.artifacts.save_analysis_outputs(phantom=phantom, output_dir=output_dir, device_id=device_id, config=config, notes=notes, metadata=metadata,
+                                             timer=timer, log_message=log_message, phantom_name='leedstor')
 
-    phantoms.helper.save_result_as_txt(phantom=phantom, output_dir=output_dir, log_message=log_message)
-    
-    phantoms.helper.save_result_as_json(phantom=phantom, output_dir=output_dir, device_id=device_id, notes=notes, config=config, metadata=metadata, log_message=log_message)
-    
-    phantoms.helper.append_result_to_phantom_csv(phantom=phantom, output_dir=output_dir, device_id=device_id, notes=notes, metadata=metadata, log_message=log_message)
+    if result_cache is not None:
+        with timer.stage('cache_store'):
+            result_cache.store(cache_key, phantom, output_dir, config, notes, metadata, log_message)
 
+    timer.save(output_dir, log_message)
 
     log_message('Analysis completed.')
 '''
@@ -0,0 +1,281 @@
+import os
+import json
+import time
+import shutil
+import pickle
+import fnmatch
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+import pydicom
+from pydicom.errors import InvalidDicomError
+
+import phantoms.helper
+import phantoms.artifacts
+
+DEFAULT_FOLDER = 'result_cache'
+DEFAULT_MAX_SIZE_MB = 2048
+
+# files of a cache entry besides the cached outputs
+ENTRY_FILE = 'cache_entry.json'
+PHANTOM_FILE = 'phantom.pkl'
+
+# the outputs of a run that are cached; nothing else of the case folder is (the staged input_* files may be links to the archive)
+CACHED_FILES = ['result.json', 'result.txt', 'result.pdf', 'analyzed_image.png', 'analyzed_subimage.*.png']
+
+def is_cached_file(name):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in CACHED_FILES)
+
+def replace_file(src, dst):
+    # copied next to dst and renamed over it, so a dst that is a link is replaced rather than written through
+    temp_file = f'{dst}.tmp{os.getpid()}'
+    shutil.copyfile(src, temp_file)
+    os.replace(temp_file, dst)
+
+def list_input_files(input_files):
+    # input_files is a file list, a single file (2D phantoms) or a folder (3D phantoms, not recursive)
+    if isinstance(input_files, str):
+        if not os.path.isdir(input_files):
+            return [input_files]
+        return [entry.path for entry in os.scandir(input_files) if entry.is_file()]
+    return list(input_files)
+
+def get_instance_digest(file_path, dicom_only=False):
+    # (SOPInstanceUID, sha256 of the pixel data) of a DICOM file; the header besides the UID does not change the result.
+    # Other files are identified by the hash of their content, or skipped (None) with dicom_only.
+    try:
+        ds = pydicom.dcmread(file_path)
+    except InvalidDicomError:
+        if dicom_only:
+            return None
+        with open(file_path, 'rb') as file:
+            return ('', hashlib.sha256(file.read()).hexdigest())
+
+    pixel_data = ds.PixelData if 'PixelData' in ds else b''
+    return (str(ds.get('SOPInstanceUID', '')), hashlib.sha256(pixel_data).hexdigest())
+
+def canonicalize(value):
+    # 40 and 40.0 are the same parameter; dict keys are sorted by json.dumps
+    if isinstance(value, dict):
+        return {str(key): canonicalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [canonicalize(item) for item in value]
+    if isinstance(value, int) and not isinstance(value, bool):
+        return float(value)
+    return value
+
+def get_pylinac_version():
+    import pylinac
+    return pylinac.__version__
+
+class ResultCache:
+    '''
+    Content-addressed cache of analysis results.
+    An entry is keyed by the input instances (SOPInstanceUIDs and pixel data hashes), the analysis parameters
+    and the pylinac version; it holds the outputs of the run and the pickled analyzed phantom.
+    The least recently used entries are evicted when the cache grows over max_size_mb.
+    '''
+    def __init__(self, folder=DEFAULT_FOLDER, max_size_mb=DEFAULT_MAX_SIZE_MB, hash_workers=4):
+        self.folder = folder
+        self.max_size_mb = max_size_mb
+        self.hash_workers = hash_workers
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+
+    def get_key(self, phantom_name, input_files, config):
+        # an input folder is also the output folder in the GUI: only its DICOM instances are inputs, never the outputs of a previous run
+        dicom_only = isinstance(input_files, str) and os.path.isdir(input_files)
+        files = list_input_files(input_files)
+        with ThreadPoolExecutor(max_workers=self.hash_workers) as executor:
+            digests = sorted(digest for digest in executor.map(lambda file: get_instance_digest(file, dicom_only), files) if digest is not None)
+        if not digests:
+            raise Exception(f'No DICOM instances in {input_files}')
+
+        params = canonicalize({
+            'phantom': phantom_name.lower(),
+            'catphan_model': config.get('catphan_model'),
+            'analysis_params': config.get('analysis_params'),
+            'pylinac': get_pylinac_version(),
+        })
+        key_hash = hashlib.sha256(json.dumps(params, sort_keys=True, separators=(',', ':'), default=str).encode('utf-8'))
+        for uid, pixel_hash in digests:
+            key_hash.update(f'{uid}:{pixel_hash}\n'.encode('utf-8'))
+        return key_hash.hexdigest()
+
+    def get_entry_dir(self, key):
+        return os.path.join(self.folder, key)
+
+    def restore(self, key, output_dir, device_id, config, notes, metadata, timer, log_message, subimages=[], phantom_name=''):
+        '''
+        Writes the cached result of key to output_dir, as the analysis would have with this config, notes and metadata.
+        Outputs missing from the entry, and the PDF when the notes or metadata changed, are rendered from the cached phantom.
+        Returns False on a cache miss.
+        '''
+        entry_dir = self.get_entry_dir(key)
+        entry_file = os.path.join(entry_dir, ENTRY_FILE)
+        if not os.path.exists(entry_file):
+            log_message(f'Result cache miss: {key}')
+            return False
+
+        try:
+            with open(entry_file, 'r') as file:
+                entry = json.load(file)
+
+            kinds = phantoms.artifacts.get_output_kinds(config)
+            pdf_outdated = entry['notes'] != notes or entry['metadata'] != metadata
+            render = [kind for kind in ['image', 'pdf', 'txt'] if kind in kinds and kind not in entry['kinds']]
+            if 'pdf' in kinds and 'pdf' not in render and pdf_outdated:
+                render.append('pdf')
+            skipped = phantoms.artifacts.get_deferred_kinds(config, kinds)
+
+            # the entry is validated before anything is written to output_dir
+            files = entry['files']
+            if 'result.json' not in files or not all(is_cached_file(name) and os.path.isfile(os.path.join(entry_dir, name)) for name in files):
+                log_message(f'Result cache entry {key} is incomplete')
+                return False
+
+            phantom_file = os.path.join(entry_dir, PHANTOM_FILE)
+            if (render or skipped) and not os.path.exists(phantom_file):
+                log_message(f'Result cache entry {key} has no analyzed phantom to produce {", ".join(render + skipped)}')
+                return False
+
+            # the run fields of result.json are those of this run
+            with open(os.path.join(entry_dir, 'result.json'), 'r') as file:
+                result_dict = json.load(file)
+            phantoms.helper.set_run_fields(result_dict, device_id=device_id, notes=notes, config=config, metadata=metadata)
+
+            log_message(f'Result cache hit: {key}')
+            for name in files:
+                if name == 'result.json' or (name == 'result.pdf' and pdf_outdated):
+                    continue
+                replace_file(os.path.join(entry_dir, name), os.path.join(output_dir, name))
+
+            result_json = os.path.join(output_dir, 'result.json')
+            log_message(f'Saving result JSON: {result_json}')
+            with open(f'{result_json}.tmp{os.getpid()}', 'w') as file:
+                json.dump(result_dict, file, indent=4)
+            os.replace(f'{result_json}.tmp{os.getpid()}', result_json)
+
+            if render or skipped:
+                with open(phantom_file, 'rb') as file:
+                    phantom = pickle.load(file)
+                phantoms.artifacts.save_outputs(phantom=phantom, kinds=render, output_dir=output_dir, device_id=device_id, config=config, notes=notes, metadata=metadata,
+                                                timer=timer, log_message=log_message, subimages=subimages, phantom_name=phantom_name)
+                if skipped:
+                    phantoms.artifacts.save_deferred(phantom=phantom, skipped=skipped, output_dir=output_dir, device_id=device_id, config=config, notes=notes, metadata=metadata,
+                                                     log_message=log_message, subimages=subimages, phantom_name=phantom_name)
+
+            if 'record' in kinds:
+                phantoms.helper.record_result(phantom_name=phantom_name, output_dir=output_dir, device_id=device_id, notes=notes, config=config, metadata=metadata, log_message=log_message)
+
+            # most recently used
+            os.utime(entry_file)
+            return True
+
+        except Exception as e:
+            # e.g. an entry evicted by another process while being read
+            log_message(f'Failed reading result cache entry {key} ({e}), running the analysis...')
+            return False
+
+    def store(self, key, phantom, output_dir, config, notes, metadata, log_message):
+        # The entry is written to a temporary folder and renamed, so concurrent jobs never see a partial entry
+        entry_dir = self.get_entry_dir(key)
+        temp_dir = f'{entry_dir}.tmp{os.getpid()}'
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir)
+        os.makedirs(temp_dir)
+
+        size = 0
+        files = []
+        for entry in os.scandir(output_dir):
+            if entry.is_file() and is_cached_file(entry.name):
+                shutil.copyfile(entry.path, os.path.join(temp_dir, entry.name))
+                size += entry.stat().st_size
+                files.append(entry.name)
+
+        phantom_file = os.path.join(temp_dir, PHANTOM_FILE)
+        try:
+            with open(phantom_file, 'wb') as file:
+                pickle.dump(phantom, file, protocol=pickle.HIGHEST_PROTOCOL)
+            size += os.path.getsize(phantom_file)
+        except Exception as e:
+            # the outputs are still cached; a hit that needs the phantom falls back to the analysis
+            log_message(f'Could not cache the analyzed phantom ({e})')
+            if os.path.exists(phantom_file):
+                os.remove(phantom_file)
+
+        with open(os.path.join(temp_dir, ENTRY_FILE), 'w') as file:
+            json.dump({
+                'key': key,
+                'files': sorted(files),
+                'kinds': phantoms.artifacts.get_output_kinds(config),
+                'notes': notes,
+                'metadata': metadata,
+                'size': size,
+                'created': time.time(),
+            }, file, indent=4)
+
+        if os.path.exists(entry_dir):
+            shutil.rmtree(entry_dir, ignore_errors=True)
+        try:
+            os.rename(temp_dir, entry_dir)
+        except OSError:
+            # stored by another job in the meantime
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            return
+
+        log_message(f'Result cached: {entry_dir} ({size / (1024 * 1024):.1f} MB)')
+        self.evict(log_message)
+
+    def get_entries(self):
+        # (last used time, size, folder) of each entry
+        entries = []
+        for entry in os.scandir(self.folder):
+            entry_file = os.path.join(entry.path, ENTRY_FILE)
+            if not entry.is_dir() or not os.path.exists(entry_file):
+                continue
+            try:
+                with open(entry_file, 'r') as file:
+                    size = json.load(file)['size']
+                entries.append((os.path.getmtime(entry_file), size, entry.path))
+            except (OSError, ValueError, KeyError):
+                continue
+        return entries
+
+    def evict(self, log_message):
+        # Removes the least recently used entries until the cache fits in max_size_mb
+        max_size = self.max_size_mb * 1024 * 1024
+        entries = sorted(self.get_entries())
+        total_size = sum(size for _, size, _ in entries)
+        while total_size > max_size and entries:
+            _, size, entry_dir = entries.pop(0)
+            log_message(f'Evicting result cache entry: {entry_dir}')
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
+
+def open_result_cache(config):
+    # The result cache of the phantom config ('result_cache' settings), None when disabled
+    settings = config.get('result_cache')
+    if not settings or not settings.get('enabled', True):
+        return None
+    return ResultCache(folder=settings.get('folder', DEFAULT_FOLDER),
+                       max_size_mb=settings.get('max_size_mb', DEFAULT_MAX_SIZE_MB),
+                       hash_workers=settings.get('hash_workers', 4))
+
+def lookup(phantom_name, input_files, output_dir, device_id, config, notes, metadata, timer, log_message, subimages=[]):
+    '''
+    Restores the cached result of the inputs if there is one.
+    Returns (cache, key, hit); cache is None when the cache is disabled or the key cannot be computed.
+    '''
+    result_cache = open_result_cache(config)
+    if result_cache is None:
+        return None, None, False
+
+    with timer.stage('cache_lookup'):
+        try:
+            key = result_cache.get_key(phantom_name, input_files, config)
+        except Exception as e:
+            log_message(f'Result cache disabled for this run ({e})')
+            return None, None, False
+        hit = result_cache.restore(key, output_dir, device_id, config, notes, metadata, timer, log_message, subimages=subimages, phantom_name=phantom_name)
+    return result_cache, key, hit
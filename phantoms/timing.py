@@ -0,0 +1,82 @@
+import os
+import sys
+import json
+import time
+from contextlib import contextmanager
+
+TIMINGS_FILE = 'timings.json'
+
+# how to read the numbers, written with them to timings.json and the log
+TIMING_NOTES = [
+    'peak_rss_mb is the peak of the process so far, not of the stage: it only goes up when a stage uses more memory than all the previous ones.',
+    'cpu_s is the CPU time of the analysis process; the processes rendering the artifacts (render_workers > 1) are not included.',
+]
+
+def get_peak_rss_mb():
+    # Peak resident memory of this process so far, in MB (None if it cannot be measured)
+    try:
+        import psutil
+        # peak_wset is only available on Windows; rss elsewhere is the current, not the peak, memory
+        peak_wset = getattr(psutil.Process().memory_info(), 'peak_wset', None)
+        if peak_wset is not None:
+            return peak_wset / (1024 * 1024)
+    except ImportError:
+        pass
+
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in KB on Linux
+        return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+    except ImportError:
+        return None
+
+class StageTimer:
+    '''
+    Records wall time, CPU time and peak RSS of each stage of a phantom analysis (see TIMING_NOTES).
+
+        timer = StageTimer()
+        with timer.stage('analyze'):
+            phantom.analyze(...)
+        timer.save(output_dir, log_message)
+    '''
+    def __init__(self):
+        self.stages = []
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+
+    @contextmanager
+    def stage(self, name):
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield
+        finally:
+            self.stages.append({
+                'stage': name,
+                'wall_s': round(time.perf_counter() - start_wall, 4),
+                'cpu_s': round(time.process_time() - start_cpu, 4),
+                'peak_rss_mb': get_peak_rss_mb(),
+            })
+
+    def get_totals(self):
+        return {
+            'wall_s': round(time.perf_counter() - self.start_wall, 4),
+            'cpu_s': round(time.process_time() - self.start_cpu, 4),
+            'peak_rss_mb': get_peak_rss_mb(),
+        }
+
+    def get_summary(self):
+        lines = [f'{"stage":<20}{"wall s":>10}{"cpu s":>10}{"peak MB":>10}']
+        for stage in self.stages + [dict(self.get_totals(), stage='total')]:
+            peak = f"{stage['peak_rss_mb']:.0f}" if stage['peak_rss_mb'] is not None else '-'
+            lines.append(f"{stage['stage']:<20}{stage['wall_s']:>10.2f}{stage['cpu_s']:>10.2f}{peak:>10}")
+        return '\n'.join(lines + TIMING_NOTES)
+
+    def save(self, output_dir, log_message):
+        timings_json = os.path.join(output_dir, TIMINGS_FILE)
+        log_message(f'Saving timings: {timings_json}')
+        with open(timings_json, 'w') as file:
+            json.dump({'stages': self.stages, 'total': self.get_totals(), 'notes': TIMING_NOTES}, file, indent=4)
+
+        log_message('Timings:\n' + self.get_summary())
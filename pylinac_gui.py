@@ -1,34 +1,48 @@
+# time the imports below when the import report is on
+import import_timer
+import_timer.install_if_enabled()
+
 import os
 import json
 import tkinter as tk
 from tkinter import filedialog, messagebox
-from tkcalendar import DateEntry  # Date picker widget
 from tkinter import ttk  # For progress bar
 import threading
+import multiprocessing
 import time
 from util import read_json_file
 
 import obj_helper
 import util
 import model_helper
-import webservice_helper
-import dicom_helper
+import staging_helper
+import results_db
 import importlib
 
-from dicom_chooser import DicomChooser, SelectionMode
+# heavy modules (pydicom, PIL, requests, tkcalendar) are imported where they are first needed,
+# and warmed up in the background once the main window is visible
+from log_pump import LogPump
+import analysis_jobs
+from analysis_jobs import AnalysisJob, JobQueue, warm_up_process
+from job_queue_window import JobQueueWindow
 
 SETTINGS_FILE = 'settings.json'
+DICOM_INDEX_FILE = 'dicom_index.db'
+THUMBNAIL_CACHE_FOLDER = 'thumbnail_cache'
+JOB_POLL_INTERVAL_MS = 200
+
+# modules imported by the warm-up thread
+WARM_UP_MODULES = ['dicom_chooser', 'dicom_helper', 'webservice_helper']
 
-# Splash Screen
-def show_splash_screen():
-    splash = tk.Tk()
+# Splash Screen, shown while the main window is built (the caller destroys it)
+def show_splash_screen(root):
+    splash = tk.Toplevel(root)
     splash.overrideredirect(True)  # Hide window borders and controls
     splash.geometry("300x200+500+300")  # Set the position and size of the splash screen
     splash_label = tk.Label(splash, text="Loading...", font=("Helvetica", 16))
     splash_label.pack(expand=True)
     splash.update()
-    time.sleep(2)  # Simulate some loading time (2 seconds)
-    splash.destroy()  # Close the splash screen
+    return splash
 
 def find_obj_of_id(objs, id):
     for obj in objs:
@@ -98,6 +112,7 @@ class PyLinacGuiApp:
         self.performed_date_label.pack(side="left", padx=5)
 
         # Date picker (DateEntry) allowing both selection and manual entry
+        from tkcalendar import DateEntry  # Date picker widget
         self.performed_date_entry = DateEntry(self.date_frame, selectmode='day', date_pattern='y-mm-dd')
         self.performed_date_entry.pack(side="left", fill="x", expand=True)
 
@@ -145,6 +160,10 @@ class PyLinacGuiApp:
         self.run_button = tk.Button(self.buttons_frame, text="Run Analysis", command=self.run_analysis_thread)
         self.run_button.pack(side=tk.LEFT, padx=5, pady=10)
 
+        # Create "Jobs" button
+        self.jobs_button = tk.Button(self.buttons_frame, text="Jobs", command=self.show_job_queue)
+        self.jobs_button.pack(side=tk.LEFT, padx=5, pady=10)
+
         # Create "Record" button
         self.push_to_server_button = tk.Button(self.buttons_frame, text="Push to server", command=self.record_result_thread)
         self.push_to_server_button.pack(side=tk.LEFT, padx=5, pady=10)
@@ -164,6 +183,12 @@ class PyLinacGuiApp:
         # Configure the Scrollbar to work with the Text widget
         self.scrollbar.config(command=self.log_output.yview)
 
+        # Messages from worker threads are queued and written to the Text widget in batches
+        self.log_pump = LogPump(self.log_output,
+                                interval_ms=self.config.get('log_flush_interval_ms', 100),
+                                max_lines=self.config.get('log_max_lines', 5000))
+        self.log_pump.start()
+
         # Create a frame to hold the status bar components
         self.status_frame = tk.Frame(root, relief=tk.SUNKEN, bd=1)
         self.status_frame.pack(side=tk.BOTTOM, fill=tk.X)
@@ -185,6 +210,12 @@ class PyLinacGuiApp:
         # Set up the exit event to save settings
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
 
+        # Analysis jobs run in separate processes
+        self.job_queue = JobQueue(max_concurrency=self.config.get('analysis_concurrency', 2), log_message=self.log)
+        self.job_queue_window = JobQueueWindow(self.root, self.job_queue)
+        self.jobs_progress_running = False
+        self.root.after(JOB_POLL_INTERVAL_MS, self.poll_job_queue)
+
         # after all UIs created:
         self.populate_performed_by()  # Populate the combobox with data from config file
         # Set the default value from the loaded settings, if available
@@ -283,14 +314,16 @@ class PyLinacGuiApp:
             self.output_folder_path.config(text=folder)
 
     def log(self, message):
-        self.log_output.insert(tk.END, message + "\n")
-        self.log_output.see(tk.END)
+        # safe to call from any thread
+        self.log_pump.log(message)
 
     def select_dicom_image_2d(self):
         
+        from dicom_chooser import DicomChooser, SelectionMode
+
         input_dir = self.get_input_folder()
         selection_mode = SelectionMode.FILE
-        dicom_chooser = DicomChooser(self.root, input_dir, selection_mode=selection_mode)
+        dicom_chooser = DicomChooser(self.root, input_dir, selection_mode=selection_mode, index_file=DICOM_INDEX_FILE, workers=self.config.get('dicom_scan_workers', 1), streaming=True, thumbnail_cache=THUMBNAIL_CACHE_FOLDER)
         dicom_chooser.show()
         self.root.wait_window(dicom_chooser.window)
 
@@ -317,6 +350,8 @@ class PyLinacGuiApp:
         return phantom['dim']
 
     def select_dicom_image_3d(self):
+        from dicom_chooser import DicomChooser, SelectionMode
+
         input_dir =  self.get_input_folder()
 
         if self.get_phantom_dim() == 3:
@@ -324,7 +359,7 @@ class PyLinacGuiApp:
         else:
             selection_mode = SelectionMode.FILE
         
-        dicom_chooser = DicomChooser(self.root, input_dir, selection_mode=selection_mode)
+        dicom_chooser = DicomChooser(self.root, input_dir, selection_mode=selection_mode, index_file=DICOM_INDEX_FILE, workers=self.config.get('dicom_scan_workers', 1), streaming=True, thumbnail_cache=THUMBNAIL_CACHE_FOLDER)
         dicom_chooser.show()
         self.root.wait_window(dicom_chooser.window)
         selected_series_name, selected_files = dicom_chooser.get_selection()
@@ -336,11 +371,12 @@ class PyLinacGuiApp:
             case_outdir = self.get_case_output_folder(selected_files[0])
             self.log(f'case output folder={case_outdir}')
 
-            import shutil
-            for i, src_file in enumerate(selected_files):
-                dst_file = os.path.join(case_outdir, f'input_{str(i).zfill(3)}.dcm' )
-                self.log(f'copying file...{src_file}-->{dst_file}')
-                shutil.copy(src_file, dst_file)
+            staging_mode = self.config.get('staging_mode', 'copy')
+            self.log(f'staging {len(selected_files)} files (mode={staging_mode})...')
+            staging_helper.stage_input_files(selected_files, case_outdir,
+                                             mode=staging_mode,
+                                             workers=self.config.get('staging_workers', 8),
+                                             log_message=self.log)
             
             self.analysis_input_folder = case_outdir
             self.analysis_result_folder = case_outdir
@@ -356,56 +392,77 @@ class PyLinacGuiApp:
             self.select_dicom_image_2d()
 
     def run_analysis_thread(self):
+        # Queue the analysis of the staged case; it runs in a separate process
+        try:
+            job = self.create_analysis_job()
+            self.job_queue.submit(job)
+        except Exception as e:
+            self.log(f"Error: {str(e)}")
+
+    def create_analysis_job(self):
+        self.phantom_config = self.load_phantom_config()
+        results_db.set_results_db_folder(self.phantom_config, self.get_output_folder())
+
+        metadata=self.phantom_config['publish_pdf_params']['metadata']
+        metadata['Performed By'] = self.performed_by_combobox.get()
+        metadata['Performed Date'] = self.performed_date_entry.get() 
         
-        # Disable the "Run Analysis" button to prevent multiple clicks
-        # self.run_button.config(state=tk.DISABLED)
-        
-        # Show progress
-        #self.progress_label.config(text="Running analysis...")
-        self.progress_bar.start()
+        config_notes = self.phantom_config['publish_pdf_params'].get('notes', '')
+        user_notes =  self.notes_text.get("1.0", tk.END).strip()
+
+        notes = f'{user_notes}\n{config_notes}'                
+
+        if self.get_phantom_dim() == 2:
+            if not hasattr(self, 'analysis_input_file'):
+                raise Exception("Please select an image first")
+            input_path = self.analysis_input_file
+        else: # 3d phantom
+            if not hasattr(self, 'analysis_input_folder'):
+                raise Exception("Please select an image first")
+            input_path = self.analysis_input_folder
+
+        return AnalysisJob(device_id=self.device_id(),
+            phantom=self.phantom(),
+            dim=self.get_phantom_dim(),
+            input_path=input_path,
+            output_dir=self.analysis_result_folder,
+            config=self.phantom_config,
+            notes=notes,
+            metadata=metadata)
+
+    def poll_job_queue(self):
+        self.job_queue.poll()
+
+        # show progress while jobs are queued or running
+        busy = self.job_queue.is_busy()
+        if busy and not self.jobs_progress_running:
+            self.progress_bar.start()
+        elif not busy and self.jobs_progress_running:
+            self.progress_bar.stop()
+        self.jobs_progress_running = busy
 
-        # Run analysis in a separate thread
-        threading.Thread(target=self.run_analysis).start()
+        self.root.after(JOB_POLL_INTERVAL_MS, self.poll_job_queue)
 
-    def run_analysis(self):
-        try:
-            module = self.get_phantom_module()
-            self.phantom_config = self.load_phantom_config()
+    def show_job_queue(self):
+        self.job_queue_window.show()
 
-            metadata=self.phantom_config['publish_pdf_params']['metadata']
-            metadata['Performed By'] = self.performed_by_combobox.get()
-            metadata['Performed Date'] = self.performed_date_entry.get() 
-            
-            config_notes = self.phantom_config['publish_pdf_params'].get('notes', '')
-            user_notes =  self.notes_text.get("1.0", tk.END).strip()
-
-            notes = f'{user_notes}\n{config_notes}'                
-
-            if self.get_phantom_dim() == 2:
-                module.run_analysis(device_id=self.device_id(),
-                    input_file=self.analysis_input_file, 
-                    output_dir=self.analysis_result_folder, 
-                    config = self.phantom_config, 
-                    notes=notes, 
-                    metadata=metadata, 
-                    log_message=self.log
-                    )
-            else: # 3d phantom
-                module.run_analysis(device_id=self.device_id(),
-                    input_dir = self.analysis_input_folder,
-                    output_dir=self.analysis_result_folder, 
-                    config = self.phantom_config, 
-                    notes=notes, 
-                    metadata=metadata, 
-                    log_message=self.log
-                    )
-                
+    def start_warm_up(self):
+        threading.Thread(target=self.warm_up, daemon=True).start()
 
-        except Exception as e:
-            self.log(f"Error: {str(e)}")
-        finally:
-            self.run_button.config(state=tk.NORMAL)
-            self.progress_bar.stop()
+    def warm_up(self):
+        # runs on a background thread once the main window is visible
+        start_time = time.perf_counter()
+        for module_name in WARM_UP_MODULES:
+            importlib.import_module(module_name)
+
+        # pylinac runs in the job processes, so it is loaded by a short-lived process:
+        # this warms the disk cache (and the frozen build's archive) without keeping pylinac in the GUI
+        process = analysis_jobs.mp_context.Process(target=warm_up_process, daemon=True)
+        process.start()
+        process.join()
+
+        self.log(f'Modules loaded in {time.perf_counter() - start_time:.1f} s')
+        import_timer.report(self.log)
     
     def get_input_folder(self):
 
@@ -442,6 +499,8 @@ class PyLinacGuiApp:
         return folder
 
     def get_case_output_folder(self, dicom_image_file):
+        import dicom_helper
+
         # get acquistion datetime
         acq_dt_str = dicom_helper.get_study_datetime_str(dicom_image_file)
 
@@ -480,15 +539,18 @@ class PyLinacGuiApp:
     def on_closing(self):
         # Save the settings when the app is closed
         self.save_settings()
+        self.job_queue.shutdown()
         self.root.destroy()
 
-    def record_result_as_number1ds(self, result_data):
+    def record_result_as_number1ds(self, result_data, kvps=None):
         # Configuration
         url = self.config['webservice_url'] + '/number1ds'
         app = f'{util.get_app_name()} 1.0.0'
         site_id = self.site()
         device_id = self.device()
 
+        import webservice_helper
+
         self.log(f'posting result number properties to {url}...')
         webservice_helper.post_result_as_number1ds(
             result_data=result_data,
@@ -497,15 +559,18 @@ class PyLinacGuiApp:
             device_id=device_id,
             phantom_id=self.phantom().lower(),
             url=url,
-            log=self.log)
+            log=self.log,
+            kvps=kvps)
         
-    def record_result_as_string1ds(self, result_data):
+    def record_result_as_string1ds(self, result_data, kvps=None):
         # Configuration
         url = self.config['webservice_url'] + '/string1ds'
         app = f'{util.get_app_name()} 1.0.0'
         site_id = self.site()
         device_id = self.device()
 
+        import webservice_helper
+
         self.log(f'posting result string properties to {url}...')
         webservice_helper.post_result_as_string1ds(
             result_data=result_data,
@@ -514,7 +579,8 @@ class PyLinacGuiApp:
             device_id=device_id,
             phantom_id=self.phantom().lower(),
             url=url,
-            log=self.log)
+            log=self.log,
+            kvps=kvps)
 
     def record_result_thread(self):
         if not hasattr(self, 'analysis_result_folder') or not os.path.exists(self.analysis_result_folder):
@@ -544,14 +610,24 @@ class PyLinacGuiApp:
 
             #result_data = phantom_module.push_to_server(result_folder=self.analysis_result_folder, config = self.config, log_message=self.log)
 
+            import webservice_helper
+            import phantoms.artifacts
+
             url = self.config['webservice_url'] +f'/{self.phantom().lower()}results'
             
-            result_data = webservice_helper.post_analysis_result(result_folder=self.analysis_result_folder, config = self.config, url=url, log_message=self.log)   
+            # the deferred phantom is only needed locally to produce skipped outputs
+            result_data = webservice_helper.post_analysis_result(result_folder=self.analysis_result_folder, config = self.config, url=url, log_message=self.log,
+                                                                 exclude_files=[phantoms.artifacts.DEFERRED_FILE])
             
 
-            self.record_result_as_number1ds(result_data)
+            # one walk of the result for both posts; lists and arrays as set by result_flatten in config.json
+            self.log('collecting numbers and strings from the result file...')
+            kvps = obj_helper.flatten(result_data, **obj_helper.get_options(self.config))
+            numbers, strings = obj_helper.split_numbers_strings(kvps)
+
+            self.record_result_as_number1ds(result_data, kvps=numbers)
             
-            self.record_result_as_string1ds(result_data)
+            self.record_result_as_string1ds(result_data, kvps=strings)
 
         except Exception as e:
             self.log(f"Error: {str(e)}")
@@ -565,10 +641,19 @@ class PyLinacGuiApp:
 
 # Main Application
 if __name__ == "__main__":
-    # Show the splash screen first
-    show_splash_screen()
+    # needed by the job processes in the frozen build
+    multiprocessing.freeze_support()
 
-    # Start the main application after splash
+    # Show the splash screen while the main application is built
     root = tk.Tk()
+    root.withdraw()
+    splash = show_splash_screen(root)
+
     app = PyLinacGuiApp(root)
+
+    splash.destroy()  # Close the splash screen
+    root.deiconify()
+
+    # load the heavy modules once the main window is visible
+    root.after_idle(app.start_warm_up)
     root.mainloop()
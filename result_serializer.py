@@ -0,0 +1,159 @@
+import json
+import time
+import base64
+from enum import Enum
+from datetime import datetime, date
+
+import numpy as np
+
+# array encodings: 'list' (plain JSON numbers) or 'base64' (arrays with at least base64_min_size elements)
+ARRAY_MODES = ['list', 'base64']
+DEFAULT_BASE64_MIN_SIZE = 256
+
+def encode_array(array):
+    # base64 of the raw little-endian buffer; contiguous arrays are encoded without a copy
+    array = np.ascontiguousarray(array)
+    if array.dtype.byteorder == '>':
+        array = array.astype(array.dtype.newbyteorder('<'))
+    return {
+        '__ndarray__': base64.b64encode(memoryview(array).cast('B')).decode('ascii'),
+        'dtype': array.dtype.str,
+        'shape': list(array.shape),
+    }
+
+def decode_array(obj):
+    # inverse of encode_array
+    return np.frombuffer(base64.b64decode(obj['__ndarray__']), dtype=np.dtype(obj['dtype'])).reshape(obj['shape'])
+
+def load(file, as_lists=False):
+    # Reads a result.json; the base64 arrays are decoded to numpy arrays, or to lists with as_lists (the server takes lists)
+    def decode(obj):
+        if '__ndarray__' not in obj:
+            return obj
+        array = decode_array(obj)
+        return array.tolist() if as_lists else array
+    return json.load(file, object_hook=decode)
+
+def convert(obj, array_mode='list', base64_min_size=DEFAULT_BASE64_MIN_SIZE):
+    # One level of conversion of an object json cannot encode; containers are returned as is and walked by the caller
+    if isinstance(obj, np.ndarray):
+        if array_mode == 'base64' and obj.size >= base64_min_size and obj.dtype.kind in 'biuf':
+            return encode_array(obj)
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, Enum):
+        return obj.value
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if hasattr(obj, '__dict__'):
+        # pylinac result dataclasses and their members
+        return vars(obj)
+    return str(obj)
+
+class ResultEncoder(json.JSONEncoder):
+    '''
+    JSON encoder of pylinac results: the result objects are encoded while json walks them,
+    so a result is serialized in one pass straight to the output stream.
+    '''
+    def __init__(self, *args, array_mode='list', base64_min_size=DEFAULT_BASE64_MIN_SIZE, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.array_mode = array_mode
+        self.base64_min_size = base64_min_size
+
+    def default(self, obj):
+        return convert(obj, self.array_mode, self.base64_min_size)
+
+def dump(obj, file, array_mode='list', base64_min_size=DEFAULT_BASE64_MIN_SIZE, indent=4):
+    if array_mode not in ARRAY_MODES:
+        raise Exception(f'Unknown array mode: {array_mode}. Use one of {ARRAY_MODES}')
+    json.dump(obj, file, cls=ResultEncoder, indent=indent, array_mode=array_mode, base64_min_size=base64_min_size)
+
+def to_serializable(obj, array_mode='list', base64_min_size=DEFAULT_BASE64_MIN_SIZE):
+    # The result as plain dicts, lists and values, for callers that need the dictionary rather than the file
+    if isinstance(obj, dict):
+        return {key: to_serializable(value, array_mode, base64_min_size) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [to_serializable(item, array_mode, base64_min_size) for item in obj]
+    if obj is None or isinstance(obj, (str, bool, int, float)):
+        return obj
+    return to_serializable(convert(obj, array_mode, base64_min_size), array_mode, base64_min_size)
+
+def get_options(config):
+    # 'result_json' settings of a phantom config: {"array_mode": "list" | "base64", "base64_min_size": 256}
+    settings = config.get('result_json', {})
+    return {
+        'array_mode': settings.get('array_mode', 'list'),
+        'base64_min_size': settings.get('base64_min_size', DEFAULT_BASE64_MIN_SIZE),
+    }
+
+if __name__ == '__main__':
+    # Benchmark on a synthetic CatPhan-like result: the json round-trip with util.obj_serializer vs one pass
+    import io
+    from dataclasses import dataclass, field
+    from util import obj_serializer
+
+    @dataclass
+    class ROIResult:
+        name: str
+        value: float
+        stdev: float
+        passed: bool
+
+    @dataclass
+    class ModuleResult:
+        passed: bool
+        mtf: np.ndarray
+        profile: np.ndarray
+        rois: dict = field(default_factory=dict)
+
+    @dataclass
+    class Result:
+        model: str
+        num_images: int
+        performed: datetime
+        modules: dict = field(default_factory=dict)
+
+    rng = np.random.default_rng(0)
+    result = Result(model='CatPhan504', num_images=80, performed=datetime.now())
+    for i in range(6):
+        rois = {f'roi{j}': ROIResult(name=f'roi{j}', value=float(rng.normal()), stdev=float(rng.random()), passed=True) for j in range(12)}
+        result.modules[f'ctp{i}'] = ModuleResult(passed=True, mtf=rng.random(200), profile=rng.random(2000), rois=rois)
+
+    def old_way():
+        result_dict = json.loads(json.dumps(vars(result), default=obj_serializer))
+        file = io.StringIO()
+        json.dump(result_dict, file, indent=4)
+        return file.getvalue()
+
+    def old_way_with_lists():
+        # the same round-trip, with the arrays kept as lists
+        result_dict = json.loads(json.dumps(vars(result), default=lambda obj: obj.tolist() if isinstance(obj, np.ndarray) else obj_serializer(obj)))
+        file = io.StringIO()
+        json.dump(result_dict, file, indent=4)
+        return file.getvalue()
+
+    def new_way(array_mode):
+        file = io.StringIO()
+        dump(vars(result), file, array_mode=array_mode)
+        return file.getvalue()
+
+    def measure(function, repeat=20):
+        start_time = time.perf_counter()
+        for _ in range(repeat):
+            output = function()
+        return (time.perf_counter() - start_time) / repeat * 1000, len(output)
+
+    print(f'{"method":<40}{"ms":>10}{"KB":>10}')
+    for name, function in [('json round-trip, str(ndarray)', old_way),
+                           ('json round-trip, arrays as lists', old_way_with_lists),
+                           ('one pass, arrays as lists', lambda: new_way('list')),
+                           ('one pass, arrays as base64', lambda: new_way('base64'))]:
+        ms, size = measure(function)
+        print(f'{name:<40}{ms:>10.2f}{size / 1024:>10.0f}')
+
+    # the base64 arrays decode to the same values
+    decoded = json.loads(new_way('base64'))
+    assert np.array_equal(decode_array(decoded['modules']['ctp0']['profile']), result.modules['ctp0'].profile)
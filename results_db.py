@@ -0,0 +1,253 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+from contextlib import contextmanager
+
+import obj_helper
+
+# default database file, next to the case folders (where results.csv used to be)
+RESULTS_DB_FILE = 'results.db'
+
+# bump this when the tables change, with a migration in create_tables (the results are not a cache)
+SCHEMA_VERSION = 1
+
+# fields of result.json stored as columns of the results table rather than as values (see phantoms.helper.set_run_fields)
+RUN_FIELDS = ['device_id', 'performed_by', 'performed_on', 'notes', 'config']
+
+# columns of the results table returned by the queries
+RESULT_COLUMNS = ['id', 'device_id', 'phantom', 'performed_on', 'performed_by', 'notes', 'output_dir', 'recorded_at']
+
+# file systems of network shares (/proc/mounts), WAL needs shared memory between the processes of one machine
+NETWORK_FILE_SYSTEMS = ['nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'fuse.sshfs', '9p']
+DRIVE_REMOTE = 4
+
+def is_network_path(path):
+    # UNC paths, mapped network drives on Windows and network mounts on Linux
+    if path.startswith(('\\\\', '//')):
+        return True
+    path = os.path.abspath(path)
+    if sys.platform == 'win32':
+        import ctypes
+        drive = os.path.splitdrive(path)[0]
+        return bool(drive) and ctypes.windll.kernel32.GetDriveTypeW(drive + '\\') == DRIVE_REMOTE
+    try:
+        with open('/proc/mounts', 'r') as file:
+            mounts = [line.split()[1:3] for line in file]
+    except OSError:
+        return False
+    # the mount point containing the path, the longest one
+    path = os.path.realpath(path)
+    fs_type = None
+    length = -1
+    for mount_point, mount_fs_type in mounts:
+        if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) and len(mount_point) > length:
+            fs_type, length = mount_fs_type, len(mount_point)
+    return fs_type in NETWORK_FILE_SYSTEMS
+
+class ResultsDB:
+    '''
+    Local store of analysis results: one row per analysis, indexed by device, phantom and date,
+    and one row per flattened result value (the keys of results.csv), so new result fields never misalign older rows.
+    Several processes can write at the same time: WAL journal (not on network shares), and writers wait up to timeout seconds for the lock.
+    '''
+    def __init__(self, db_file=RESULTS_DB_FILE, wal=True, timeout=30):
+        self.db_file = db_file
+        # WAL on a network share can corrupt the database, the default rollback journal is used there
+        self.wal = wal and not is_network_path(db_file)
+        # transactions are explicit, see transaction()
+        self.conn = sqlite3.connect(db_file, timeout=timeout, isolation_level=None)
+        if self.wal:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+        self.create_tables()
+
+    @contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so concurrent writers wait instead of failing on upgrade
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+
+    def create_tables(self):
+        with self.transaction():
+            version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+            if version > SCHEMA_VERSION:
+                raise Exception(f'{self.db_file} was created by a newer version (schema {version})')
+
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS results (
+                id INTEGER PRIMARY KEY,
+                device_id TEXT NOT NULL,
+                phantom TEXT NOT NULL,
+                performed_on TEXT,
+                performed_by TEXT,
+                notes TEXT,
+                output_dir TEXT UNIQUE,
+                recorded_at TEXT NOT NULL,
+                result_json TEXT NOT NULL)''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_results_device ON results(device_id, phantom, performed_on)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_results_phantom ON results(phantom, performed_on)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_results_performed_on ON results(performed_on)')
+
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS result_values (
+                result_id INTEGER NOT NULL,
+                key TEXT NOT NULL,
+                number REAL,
+                text TEXT,
+                PRIMARY KEY (result_id, key)) WITHOUT ROWID''')
+            self.conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+    def add_result(self, result_data, phantom, output_dir):
+        '''
+        Adds a result.json dict. A new analysis of the same output folder replaces the previous one.
+        Returns the id of the result.
+        '''
+        output_dir = os.path.abspath(output_dir)
+        # the run fields are columns of results; booleans are stored as 1 and 0
+        values = obj_helper.traverse_and_collect_numbers_strings({key: value for key, value in result_data.items() if key not in RUN_FIELDS})
+        rows = []
+        for item in values:
+            if isinstance(item['value'], (int, float)):
+                rows.append((item['key'], float(item['value']), None))
+            else:
+                rows.append((item['key'], None, item['value']))
+
+        with self.transaction():
+            self.delete_output_dir(output_dir)
+            cursor = self.conn.execute(
+                'INSERT INTO results (device_id, phantom, performed_on, performed_by, notes, output_dir, recorded_at, result_json) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (result_data.get('device_id') or '', phantom.lower(), result_data.get('performed_on'), result_data.get('performed_by'),
+                 result_data.get('notes'), output_dir, time.strftime('%Y-%m-%d %H:%M:%S'), json.dumps(result_data)))
+            result_id = cursor.lastrowid
+            self.conn.executemany('INSERT INTO result_values VALUES (?, ?, ?, ?)', [(result_id, *row) for row in rows])
+        return result_id
+
+    def delete_output_dir(self, output_dir):
+        for (result_id,) in self.conn.execute('SELECT id FROM results WHERE output_dir = ?', (output_dir,)).fetchall():
+            self.conn.execute('DELETE FROM result_values WHERE result_id = ?', (result_id,))
+            self.conn.execute('DELETE FROM results WHERE id = ?', (result_id,))
+
+    def get_filter(self, device_id=None, phantom=None, start=None, end=None):
+        # WHERE clause on the results table; start and end are inclusive 'YYYY-MM-DD' dates
+        conditions, params = [], []
+        if device_id is not None:
+            conditions.append('r.device_id = ?')
+            params.append(device_id)
+        if phantom is not None:
+            conditions.append('r.phantom = ?')
+            params.append(phantom.lower())
+        if start is not None:
+            conditions.append('r.performed_on >= ?')
+            params.append(start)
+        if end is not None:
+            conditions.append('r.performed_on <= ?')
+            params.append(end)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        return where, params
+
+    def query_results(self, device_id=None, phantom=None, start=None, end=None):
+        # results in date order, without their values
+        where, params = self.get_filter(device_id, phantom, start, end)
+        rows = self.conn.execute(f'SELECT {", ".join("r." + column for column in RESULT_COLUMNS)} FROM results r {where} ORDER BY r.performed_on, r.id', params)
+        return [dict(zip(RESULT_COLUMNS, row)) for row in rows]
+
+    def query_values(self, keys, device_id=None, phantom=None, start=None, end=None):
+        '''
+        The given result keys of the matching results, in date order:
+        [{'id', 'device_id', ..., 'values': {key: number or text}}]
+        '''
+        results = self.query_results(device_id, phantom, start, end)
+        if not results or not keys:
+            return results
+        by_id = {result['id']: result for result in results}
+        for result in results:
+            result['values'] = {}
+
+        where, params = self.get_filter(device_id, phantom, start, end)
+        key_placeholders = ', '.join(['?'] * len(keys))
+        key_condition = f'v.key IN ({key_placeholders})'
+        where = f'{where} AND {key_condition}' if where else f'WHERE {key_condition}'
+        rows = self.conn.execute(f'''SELECT v.result_id, v.key, v.number, v.text FROM results r
+                                     JOIN result_values v ON v.result_id = r.id {where}''', params + list(keys))
+        for result_id, key, number, text in rows:
+            by_id[result_id]['values'][key] = number if number is not None else text
+        return results
+
+    def get_keys(self, device_id=None, phantom=None):
+        # all the value keys of the matching results
+        where, params = self.get_filter(device_id, phantom)
+        rows = self.conn.execute(f'SELECT DISTINCT v.key FROM results r JOIN result_values v ON v.result_id = r.id {where} ORDER BY v.key', params)
+        return [row[0] for row in rows]
+
+    def get_devices(self, phantom=None):
+        where, params = self.get_filter(phantom=phantom)
+        return [row[0] for row in self.conn.execute(f'SELECT DISTINCT r.device_id FROM results r {where} ORDER BY r.device_id', params)]
+
+    def get_result(self, result_id):
+        row = self.conn.execute('SELECT result_json FROM results WHERE id = ?', (result_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def export_csv(self, csv_file, device_id=None, phantom=None, start=None, end=None):
+        # results.csv-like export; the header is the union of the keys, so every value is in its column
+        keys = self.get_keys(device_id, phantom)
+        results = self.query_values(keys, device_id, phantom, start, end)
+        columns = [column for column in RESULT_COLUMNS if column != 'id']
+        with open(csv_file, 'w') as file:
+            file.write(','.join(columns + keys) + '\n')
+            for result in results:
+                values = [result[column] for column in columns] + [result.get('values', {}).get(key) for key in keys]
+                file.write(','.join('' if value is None else str(value).replace(',', '[comma]').replace('\n', '[newline]') for value in values) + '\n')
+        return len(results)
+
+    def close(self):
+        self.conn.close()
+
+def get_results_db_file(config, output_dir):
+    # 'results_db' file of the phantom config; a relative path is relative to the parent of the case folder
+    db_file = config.get('results_db', {}).get('file', RESULTS_DB_FILE)
+    if os.path.isabs(db_file):
+        return db_file
+    return os.path.join(os.path.dirname(os.path.abspath(output_dir)), db_file)
+
+def set_results_db_folder(config, folder):
+    # The GUI and the batches share one database for all their devices and phantoms: a relative file is put in their output folder
+    settings = dict(config.get('results_db', {}))
+    db_file = settings.get('file', RESULTS_DB_FILE)
+    if not os.path.isabs(db_file):
+        settings['file'] = os.path.join(os.path.abspath(folder), db_file)
+    config['results_db'] = settings
+
+def open_results_db(config, output_dir):
+    settings = config.get('results_db', {})
+    return ResultsDB(get_results_db_file(config, output_dir), wal=settings.get('wal', True), timeout=settings.get('timeout', 30))
+
+if __name__ == '__main__':
+    # python results_db.py <results.db> --csv results.csv [--device_id 'SBUH|TrueBeam'] [--phantom catphan] [--start 2024-01-01] [--end 2024-12-31]
+    parser = argparse.ArgumentParser(description="List or export the results database")
+    parser.add_argument("db_file", help="The results database")
+    parser.add_argument("--device_id", help="Only this device (SITE|DEVICE)")
+    parser.add_argument("--phantom", help="Only this phantom")
+    parser.add_argument("--start", help="From this date (YYYY-MM-DD)")
+    parser.add_argument("--end", help="Until this date (YYYY-MM-DD)")
+    parser.add_argument("--csv", help="Export the results with all their values to this CSV file")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db_file):
+        print(f'Error: {args.db_file} not found')
+        sys.exit(1)
+
+    db = ResultsDB(args.db_file)
+    try:
+        if args.csv:
+            count = db.export_csv(args.csv, args.device_id, args.phantom, args.start, args.end)
+            print(f'{count} results exported to {args.csv}')
+        else:
+            for result in db.query_results(args.device_id, args.phantom, args.start, args.end):
+                print(f"{result['id']:>6}  {result['performed_on'] or '':<12}{result['device_id']:<25}{result['phantom']:<12}{result['output_dir']}")
+    finally:
+        db.close()
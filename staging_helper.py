@@ -0,0 +1,119 @@
+import os
+import json
+import shutil
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+# How the selected input files are put into the case folder
+#   link          - hardlink each file, else symlink, else parallel_copy
+#   parallel_copy - copy on a thread pool, verifying a SHA-256 checksum of each copy
+#   manifest      - copy nothing, write the source paths to input_manifest.json for the phantom loader
+#   copy          - copy one file at a time with shutil.copy (the original behavior)
+STAGING_MODES = ['link', 'parallel_copy', 'manifest', 'copy']
+
+MANIFEST_FILE = 'input_manifest.json'
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+def get_staged_filename(i):
+    return f'input_{str(i).zfill(3)}.dcm'
+
+def file_sha256(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(COPY_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def copy_with_checksum(src_file, dst_file):
+    # Copy a file, hashing the source while it is read, then verify the copy
+    sha256 = hashlib.sha256()
+    with open(src_file, 'rb') as src, open(dst_file, 'wb') as dst:
+        for chunk in iter(lambda: src.read(COPY_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+            dst.write(chunk)
+    shutil.copystat(src_file, dst_file)
+
+    checksum = sha256.hexdigest()
+    if file_sha256(dst_file) != checksum:
+        raise Exception(f'Checksum mismatch after copying {src_file} to {dst_file}')
+    return checksum
+
+def link_file(src_file, dst_file):
+    # Returns 'hardlink' or 'symlink', or None if the file system supports neither
+    try:
+        os.link(src_file, dst_file)
+        return 'hardlink'
+    except OSError:
+        pass
+    try:
+        os.symlink(os.path.abspath(src_file), dst_file)
+        return 'symlink'
+    except OSError:
+        return None
+
+def parallel_copy(pairs, workers, log_message):
+    # pairs: list of (src_file, dst_file)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda pair: copy_with_checksum(*pair), pairs))
+    log_message(f'{len(pairs)} files copied and verified (workers={workers})')
+
+def remove_staged_files(case_folder):
+    # Remove inputs of an earlier staging so they are not mixed with the new ones
+    manifest_file = os.path.join(case_folder, MANIFEST_FILE)
+    if os.path.lexists(manifest_file):
+        os.remove(manifest_file)
+
+    for filename in os.listdir(case_folder):
+        if filename.startswith('input_') and filename.endswith('.dcm'):
+            os.remove(os.path.join(case_folder, filename))
+
+def stage_input_files(src_files, case_folder, mode='copy', workers=8, log_message=print):
+    '''
+    Puts the input files into the case folder with the given staging mode (see STAGING_MODES).
+    The phantom modules read the inputs with read_staged_input().
+    '''
+    if mode not in STAGING_MODES:
+        raise Exception(f'Unknown staging mode: {mode}. Use one of {STAGING_MODES}')
+
+    remove_staged_files(case_folder)
+
+    pairs = [(src_file, os.path.join(case_folder, get_staged_filename(i))) for i, src_file in enumerate(src_files)]
+
+    if mode == 'copy':
+        for src_file, dst_file in pairs:
+            log_message(f'copying file...{src_file}-->{dst_file}')
+            shutil.copy(src_file, dst_file)
+
+    elif mode == 'parallel_copy':
+        parallel_copy(pairs, workers, log_message)
+
+    elif mode == 'link':
+        counts = {'hardlink': 0, 'symlink': 0}
+        to_copy = []
+        for src_file, dst_file in pairs:
+            link_type = link_file(src_file, dst_file)
+            if link_type:
+                counts[link_type] += 1
+            else:
+                to_copy.append((src_file, dst_file))
+        log_message(f"{counts['hardlink']} files hardlinked, {counts['symlink']} files symlinked")
+
+        if to_copy:
+            log_message('links not supported for some files, copying them...')
+            parallel_copy(to_copy, workers, log_message)
+
+    else: # manifest
+        manifest_file = os.path.join(case_folder, MANIFEST_FILE)
+        with open(manifest_file, 'w') as file:
+            json.dump({'files': [os.path.abspath(src_file) for src_file in src_files]}, file, indent=4)
+        log_message(f'{len(src_files)} source paths written to {manifest_file}')
+
+def read_staged_input(case_folder):
+    # The list of source files if the case was staged with a manifest, otherwise the case folder itself
+    manifest_file = os.path.join(case_folder, MANIFEST_FILE)
+    if not os.path.exists(manifest_file):
+        return case_folder
+
+    with open(manifest_file, 'r') as file:
+        return json.load(file)['files']
@@ -0,0 +1,70 @@
+import time
+import textwrap
+
+import pytest
+
+import analysis_jobs
+from analysis_jobs import AnalysisJob, JobQueue, CANCELLED, DONE
+
+# a phantom module for the job processes: logs every delay seconds, or sleeps without logging
+JOB_MODULE = '''
+import time
+
+def run_analysis(device_id, input_file, output_dir, config, notes, metadata, log_message):
+    if config.get('silent'):
+        time.sleep(60)
+    for i in range(config['steps']):
+        log_message(f'step {i}')
+        time.sleep(config['delay'])
+'''
+
+@pytest.fixture
+def job_phantom(tmp_path, monkeypatch):
+    # phantoms is a namespace package, the module is found in tmp_path by the spawned processes too
+    (tmp_path / 'phantoms').mkdir()
+    (tmp_path / 'phantoms' / 'jobtest.py').write_text(textwrap.dedent(JOB_MODULE))
+    monkeypatch.syspath_prepend(str(tmp_path))
+    return 'jobtest'
+
+def make_job(phantom, output_dir, **config):
+    return AnalysisJob(device_id='SITE|DEVICE', phantom=phantom, dim=2, input_path='image.dcm', output_dir=str(output_dir),
+                       config=config, notes='', metadata={})
+
+def poll_until(job_queue, condition, timeout=30):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        job_queue.poll()
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+def test_cancelled_job_stops_at_its_next_log(job_phantom, tmp_path):
+    logs = []
+    job_queue = JobQueue(max_concurrency=1, log_message=logs.append)
+    job = job_queue.submit(make_job(job_phantom, tmp_path / 'a', steps=1000, delay=0.05))
+    assert poll_until(job_queue, lambda: any('step 0' in line for line in logs))
+
+    process = job.process
+    job_queue.cancel(job.id)
+    assert job.status == CANCELLED
+    assert poll_until(job_queue, lambda: not process.is_alive(), timeout=analysis_jobs.CANCEL_TIMEOUT_S)
+    # stopped by itself, not terminated
+    assert process.exitcode == 0
+    assert not any('terminating' in line for line in logs)
+
+def test_terminated_job_does_not_affect_other_jobs(job_phantom, tmp_path, monkeypatch):
+    monkeypatch.setattr(analysis_jobs, 'CANCEL_TIMEOUT_S', 0.5)
+    logs = []
+    job_queue = JobQueue(max_concurrency=2, log_message=logs.append)
+    silent = job_queue.submit(make_job(job_phantom, tmp_path / 'silent', silent=True))
+    other = job_queue.submit(make_job(job_phantom, tmp_path / 'other', steps=40, delay=0.05))
+    assert poll_until(job_queue, lambda: any(f'[job {other.id}] step 0' in line for line in logs))
+
+    job_queue.cancel(silent.id)
+    assert poll_until(job_queue, lambda: other.status == DONE)
+    assert any(f'Job {silent.id} did not stop, terminating it.' in line for line in logs)
+    assert not silent.process.is_alive()
+    # every log of the other job arrived through its own queue
+    assert len([line for line in logs if line.startswith(f'[job {other.id}] step')]) == 40
+    job_queue.shutdown()
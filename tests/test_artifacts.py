@@ -0,0 +1,13 @@
+import phantoms.artifacts
+
+def get_deferred_kinds(config):
+    return phantoms.artifacts.get_deferred_kinds(config, phantoms.artifacts.get_output_kinds(config))
+
+def test_skipped_outputs_are_not_deferred_by_default():
+    assert get_deferred_kinds({'output_profile': 'minimal'}) == []
+    assert get_deferred_kinds({'output_profile': 'standard'}) == []
+
+def test_skipped_outputs_are_deferred_on_opt_in():
+    assert get_deferred_kinds({'output_profile': 'minimal', 'defer_outputs': True}) == ['image', 'pdf', 'txt']
+    assert get_deferred_kinds({'output_profile': 'standard', 'defer_outputs': True}) == ['pdf']
+    assert get_deferred_kinds({'output_profile': 'full', 'defer_outputs': True}) == []
@@ -0,0 +1,52 @@
+import sys
+import textwrap
+
+import pytest
+
+import catphan_sweep
+
+# a stand-in for pylinac's CatPhans that keeps state between analyses, as the real ones do (e.g. the found origin slice)
+PYLINAC_MODULE = '''
+import types
+
+class CatPhan604:
+    def __init__(self, input_files):
+        self.input_files = input_files
+        self.num_analyses = 0
+
+    def analyze(self, hu_tolerance, **params):
+        self.num_analyses += 1
+        self.hu_tolerance = hu_tolerance
+
+    def results_data(self):
+        return types.SimpleNamespace(num_analyses=self.num_analyses, ctp404={'hu_tolerance': self.hu_tolerance, 'hu_linearity_passed': self.num_analyses == 1})
+
+CatPhan600 = CatPhan504 = CatPhan503 = CatPhan604
+'''
+
+CONFIG = {
+    'catphan_model': '604',
+    'analysis_params': {'hu_tolerance': 40, 'scaling_tolerance': 1, 'thickness_tolerance': 0.2, 'low_contrast_tolerance': 1,
+                        'cnr_threshold': 15, 'contrast_method': 'Michelson', 'visibility_threshold': 0.15,
+                        'thickness_slice_straddle': 'auto', 'expected_hu_values': None},
+}
+
+@pytest.fixture
+def fake_pylinac(tmp_path, monkeypatch):
+    # found by the spawned workers too
+    (tmp_path / 'pylinac.py').write_text(textwrap.dedent(PYLINAC_MODULE))
+    monkeypatch.syspath_prepend(str(tmp_path))
+    for name in ['pylinac', 'phantoms.catphan']:
+        monkeypatch.delitem(sys.modules, name, raising=False)
+    yield
+    for name in ['pylinac', 'phantoms.catphan']:
+        sys.modules.pop(name, None)
+
+def test_serial_and_parallel_results_match(fake_pylinac):
+    grid = {'hu_tolerance': [30, 40, 50]}
+    serial = catphan_sweep.run_sweep(['a.dcm'], CONFIG, grid, workers=1, log_message=lambda message: None)
+    parallel = catphan_sweep.run_sweep(['a.dcm'], CONFIG, grid, workers=2, log_message=lambda message: None)
+
+    assert [row['results'] for row in serial] == [row['results'] for row in parallel]
+    assert [row['results']['ctp404_hu_tolerance'] for row in serial] == [30, 40, 50]
+    assert all(row['passed'] and row['results']['num_analyses'] == 1 for row in serial)
@@ -0,0 +1,58 @@
+import pytest
+import pydicom
+from pydicom.data import get_testdata_file
+
+import dicom_chooser
+from dicom_chooser import DicomChooser
+
+def test_properties_and_prefetch_read_headers_only(monkeypatch, tmp_path):
+    file_path = get_testdata_file('CT_small.dcm')
+    chooser = DicomChooser(root=None, input_dir=str(tmp_path), thumbnail_cache=str(tmp_path / 'thumbnails'))
+    # a thumbnail cached on disk by a previous session
+    chooser.load_thumbnail(file_path)
+    chooser = DicomChooser(root=None, input_dir=str(tmp_path), thumbnail_cache=str(tmp_path / 'thumbnails'))
+
+    reads = []
+    read = pydicom.dcmread
+    def dcmread(path, **kwargs):
+        reads.append(kwargs)
+        return read(path, **kwargs)
+    monkeypatch.setattr(dicom_chooser.pydicom, 'dcmread', dcmread)
+
+    chooser.prefetch(file_path, chooser.prefetch_generation)
+    assert reads == [{'stop_before_pixels': True}]
+    header = chooser.load_header(file_path)
+    assert 'PixelData' not in header
+    assert header.SOPInstanceUID == read(file_path).SOPInstanceUID
+    assert len(reads) == 1
+
+class FakeTree:
+    # the series node selected in the treeview
+    def selection(self):
+        return ['series']
+
+    def item(self, node, option=None):
+        if option == 'values':
+            return ('patient', 'study', 'series')
+        return {'text': 'CT - 20240102 - series (2 files)'}
+
+class FakeWindow:
+    destroyed = False
+
+    def destroy(self):
+        self.destroyed = True
+
+@pytest.mark.parametrize('scan_finished, confirmed, selected', [(True, False, True), (False, False, False), (False, True, True)])
+def test_select_series_during_scan_asks_to_confirm(monkeypatch, tmp_path, scan_finished, confirmed, selected):
+    questions = []
+    monkeypatch.setattr(dicom_chooser.messagebox, 'askyesno', lambda *args, **kwargs: questions.append(args) or confirmed)
+    chooser = DicomChooser(root=None, input_dir=str(tmp_path), streaming=True)
+    chooser.series_tree = FakeTree()
+    chooser.window = FakeWindow()
+    chooser.dicom_tree = {'patient': {'study': {'series': {'files': ['a.dcm', 'b.dcm']}}}}
+    chooser.scan_finished = scan_finished
+
+    chooser.on_select_clicked()
+    assert len(questions) == (0 if scan_finished else 1)
+    assert chooser.window.destroyed == selected
+    assert chooser.selected_files == (['a.dcm', 'b.dcm'] if selected else [])
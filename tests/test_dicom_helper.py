@@ -0,0 +1,79 @@
+import shutil
+import sqlite3
+
+import pytest
+import pydicom
+from pydicom.data import get_testdata_file
+
+import dicom_helper
+
+SAMPLE_FILES = ['CT_small.dcm', 'MR_small.dcm', 'rtplan.dcm']
+
+@pytest.mark.parametrize('name', SAMPLE_FILES)
+def test_tag_subset_read_matches_full_read(name):
+    file_path = get_testdata_file(name)
+    with open(file_path, 'rb') as fp:
+        header = dicom_helper.read_dicom_header_tags(fp)
+    with open(file_path, 'rb') as fp:
+        full_header = dicom_helper.read_dicom_header_full(fp)
+    assert header is not None
+    assert header == full_header
+
+def test_read_dicom_header_does_not_fall_back(monkeypatch):
+    # the subset read finds the header, the full read is never needed
+    def fail(fp):
+        raise AssertionError('full header read')
+    monkeypatch.setattr(dicom_helper, 'read_dicom_header_full', fail)
+    header = dicom_helper.read_dicom_header(get_testdata_file('CT_small.dcm'))
+    assert header['modality'] == 'CT'
+
+def test_benchmark_counts_only_headers(tmp_path, capsys, monkeypatch):
+    for name in SAMPLE_FILES:
+        (tmp_path / name).write_bytes(open(get_testdata_file(name), 'rb').read())
+    (tmp_path / 'notes.txt').write_text('not dicom')
+
+    dicom_helper.benchmark_header_reads(str(tmp_path))
+    output = capsys.readouterr().out
+    assert f'tag subset: {len(SAMPLE_FILES)} files' in output
+
+    # a subset read that returns no header is not counted
+    monkeypatch.setattr(dicom_helper, 'read_dicom_header_tags', lambda fp: None)
+    dicom_helper.benchmark_header_reads(str(tmp_path))
+    assert 'tag subset: no DICOM files found' in capsys.readouterr().out
+
+def test_thumbnail_cache_hit_does_not_read_the_dataset(tmp_path):
+    file_path = get_testdata_file('CT_small.dcm')
+    loads = []
+    def load_dicom_data():
+        loads.append(file_path)
+        return pydicom.dcmread(file_path)
+
+    thumbnail = dicom_helper.get_dicom_thumbnail(file_path, (64, 64), cache_folder=str(tmp_path), load_dicom_data=load_dicom_data)
+    cached = dicom_helper.get_dicom_thumbnail(file_path, (64, 64), cache_folder=str(tmp_path), load_dicom_data=load_dicom_data)
+    assert len(loads) == 1
+    assert (cached == thumbnail).all()
+
+def scan(directory, index_file):
+    log = []
+    dicom_tree = dicom_helper.parse_dicom_directory(directory, index_file=index_file, log_message=log.append)
+    return dicom_tree, log[-1]
+
+def test_index_hit_on_rescan_of_current_folder(tmp_path, monkeypatch):
+    folder = tmp_path / 'scan'
+    folder.mkdir()
+    for name in ['CT_small.dcm', 'MR_small.dcm']:
+        shutil.copy(get_testdata_file(name), folder / name)
+    index_file = str(tmp_path / 'dicom_index.db')
+    monkeypatch.chdir(folder)
+
+    dicom_tree, log = scan('.', index_file)
+    assert '(2 read)' in log
+    dicom_tree_again, log = scan('.', index_file)
+    assert '(0 read)' in log
+    assert dicom_tree_again == dicom_tree
+
+    # the absolute spelling of the same folder uses the same rows
+    _, log = scan(str(folder), index_file)
+    assert '(0 read)' in log
+    with sqlite3.connect(index_file) as conn:
+        assert conn.execute('SELECT COUNT(*) FROM files').fetchone()[0] == 2
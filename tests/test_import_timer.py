@@ -0,0 +1,29 @@
+import threading
+
+from import_timer import ImportTimer
+
+def test_nested_times_are_charged_per_thread():
+    # a module importing a child on one thread while another thread imports a module of its own
+    timer = ImportTimer()
+    parent_entered = threading.Event()
+    other_done = threading.Event()
+
+    def other_thread():
+        parent_entered.wait()
+        timer.enter()
+        timer.exit('other', 1.0)
+        other_done.set()
+
+    thread = threading.Thread(target=other_thread)
+    thread.start()
+    timer.enter()
+    parent_entered.set()
+    other_done.wait()
+    timer.enter()
+    timer.exit('child', 0.25)
+    timer.exit('parent', 2.0)
+    thread.join()
+
+    assert timer.times['other'] == (1.0, 1.0)
+    assert timer.times['child'] == (0.25, 0.25)
+    assert timer.times['parent'] == (2.0, 1.75)
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+import obj_helper
+
+RESULT = {
+    'catphan_model': 'CatPhan604',
+    'num_images': 80,
+    'ctp404': {
+        'hu_linearity_passed': True,
+        'line_distances_mm': [50.1, 49.9, 50.0, 50.2],
+        'hu_rois': {'Bone 20%': {'value': 237.5, 'passed': True}, 'Air': {'value': -998.0, 'passed': True}},
+    },
+    'ctp528': {'mtf_lp_mm': {'50': 0.42, '80': 0.31}, 'profile': list(range(100))},
+    'empty': {},
+    'none': None,
+}
+
+def items(flattened):
+    return {item['key']: item['value'] for item in flattened}
+
+def test_wrappers_match_legacy_traverse():
+    assert obj_helper.traverse_and_collect_numbers(RESULT) == obj_helper.legacy_traverse(RESULT, (int, float))
+    assert obj_helper.traverse_and_collect_strings(RESULT) == obj_helper.legacy_traverse(RESULT, str)
+    assert obj_helper.traverse_and_collect_numbers_strings(RESULT) == obj_helper.legacy_traverse(RESULT, (int, float, str))
+
+def test_wrappers_append_to_result():
+    result = [{'key': 'zz', 'value': 1}]
+    collected = obj_helper.traverse_and_collect_numbers({'a': 2}, result=result)
+    assert collected == [{'key': 'a', 'value': 2}, {'key': 'zz', 'value': 1}]
+
+def test_keys_are_sanitized():
+    flattened = items(obj_helper.flatten(RESULT))
+    assert flattened['ctp404_hu_rois_Bone_20__value'] == 237.5
+    assert flattened['ctp528_mtf_lp_mm_50'] == 0.42
+    assert flattened['catphan_model'] == 'CatPhan604'
+
+def test_skip_mode_leaves_lists_out():
+    flattened = items(obj_helper.flatten(RESULT))
+    assert not any(key.startswith(('ctp404_line_distances_mm', 'ctp528_profile')) for key in flattened)
+
+def test_index_mode():
+    flattened = items(obj_helper.flatten(RESULT, list_mode='index', max_list_items=32))
+    assert flattened['ctp404_line_distances_mm_0'] == 50.1
+    assert flattened['ctp404_line_distances_mm_3'] == 50.2
+    # longer than max_list_items: summarized
+    assert flattened['ctp528_profile_count'] == 100
+    assert flattened['ctp528_profile_mean'] == pytest.approx(49.5)
+    assert 'ctp528_profile_0' not in flattened
+
+def test_summary_mode():
+    flattened = items(obj_helper.flatten(RESULT, list_mode='summary'))
+    assert flattened['ctp404_line_distances_mm_count'] == 4
+    assert flattened['ctp404_line_distances_mm_min'] == 49.9
+    assert flattened['ctp404_line_distances_mm_max'] == 50.2
+    assert 'ctp404_line_distances_mm_0' not in flattened
+
+def test_numpy_arrays_and_scalars():
+    obj = {'array': np.array([[1.0, 2.0], [3.0, 4.0]]), 'scalar': np.float64(1.5)}
+    flattened = items(obj_helper.flatten(obj, list_mode='index'))
+    assert flattened['array_0_1'] == 2.0
+    assert flattened['array_1_0'] == 3.0
+    assert flattened['scalar'] == 1.5
+
+def test_numbers_and_strings_filters():
+    numbers, strings = obj_helper.split_numbers_strings(obj_helper.flatten(RESULT))
+    assert items(obj_helper.flatten(RESULT, strings=False)) == items(numbers)
+    assert items(obj_helper.flatten(RESULT, numbers=False)) == items(strings)
+
+def test_get_options():
+    assert obj_helper.get_options({}) == {'list_mode': 'skip', 'max_list_items': obj_helper.DEFAULT_MAX_LIST_ITEMS}
+    assert obj_helper.get_options({'result_flatten': {'list_mode': 'index', 'max_list_items': 8}}) == {'list_mode': 'index', 'max_list_items': 8}
+    with pytest.raises(Exception):
+        obj_helper.get_options({'result_flatten': {'list_mode': 'all'}})
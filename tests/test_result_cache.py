@@ -0,0 +1,117 @@
+import os
+import json
+import shutil
+
+import pytest
+import pydicom
+from pydicom.data import get_testdata_file
+
+import phantoms.result_cache
+from phantoms.result_cache import ResultCache
+from phantoms.timing import StageTimer
+
+CONFIG = {'catphan_model': '604', 'analysis_params': {'hu_tolerance': 40}}
+
+@pytest.fixture(autouse=True)
+def pylinac_version(monkeypatch):
+    monkeypatch.setattr(phantoms.result_cache, 'get_pylinac_version', lambda: '3.0')
+
+@pytest.fixture
+def case_folder(tmp_path):
+    folder = tmp_path / 'case'
+    folder.mkdir()
+    shutil.copy(get_testdata_file('CT_small.dcm'), folder / 'CT_small.dcm')
+    return folder
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResultCache(folder=str(tmp_path / 'cache'))
+
+def test_key_ignores_outputs_in_the_input_folder(case_folder, cache):
+    key = cache.get_key('catphan', str(case_folder), CONFIG)
+
+    # the outputs of a run, written to the case folder by the GUI
+    (case_folder / 'result.json').write_text('{"num_images": 1}')
+    (case_folder / 'timings.json').write_text('{"total": 1.5}')
+    (case_folder / 'analyzed_image.png').write_bytes(b'\x89PNG')
+    (case_folder / 'deferred.pkl').write_bytes(b'\x80\x05')
+    assert cache.get_key('catphan', str(case_folder), CONFIG) == key
+
+    (case_folder / 'timings.json').write_text('{"total": 2.5}')
+    assert cache.get_key('catphan', str(case_folder), CONFIG) == key
+
+def test_key_changes_with_pixel_data_and_params(case_folder, cache):
+    key = cache.get_key('catphan', str(case_folder), CONFIG)
+    assert cache.get_key('catphan', str(case_folder), {'catphan_model': '604', 'analysis_params': {'hu_tolerance': 40.0}}) == key
+    assert cache.get_key('catphan', str(case_folder), {'catphan_model': '604', 'analysis_params': {'hu_tolerance': 30}}) != key
+
+    ds = pydicom.dcmread(case_folder / 'CT_small.dcm')
+    pixels = bytearray(ds.PixelData)
+    pixels[0] ^= 0xFF
+    ds.PixelData = bytes(pixels)
+    ds.save_as(case_folder / 'CT_small.dcm')
+    assert cache.get_key('catphan', str(case_folder), CONFIG) != key
+
+def test_key_of_a_folder_without_dicom_fails(tmp_path, cache):
+    (tmp_path / 'result.json').write_text('{}')
+    with pytest.raises(Exception):
+        cache.get_key('catphan', str(tmp_path), CONFIG)
+
+def test_explicit_non_dicom_input_is_hashed(tmp_path, cache):
+    # 2D phantoms can be analyzed from other image formats
+    image = tmp_path / 'image.png'
+    image.write_bytes(b'image 1')
+    key = cache.get_key('qc3', str(image), CONFIG)
+    image.write_bytes(b'image 2')
+    assert cache.get_key('qc3', str(image), CONFIG) != key
+
+METADATA = {'Performed By': 'me', 'Performed Date': '2024-01-02'}
+
+def write_case(folder, archive):
+    # a case folder of the GUI: inputs staged as links to the archive, the run log and the outputs
+    folder.mkdir()
+    for i, name in enumerate(['a.dcm', 'b.dcm']):
+        (archive / name).write_bytes(name.encode() * 100)
+        os.link(archive / name, folder / f'input_{i:03d}.dcm')
+    (folder / 'input_manifest.json').write_text('[]')
+    (folder / 'log.txt').write_text('log')
+    (folder / 'result.json').write_text('{"num_images": 80}')
+    (folder / 'result.txt').write_text('result')
+    (folder / 'result.pdf').write_bytes(b'%PDF')
+    (folder / 'analyzed_image.png').write_bytes(b'\x89PNG')
+
+def test_store_and_restore_only_outputs(tmp_path, cache):
+    archive = tmp_path / 'archive'
+    archive.mkdir()
+    config = dict(CONFIG, output_profile='full')
+    write_case(tmp_path / 'case1', archive)
+    cache.store('key', {'phantom': 1}, str(tmp_path / 'case1'), config, 'notes', METADATA, print)
+
+    entry = json.loads((tmp_path / 'cache' / 'key' / 'cache_entry.json').read_text())
+    assert entry['files'] == ['analyzed_image.png', 'result.json', 'result.pdf', 'result.txt']
+
+    # the same series staged in another order
+    case2 = tmp_path / 'case2'
+    case2.mkdir()
+    os.link(archive / 'b.dcm', case2 / 'input_000.dcm')
+    os.link(archive / 'a.dcm', case2 / 'input_001.dcm')
+    assert cache.restore('key', str(case2), 'SBUH|TrueBeam', config, 'notes', METADATA, StageTimer(), print, phantom_name='catphan')
+
+    assert (archive / 'a.dcm').read_bytes() == b'a.dcm' * 100
+    assert (archive / 'b.dcm').read_bytes() == b'b.dcm' * 100
+    assert not (case2 / 'log.txt').exists()
+    assert json.loads((case2 / 'result.json').read_text())['device_id'] == 'SBUH|TrueBeam'
+    assert (case2 / 'analyzed_image.png').read_bytes() == b'\x89PNG'
+
+def test_incomplete_entry_writes_nothing(tmp_path, cache):
+    archive = tmp_path / 'archive'
+    archive.mkdir()
+    config = dict(CONFIG, output_profile='full')
+    write_case(tmp_path / 'case1', archive)
+    cache.store('key', {'phantom': 1}, str(tmp_path / 'case1'), config, 'notes', METADATA, print)
+    (tmp_path / 'cache' / 'key' / 'result.txt').unlink()
+
+    case2 = tmp_path / 'case2'
+    case2.mkdir()
+    assert not cache.restore('key', str(case2), 'SBUH|TrueBeam', config, 'notes', METADATA, StageTimer(), print, phantom_name='catphan')
+    assert list(case2.iterdir()) == []
@@ -0,0 +1,104 @@
+import io
+import json
+import os
+from enum import Enum
+from datetime import datetime
+from dataclasses import dataclass, field
+
+import numpy as np
+import pytest
+
+import obj_helper
+import phantoms.helper
+import result_serializer
+
+class Model(Enum):
+    CATPHAN604 = 'CatPhan604'
+
+@dataclass
+class ModuleResult:
+    passed: bool
+    profile: np.ndarray
+    mtf: np.ndarray
+    rois: dict = field(default_factory=dict)
+
+@dataclass
+class Result:
+    model: Model
+    performed: datetime
+    num_images: np.int64
+    ctp528: ModuleResult
+
+def make_result():
+    return Result(model=Model.CATPHAN604, performed=datetime(2024, 1, 2, 3, 4, 5), num_images=np.int64(80),
+                  ctp528=ModuleResult(passed=True, profile=np.linspace(0, 1, 1000), mtf=np.arange(5, dtype=np.float32),
+                                      rois={'Air': {'value': np.float64(-1000.0)}}))
+
+def dump(obj, **options):
+    file = io.StringIO()
+    result_serializer.dump(obj, file, **options)
+    return json.loads(file.getvalue())
+
+def test_list_mode():
+    data = dump(vars(make_result()))
+    assert data['model'] == 'CatPhan604'
+    assert data['performed'] == '2024-01-02T03:04:05'
+    assert data['num_images'] == 80
+    assert data['ctp528']['profile'] == np.linspace(0, 1, 1000).tolist()
+    assert data['ctp528']['rois']['Air']['value'] == -1000.0
+
+@pytest.mark.parametrize('array', [np.linspace(0, 1, 1000), np.arange(600, dtype='>i4').reshape(20, 30), np.ones((16, 16), dtype=np.uint8)])
+def test_base64_round_trip(array):
+    data = dump({'array': array}, array_mode='base64', base64_min_size=256)
+    decoded = result_serializer.decode_array(data['array'])
+    assert decoded.shape == array.shape
+    assert decoded.dtype == array.dtype.newbyteorder('<')
+    assert np.array_equal(decoded, array)
+
+def test_base64_keeps_small_arrays_as_lists():
+    data = dump(vars(make_result()), array_mode='base64', base64_min_size=256)
+    assert '__ndarray__' in data['ctp528']['profile']
+    assert data['ctp528']['mtf'] == [0.0, 1.0, 2.0, 3.0, 4.0]
+
+def test_flatten_reads_base64_arrays():
+    # the consumers of result.json: results.csv and the results database (skip), the server posts (index)
+    data = dump(vars(make_result()), array_mode='base64', base64_min_size=256)
+    skipped = {item['key']: item['value'] for item in obj_helper.flatten(data)}
+    assert 'ctp528_profile___ndarray__' not in skipped
+    assert skipped['ctp528_rois_Air_value'] == -1000.0
+
+    indexed = {item['key']: item['value'] for item in obj_helper.flatten(data, list_mode='index', max_list_items=32)}
+    assert indexed['ctp528_profile_count'] == 1000
+    assert indexed['ctp528_profile_max'] == 1.0
+    assert indexed['ctp528_mtf_4'] == 4.0
+
+def test_to_serializable_matches_dump():
+    result = make_result()
+    assert result_serializer.to_serializable(vars(result)) == dump(vars(result))
+
+class FakePhantom:
+    def results_data(self):
+        return make_result()
+
+def test_base64_result_json_loads_back(tmp_path):
+    # result.json written as the analyses do with a phantom config, read back into the same arrays
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with open(os.path.join(root, 'config.sbuh.truebeam.catphan.json'), 'r') as file:
+        config = json.load(file)
+    config['result_json'] = {'array_mode': 'base64', 'base64_min_size': 256}
+    phantoms.helper.save_result_as_json(phantom=FakePhantom(), output_dir=str(tmp_path), device_id='SBUH|TrueBeam', notes='',
+                                        config=config, metadata={'Performed By': 'me', 'Performed Date': '2024-01-02'}, log_message=print)
+    result = make_result()
+
+    with open(tmp_path / 'result.json', 'r') as file:
+        assert '__ndarray__' in json.load(file)['ctp528']['profile']
+    with open(tmp_path / 'result.json', 'r') as file:
+        data = result_serializer.load(file)
+    assert isinstance(data['ctp528']['profile'], np.ndarray)
+    assert np.array_equal(data['ctp528']['profile'], result.ctp528.profile)
+    assert data['ctp528']['mtf'] == result.ctp528.mtf.tolist()
+
+    # as posted to the server
+    with open(tmp_path / 'result.json', 'r') as file:
+        data = result_serializer.load(file, as_lists=True)
+    assert data['ctp528']['profile'] == result.ctp528.profile.tolist()
@@ -0,0 +1,42 @@
+import pytest
+
+import results_db
+
+@pytest.mark.parametrize('path', ['\\\\server\\share\\results.db', '//server/share/results.db'])
+def test_unc_paths_are_network_paths(path):
+    assert results_db.is_network_path(path)
+
+def test_local_path_is_not_a_network_path(tmp_path):
+    assert not results_db.is_network_path(str(tmp_path / 'results.db'))
+
+def journal_mode(db):
+    return db.conn.execute('PRAGMA journal_mode').fetchone()[0]
+
+def test_wal_on_a_local_folder(tmp_path):
+    db = results_db.ResultsDB(str(tmp_path / 'results.db'))
+    try:
+        assert db.wal
+        assert journal_mode(db) == 'wal'
+    finally:
+        db.close()
+
+def test_no_wal_on_a_network_share(tmp_path, monkeypatch):
+    monkeypatch.setattr(results_db, 'is_network_path', lambda path: True)
+    db = results_db.ResultsDB(str(tmp_path / 'results.db'), wal=True)
+    try:
+        assert not db.wal
+        assert journal_mode(db) == 'delete'
+    finally:
+        db.close()
+
+def test_add_and_query_result(tmp_path):
+    db = results_db.ResultsDB(str(tmp_path / 'results.db'), wal=False)
+    try:
+        result_data = {'device_id': 'SBUH|TrueBeam', 'performed_on': '2024-01-02', 'ctp486': {'uniformity_index': 1.2, 'passed': True}}
+        db.add_result(result_data, phantom='catphan', output_dir=str(tmp_path / 'case1'))
+        db.add_result(dict(result_data, performed_on='2024-01-03'), phantom='catphan', output_dir=str(tmp_path / 'case1'))
+        results = db.query_results(device_id='SBUH|TrueBeam')
+        assert len(results) == 1
+        assert results[0]['performed_on'] == '2024-01-03'
+    finally:
+        db.close()
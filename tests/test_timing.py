@@ -0,0 +1,43 @@
+import sys
+import json
+import types
+
+import pytest
+
+from phantoms.timing import get_peak_rss_mb, StageTimer, TIMING_NOTES
+
+def fake_psutil(**memory_info):
+    # psutil.Process().memory_info() returning the given fields
+    module = types.ModuleType('psutil')
+    module.Process = lambda: types.SimpleNamespace(memory_info=lambda: types.SimpleNamespace(**memory_info))
+    return module
+
+def test_peak_rss_stays_after_release():
+    # allocate and free ~200 MB, the peak stays above it once the memory is released
+    before = get_peak_rss_mb()
+    data = bytearray(200 * 1024 * 1024)
+    data[::4096] = b'\x01' * len(data[::4096])
+    del data
+    assert get_peak_rss_mb() >= before + 150
+
+def test_peak_rss_without_peak_wset(monkeypatch):
+    resource = pytest.importorskip('resource')
+    # psutil on Linux/macOS: rss is the current memory, ru_maxrss is used instead
+    monkeypatch.setitem(sys.modules, 'psutil', fake_psutil(rss=1024 * 1024))
+    assert get_peak_rss_mb() == pytest.approx(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, rel=0.05)
+
+def test_peak_rss_with_peak_wset(monkeypatch):
+    # psutil on Windows
+    monkeypatch.setitem(sys.modules, 'psutil', fake_psutil(rss=1024 * 1024, peak_wset=300 * 1024 * 1024))
+    assert get_peak_rss_mb() == 300
+
+def test_timings_explain_the_numbers(tmp_path):
+    timer = StageTimer()
+    with timer.stage('analyze'):
+        pass
+    logs = []
+    timer.save(str(tmp_path), logs.append)
+    timings = json.loads((tmp_path / 'timings.json').read_text())
+    assert timings['notes'] == TIMING_NOTES
+    assert [stage['stage'] for stage in timings['stages']] == ['analyze']
+    assert all(note in logs[-1] for note in TIMING_NOTES)
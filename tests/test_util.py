@@ -0,0 +1,17 @@
+import zipfile
+
+import util
+
+def test_zip_folder_excludes_files(tmp_path):
+    folder = tmp_path / 'case'
+    (folder / 'sub').mkdir(parents=True)
+    for name in ['result.json', 'deferred.pkl', 'sub/analyzed_image.png']:
+        (folder / name).write_text(name)
+
+    zip_filepath = util.zip_folder(str(folder), 'catphan_', str(tmp_path), exclude_files=['deferred.pkl'])
+    with zipfile.ZipFile(zip_filepath) as zipf:
+        assert sorted(name.replace('\\', '/') for name in zipf.namelist()) == ['result.json', 'sub/analyzed_image.png']
+
+    zip_filepath = util.zip_folder(str(folder), 'all_', str(tmp_path))
+    with zipfile.ZipFile(zip_filepath) as zipf:
+        assert len(zipf.namelist()) == 3
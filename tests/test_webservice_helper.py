@@ -0,0 +1,111 @@
+import os
+import sys
+import subprocess
+import socket
+import threading
+
+import numpy as np
+import pytest
+import requests
+
+import result_serializer
+import webservice_helper
+from webservice_stub import WebserviceStub
+
+@pytest.fixture(autouse=True)
+def session():
+    yield
+    webservice_helper.close()
+
+def configure(**settings):
+    webservice_helper.configure({'webservice': {'backoff_factor': 0.01, **settings}})
+
+def test_requests_share_one_connection():
+    configure()
+    with WebserviceStub() as stub:
+        for i in range(4):
+            assert webservice_helper.post({'i': i}, f'{stub.url}/catphanresults') == {'_id': str(i + 1)}
+    assert stub.connections == 1
+
+def test_unavailable_is_retried():
+    configure(retries=3)
+    with WebserviceStub(fail_first=2, fail_status=503) as stub:
+        assert webservice_helper.post({}, f'{stub.url}/catphanresults') == {'_id': '1'}
+    assert [request['status'] for request in stub.requests] == [503, 503, 201]
+
+def test_retries_are_limited():
+    configure(retries=2)
+    with WebserviceStub(fail_first=5, fail_status=502) as stub:
+        assert webservice_helper.post({}, f'{stub.url}/catphanresults') is None
+    assert len(stub.requests) == 3
+
+def test_internal_error_is_not_retried():
+    # the record may have been created before the 500
+    configure(retries=3)
+    with WebserviceStub(fail_first=1, fail_status=500) as stub:
+        assert webservice_helper.post({}, f'{stub.url}/catphanresults') is None
+    assert [request['status'] for request in stub.requests] == [500]
+
+def test_read_timeout_is_not_retried():
+    configure(retries=3, read_timeout=0.2)
+    with WebserviceStub(delay=0.5) as stub:
+        with pytest.raises(requests.exceptions.ConnectionError):
+            webservice_helper.post({}, f'{stub.url}/catphanresults')
+        stub.delay = 0
+    assert len(stub.requests) == 1
+
+def test_connection_error_is_retried():
+    # the server is not listening yet on the first attempts
+    with socket.socket() as free:
+        free.bind(('127.0.0.1', 0))
+        port = free.getsockname()[1]
+    configure(retries=5, backoff_factor=0.1)
+    stub = WebserviceStub(port=port)
+    server = threading.Timer(0.2, stub.start)
+    server.start()
+    try:
+        assert webservice_helper.post({}, f'http://127.0.0.1:{port}/api/catphanresults') == {'_id': '1'}
+    finally:
+        server.join()
+        stub.stop()
+
+def test_settings_default_and_override():
+    assert webservice_helper.get_settings(None)['retries'] == webservice_helper.DEFAULT_RETRIES
+    configure(connect_timeout=2, read_timeout=30)
+    assert webservice_helper.get_timeout() == (2, 30)
+
+def test_post_analysis_result(tmp_path):
+    result_folder = tmp_path / 'case'
+    result_folder.mkdir()
+    (result_folder / 'result.json').write_text('{"num_images": 80}')
+    (result_folder / 'deferred.pkl').write_bytes(b'\x80' * 100000)
+    configure()
+    with WebserviceStub() as stub:
+        config = {'webservice_url': stub.url, 'temp_folder': str(tmp_path), 'webservice': {'backoff_factor': 0.01}}
+        result_data = webservice_helper.post_analysis_result(result_folder=str(result_folder), config=config, url=f'{stub.url}/catphanresults',
+                                                             log_message=print, exclude_files=['deferred.pkl'])
+    assert result_data == {'num_images': 80, 'file': 'upload_1.zip'}
+    assert [request['path'] for request in stub.requests] == ['/api/upload', '/api/catphanresults']
+    # the zip without the 100 kB pickle
+    assert stub.requests[0]['size'] < 10000
+
+def test_client_does_not_import_the_phantom_layer():
+    code = 'import sys, webservice_helper; print(any(name.startswith("phantoms") for name in sys.modules))'
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout
+    assert output.strip() == 'False'
+
+def test_posted_result_has_lists(tmp_path):
+    # a result.json with base64 arrays is posted with the arrays as lists
+    result_folder = tmp_path / 'case'
+    result_folder.mkdir()
+    profile = np.linspace(0, 1, 300)
+    with open(result_folder / 'result.json', 'w') as file:
+        result_serializer.dump({'profile': profile, 'num_images': 80}, file, array_mode='base64')
+    configure()
+    with WebserviceStub() as stub:
+        config = {'webservice_url': stub.url, 'temp_folder': str(tmp_path), 'webservice': {'backoff_factor': 0.01}}
+        webservice_helper.post_analysis_result(result_folder=str(result_folder), config=config, url=f'{stub.url}/catphanresults', log_message=print)
+    posted = stub.requests[1]['json']
+    assert posted['profile'] == profile.tolist()
+    assert posted['num_images'] == 80
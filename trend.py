@@ -0,0 +1,327 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+
+from util import log, read_json_file
+import results_db
+
+TREND_REPORT_FILE = 'trend_report.txt'
+TREND_JSON_FILE = 'trend.json'
+
+# control chart settings when the config has no 'trend' section
+DEFAULT_WINDOW = 10
+DEFAULT_BASELINE_SIZE = 20
+DEFAULT_CUSUM_K = 0.5
+DEFAULT_CUSUM_H = 5.0
+
+# d2 of the moving range of 2 consecutive values: sigma = mean moving range / d2
+MR_D2 = 1.128
+
+def get_settings(config, metrics=None):
+    '''
+    The 'trend' section of a phantom config:
+        {"window": 10, "baseline_size": 20, "cusum_k": 0.5, "cusum_h": 5,
+         "metrics": {"ctp486_uniformity_index": {}, "ctp404_hu_rois_Air_value": {"low": -1040, "high": -960}}}
+    metrics (e.g. from the command line) replaces the metrics of the config, with their tolerances if the config has them.
+    '''
+    trend = config.get('trend', {})
+    tolerances = trend.get('metrics', {})
+    if metrics is None:
+        metrics = list(tolerances)
+    return {
+        'window': trend.get('window', DEFAULT_WINDOW),
+        'baseline_size': trend.get('baseline_size', DEFAULT_BASELINE_SIZE),
+        'cusum_k': trend.get('cusum_k', DEFAULT_CUSUM_K),
+        'cusum_h': trend.get('cusum_h', DEFAULT_CUSUM_H),
+        'metrics': {metric: tolerances.get(metric, {}) for metric in metrics},
+    }
+
+def load_history(db, device_id, phantom, metrics, start=None, end=None):
+    '''
+    The metrics of the results of a device and phantom, in date order:
+    {'dates': datetime64[D] array, 'output_dirs': list, 'values': float array (results x metrics, NaN where missing)}.
+    Results without a performed date are left out.
+    '''
+    results = [result for result in db.query_values(metrics, device_id, phantom, start, end) if result['performed_on']]
+    values = np.full((len(results), len(metrics)), np.nan)
+    for i, result in enumerate(results):
+        for j, metric in enumerate(metrics):
+            value = result.get('values', {}).get(metric)
+            if isinstance(value, (int, float)):
+                values[i, j] = value
+    return {
+        'dates': np.array([result['performed_on'] for result in results], dtype='datetime64[D]'),
+        'output_dirs': [result['output_dir'] for result in results],
+        'values': values,
+    }
+
+def window_sums(a, window):
+    # sum over the last window rows (fewer at the start), along axis 0, from one cumulative sum
+    cumsum = np.vstack([np.zeros((1, a.shape[1])), np.cumsum(a, axis=0)])
+    end = np.arange(1, a.shape[0] + 1)
+    return cumsum[end] - cumsum[np.maximum(end - window, 0)]
+
+def rolling_stats(values, window):
+    '''
+    Rolling mean and standard deviation of each column over the last window results, ignoring NaNs.
+    NaN where the window has fewer than 2 values.
+    '''
+    valid = np.isfinite(values)
+    # centered on the column means, so the sums of squares do not lose precision
+    offset = np.nanmean(np.where(valid.any(axis=0), values, 0), axis=0) if values.size else 0
+    x = np.where(valid, values - offset, 0.0)
+    count = window_sums(valid.astype(float), window)
+    total = window_sums(x, window)
+    total_sq = window_sums(x * x, window)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+        var = (total_sq - total * mean) / (count - 1)
+    enough = count >= 2
+    mean = np.where(enough, mean + offset, np.nan)
+    std = np.where(enough, np.sqrt(np.maximum(var, 0)), np.nan)
+    return mean, std
+
+def baseline_limits(values, baseline_size):
+    '''
+    Center line and sigma of each column from its first baseline_size values (individuals chart:
+    sigma from the mean moving range). NaN for columns with fewer than 2 values.
+    '''
+    center = np.full(values.shape[1], np.nan)
+    sigma = np.full(values.shape[1], np.nan)
+    for j in range(values.shape[1]):
+        baseline = values[np.isfinite(values[:, j]), j][:baseline_size]
+        if len(baseline) < 2:
+            continue
+        center[j] = baseline.mean()
+        sigma[j] = np.abs(np.diff(baseline)).mean() / MR_D2
+    return center, sigma
+
+def cusum(values, center, sigma, k=DEFAULT_CUSUM_K):
+    '''
+    Upper and lower tabular CUSUM of each column, in sigma units:
+        C+[t] = max(0, C+[t-1] + z[t] - k), C-[t] = max(0, C-[t-1] - z[t] - k)
+    computed as the cumulative sum minus its running minimum (clipped at 0). Missing values leave the sums unchanged.
+    '''
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z = (values - center) / np.where(sigma > 0, sigma, np.nan)
+    valid = np.isfinite(z)
+
+    def one_sided(steps):
+        s = np.cumsum(np.where(valid, steps, 0.0), axis=0)
+        return s - np.minimum(np.minimum.accumulate(s, axis=0), 0)
+
+    return one_sided(z - k), one_sided(-z - k)
+
+def get_tolerance_limits(settings):
+    # low and high tolerance of each metric, -inf/inf when not set
+    metrics = settings['metrics']
+    low = np.array([metrics[metric].get('low', -np.inf) for metric in metrics], dtype=float)
+    high = np.array([metrics[metric].get('high', np.inf) for metric in metrics], dtype=float)
+    return low, high
+
+def analyze_trends(history, settings):
+    '''
+    Control chart of every metric at once, the arrays being (results x metrics):
+    rolling mean and std, Shewhart center and 3 sigma limits, CUSUM, and the flags
+    out_of_control (beyond 3 sigma), cusum_alarm (C+ or C- over h) and out_of_tolerance (config low/high).
+    '''
+    values = history['values']
+    mean, std = rolling_stats(values, settings['window'])
+    center, sigma = baseline_limits(values, settings['baseline_size'])
+    cusum_high, cusum_low = cusum(values, center, sigma, settings['cusum_k'])
+    low, high = get_tolerance_limits(settings)
+    valid = np.isfinite(values)
+    with np.errstate(invalid='ignore'):
+        out_of_control = valid & (np.abs(values - center) > 3 * sigma)
+        out_of_tolerance = valid & ((values < low) | (values > high))
+    cusum_alarm = valid & ((cusum_high > settings['cusum_h']) | (cusum_low > settings['cusum_h']))
+    return {
+        'rolling_mean': mean,
+        'rolling_std': std,
+        'center': center,
+        'sigma': sigma,
+        'ucl': center + 3 * sigma,
+        'lcl': center - 3 * sigma,
+        'cusum_high': cusum_high,
+        'cusum_low': cusum_low,
+        'low': low,
+        'high': high,
+        'out_of_control': out_of_control,
+        'cusum_alarm': cusum_alarm,
+        'out_of_tolerance': out_of_tolerance,
+    }
+
+def to_float(value):
+    # JSON-friendly: NaN and inf as None
+    value = float(value)
+    return value if np.isfinite(value) else None
+
+def get_summary(history, trends, settings):
+    # one row per metric: its last value and rolling statistics, the limits, and the flagged results
+    dates = history['dates']
+    values = history['values']
+    rows = []
+    for j, metric in enumerate(settings['metrics']):
+        valid = np.isfinite(values[:, j])
+        last = np.flatnonzero(valid)[-1] if valid.any() else None
+        # the CUSUM stays over h until the process is back on target: only the start of an alarm is listed
+        alarm = trends['cusum_alarm'][:, j]
+        alarm_start = alarm & ~np.concatenate([[False], alarm[:-1]])
+        flags = {'out_of_control': trends['out_of_control'][:, j], 'cusum_alarm': alarm_start, 'out_of_tolerance': trends['out_of_tolerance'][:, j]}
+        flagged = flags['out_of_control'] | flags['cusum_alarm'] | flags['out_of_tolerance']
+        rows.append({
+            'metric': metric,
+            'n': int(valid.sum()),
+            'last_date': str(dates[last]) if last is not None else None,
+            'last_value': to_float(values[last, j]) if last is not None else None,
+            'rolling_mean': to_float(trends['rolling_mean'][last, j]) if last is not None else None,
+            'rolling_std': to_float(trends['rolling_std'][last, j]) if last is not None else None,
+            'center': to_float(trends['center'][j]),
+            'lcl': to_float(trends['lcl'][j]),
+            'ucl': to_float(trends['ucl'][j]),
+            'out_of_control': int(trends['out_of_control'][:, j].sum()),
+            'cusum_alarm': bool(trends['cusum_alarm'][last, j]) if last is not None else False,
+            'out_of_tolerance': int(trends['out_of_tolerance'][:, j].sum()),
+            'flagged': [{'date': str(dates[i]), 'output_dir': history['output_dirs'][i],
+                         'value': to_float(values[i, j]),
+                         'flags': [flag for flag in flags if flags[flag][i]]}
+                        for i in np.flatnonzero(flagged)],
+        })
+    return rows
+
+def format_number(value):
+    return '' if value is None else f'{value:.4g}'
+
+def format_report(device_id, phantom, history, summary):
+    # compact text report: one line per metric
+    columns = ['metric', 'n', 'last_date', 'last_value', 'rolling_mean', 'rolling_std', 'center', 'lcl', 'ucl', 'out_of_control', 'cusum_alarm', 'out_of_tolerance']
+    cells = [columns]
+    for row in summary:
+        cells.append([row['metric'], str(row['n']), row['last_date'] or ''] +
+                     [format_number(row[column]) for column in ['last_value', 'rolling_mean', 'rolling_std', 'center', 'lcl', 'ucl']] +
+                     [str(row['out_of_control']), 'ALARM' if row['cusum_alarm'] else '', str(row['out_of_tolerance'])])
+    widths = [max(len(row[i]) for row in cells) for i in range(len(columns))]
+    dates = history['dates']
+    period = f'{dates[0]} to {dates[-1]}' if len(dates) else 'no results'
+    lines = [f'{device_id} {phantom}: {len(dates)} results, {period}']
+    lines += ['  '.join(cell.ljust(width) for cell, width in zip(row, widths)) for row in cells]
+    return '\n'.join(lines)
+
+def get_chart_file(output_dir, device_id, phantom, metric):
+    device = device_id.replace('|', '_').lower()
+    return os.path.join(output_dir, f'trend_{device}_{phantom.lower()}_{metric}.png')
+
+def save_charts(device_id, phantom, history, trends, settings, output_dir, log_message=print):
+    # one PNG per metric: the values with the rolling mean, control and tolerance limits and flags, and the CUSUM below
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    dates = history['dates']
+    files = []
+    for j, metric in enumerate(settings['metrics']):
+        values = history['values'][:, j]
+        valid = np.isfinite(values)
+        if not valid.any():
+            continue
+        fig, (ax, ax_cusum) = plt.subplots(2, 1, figsize=(10, 6), sharex=True, gridspec_kw={'height_ratios': [3, 1]})
+        ax.plot(dates[valid], values[valid], 'o-', color='tab:blue', markersize=3, linewidth=0.8, label='value')
+        ax.plot(dates, trends['rolling_mean'][:, j], color='tab:orange', linewidth=1.2, label=f"rolling mean ({settings['window']})")
+        if np.isfinite(trends['center'][j]):
+            ax.axhline(trends['center'][j], color='tab:green', linewidth=1, label='center')
+            ax.axhline(trends['ucl'][j], color='tab:green', linestyle='--', linewidth=1, label='3 sigma')
+            ax.axhline(trends['lcl'][j], color='tab:green', linestyle='--', linewidth=1)
+        for limit in [trends['low'][j], trends['high'][j]]:
+            if np.isfinite(limit):
+                ax.axhline(limit, color='tab:red', linestyle=':', linewidth=1)
+        flagged = trends['out_of_control'][:, j] | trends['out_of_tolerance'][:, j]
+        if flagged.any():
+            ax.plot(dates[flagged], values[flagged], 'o', color='tab:red', markersize=6, label='flagged')
+        ax.set_title(f'{device_id} {phantom}: {metric}')
+        ax.legend(loc='best', fontsize='small')
+        ax.grid(alpha=0.3)
+
+        ax_cusum.plot(dates, trends['cusum_high'][:, j], color='tab:purple', linewidth=1, label='C+')
+        ax_cusum.plot(dates, trends['cusum_low'][:, j], color='tab:brown', linewidth=1, label='C-')
+        ax_cusum.axhline(settings['cusum_h'], color='tab:red', linestyle=':', linewidth=1)
+        ax_cusum.set_ylabel('CUSUM')
+        ax_cusum.legend(loc='upper left', fontsize='small')
+        ax_cusum.grid(alpha=0.3)
+
+        fig.autofmt_xdate()
+        fig.tight_layout()
+        file = get_chart_file(output_dir, device_id, phantom, metric)
+        fig.savefig(file, dpi=100)
+        plt.close(fig)
+        files.append(file)
+    log_message(f'{len(files)} charts saved in {output_dir}')
+    return files
+
+def run_trend(db, device_id, phantom, settings, output_dir=None, start=None, end=None, charts=True, log_message=print):
+    '''
+    Trend of the metrics of a device and phantom: returns the summary rows and the report text,
+    and saves the charts in output_dir when given.
+    '''
+    metrics = list(settings['metrics'])
+    start_time = time.perf_counter()
+    history = load_history(db, device_id, phantom, metrics, start, end)
+    trends = analyze_trends(history, settings)
+    summary = get_summary(history, trends, settings)
+    log_message(f'{device_id} {phantom}: {len(history["dates"])} results analyzed in {time.perf_counter() - start_time:.2f} s')
+    if charts and output_dir and len(history['dates']):
+        save_charts(device_id, phantom, history, trends, settings, output_dir, log_message)
+    return summary, format_report(device_id, phantom, history, summary)
+
+def main():
+    parser = argparse.ArgumentParser(description="Trends and control charts of the results in the results database")
+    parser.add_argument("db_file", help="The results database")
+    parser.add_argument("--phantom", required=True, help="The phantom, e.g. catphan")
+    parser.add_argument("--device_id", nargs='+', help="Devices (SITE|DEVICE). Default: every device with results of the phantom")
+    parser.add_argument("-c", "--config_file", help="Phantom config file with a 'trend' section (metrics, tolerances, window, baseline_size, cusum_k, cusum_h)")
+    parser.add_argument("-m", "--metrics", nargs='+', help="Result keys to trend (flattened as in results.csv). Default: the metrics of the config")
+    parser.add_argument("--start", help="From this date (YYYY-MM-DD)")
+    parser.add_argument("--end", help="Until this date (YYYY-MM-DD)")
+    parser.add_argument("-o", "--output_folder", default='.', help="Folder of the report and the charts")
+    parser.add_argument("--no_charts", action='store_true', help="Only the report")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db_file):
+        raise Exception(f'{args.db_file} not found')
+    config = read_json_file(args.config_file) if args.config_file else {}
+    settings = get_settings(config, args.metrics)
+    if not settings['metrics']:
+        raise Exception('No metrics: give --metrics or a config file with a trend section')
+    if not os.path.exists(args.output_folder):
+        os.makedirs(args.output_folder)
+
+    db = results_db.ResultsDB(args.db_file)
+    try:
+        device_ids = args.device_id or db.get_devices(args.phantom)
+        reports, summaries = [], {}
+        for device_id in device_ids:
+            summary, report = run_trend(db, device_id, args.phantom, settings, args.output_folder, args.start, args.end,
+                                        charts=not args.no_charts, log_message=log)
+            reports.append(report)
+            summaries[device_id] = summary
+    finally:
+        db.close()
+
+    report_text = '\n\n'.join(reports)
+    log(report_text)
+    report_file = os.path.join(args.output_folder, TREND_REPORT_FILE)
+    log(f'saving trend report: {report_file}')
+    with open(report_file, 'w') as file:
+        file.write(report_text + '\n')
+    with open(os.path.join(args.output_folder, TREND_JSON_FILE), 'w') as file:
+        json.dump({'phantom': args.phantom, 'settings': settings, 'devices': summaries}, file, indent=4)
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        log(f'Error: {e}')
+        sys.exit(1)
@@ -3,6 +3,8 @@ import json
 import sys
 import os
 import zipfile
+import threading
+from collections import OrderedDict
 
 def log(str):
     print(str)
@@ -46,7 +48,10 @@ def read_json_file(json_file_path):
 
     return data
 
-def zip_folder(folder_path, filename_prefix, output_folder_path):
+def zip_folder(folder_path, filename_prefix, output_folder_path, exclude_files=None):
+    # exclude_files: file names left out of the zip, in any subfolder
+    exclude_files = set(exclude_files or [])
+
     # Generate a zip file name based on timestamp
     zip_filename = f"{filename_prefix}{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
     zip_filepath = os.path.join(output_folder_path, zip_filename)
@@ -56,6 +61,8 @@ def zip_folder(folder_path, filename_prefix, output_folder_path):
         # Traverse all files and directories within the input folder
         for root, dirs, files in os.walk(folder_path):
             for file in files:
+                if file in exclude_files:
+                    continue
                 # Create the full file path
                 file_path = os.path.join(root, file)
                 # Write the file to the zip archive with a relative path
@@ -64,4 +71,37 @@ def zip_folder(folder_path, filename_prefix, output_folder_path):
     return zip_filepath
 
 def datetime_to_string_yyyymmdd_hhmmss(dt):
-    return dt.strftime('%Y%m%d_%H%M%S')
\ No newline at end of file
+    return dt.strftime('%Y%m%d_%H%M%S')
+
+class LRUCache:
+    """Thread-safe, size-bounded cache that evicts the least recently used entries."""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def __len__(self):
+        with self.lock:
+            return len(self.items)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
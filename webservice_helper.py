@@ -1,11 +1,88 @@
-import json
 import re
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime
 import os
 import util
 import model_helper
 import obj_helper
+import result_serializer
+
+# 'webservice' settings of config.json when not set
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 60
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+DEFAULT_POOL_SIZE = 4
+# the server or a proxy did not process the request, so even a POST can be sent again;
+# a 500 may come after the record was created, it is not retried
+RETRY_STATUS_CODES = [502, 503, 504]
+
+# one session for all the requests, so a push reuses its connections (keep-alive) for the zip, the result and the number/string 1ds
+session = None
+session_settings = None
+session_lock = threading.Lock()
+
+def get_settings(config=None):
+    # 'webservice' settings of config.json: {"connect_timeout": 5, "read_timeout": 60, "retries": 3, "backoff_factor": 0.5, "pool_size": 4}
+    settings = (config or {}).get('webservice', {})
+    return {
+        'connect_timeout': settings.get('connect_timeout', DEFAULT_CONNECT_TIMEOUT),
+        'read_timeout': settings.get('read_timeout', DEFAULT_READ_TIMEOUT),
+        'retries': settings.get('retries', DEFAULT_RETRIES),
+        'backoff_factor': settings.get('backoff_factor', DEFAULT_BACKOFF_FACTOR),
+        'pool_size': settings.get('pool_size', DEFAULT_POOL_SIZE),
+    }
+
+def create_session(settings):
+    '''
+    Session with a connection pool and retries with exponential backoff (backoff_factor * 2^n seconds)
+    on connection errors and 502/503/504 responses, POST included.
+    A request that may have reached the server (500, read error or timeout) is not retried, so a record is not posted twice.
+    '''
+    retry = Retry(total=settings['retries'],
+                  read=0,
+                  backoff_factor=settings['backoff_factor'],
+                  status_forcelist=RETRY_STATUS_CODES,
+                  allowed_methods=None,
+                  # the last response is returned, its status is reported by the caller
+                  raise_on_status=False)
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=settings['pool_size'], pool_maxsize=settings['pool_size'])
+    new_session = requests.Session()
+    new_session.mount('http://', adapter)
+    new_session.mount('https://', adapter)
+    return new_session
+
+def configure(config):
+    # Applies the 'webservice' settings of config.json; the session is recreated only when they changed
+    global session, session_settings
+    settings = get_settings(config)
+    with session_lock:
+        if session is not None and settings == session_settings:
+            return
+        if session is not None:
+            session.close()
+        session = create_session(settings)
+        session_settings = settings
+
+def get_session():
+    if session is None:
+        configure(None)
+    return session
+
+def get_timeout():
+    settings = session_settings or get_settings()
+    return (settings['connect_timeout'], settings['read_timeout'])
+
+def close():
+    global session, session_settings
+    with session_lock:
+        if session is not None:
+            session.close()
+        session = None
+        session_settings = None
 '''
 # Post the Measurement1D array to the API
 def post_measurements(measurements, url):
@@ -27,7 +104,7 @@ def post(obj, url):
     headers = {'Content-Type': 'application/json'}
 
     print(f'Sending result.json to {url}...')
-    response = requests.post(url, json=obj, headers=headers)
+    response = get_session().post(url, json=obj, headers=headers, timeout=get_timeout())
 
     # Check if the request was successful
     if response.status_code in [200, 201]:
@@ -45,7 +122,7 @@ def upload_zip_file(filepath, url):
             files = {'file': (os.path.basename(filepath), file, 'application/zip')}
             
             # Make a POST request to upload the file
-            response = requests.post(url, files=files)
+            response = get_session().post(url, files=files, timeout=get_timeout())
 
             # Check the response status code
             if response.status_code in (200, 201):
@@ -58,16 +135,18 @@ def upload_zip_file(filepath, url):
     except Exception as e:
         print(f"Error while uploading zip file: {e}")
 
-def post_analysis_result(result_folder, config, url, log_message):
+def post_analysis_result(result_folder, config, url, log_message, exclude_files=None):
+    # exclude_files: files of the result folder left out of the uploaded zip
     
     temp_folder = config['temp_folder']
+    configure(config)
     
     if not result_folder or not os.path.exists(result_folder):
         raise Exception("The result folder not found.")
     
     # Zip the input folder
     log_message(f"Zipping input folder: {result_folder}")
-    zip_filepath = util.zip_folder(result_folder, f'catphan_', temp_folder)
+    zip_filepath = util.zip_folder(result_folder, f'catphan_', temp_folder, exclude_files=exclude_files)
     log_message(f"Result folder zipped at: {zip_filepath}")
     
     # Get the upload URL from config
@@ -92,9 +171,9 @@ def post_analysis_result(result_folder, config, url, log_message):
     if not os.path.exists(result_json):
         raise Exception("The result.json file does not exist. Run the analysis first.")
 
-    # Read the result.json file
+    # Read the result.json file; the server takes the arrays as lists, whatever the encoding of the file
     with open(result_json, 'r') as json_file:
-        result_data = json.load(json_file)
+        result_data = result_serializer.load(json_file, as_lists=True)
 
     # add zip filename
     result_data['file'] = uploaded_zip_filename
@@ -111,10 +190,11 @@ def post_analysis_result(result_folder, config, url, log_message):
 
     return result_data
 
-def post_result_as_number1ds(result_data, app, site_id, device_id, phantom_id, url, log):
-    # travese the result object and collect numbers
-    log('collecting numbers from the result file...')
-    kvps = obj_helper.traverse_and_collect_numbers(result_data)
+def post_result_as_number1ds(result_data, app, site_id, device_id, phantom_id, url, log, kvps=None):
+    # travese the result object and collect numbers, unless the caller already flattened it (obj_helper.flatten)
+    if kvps is None:
+        log('collecting numbers from the result file...')
+        kvps = obj_helper.traverse_and_collect_numbers(result_data)
 
     # convert the numbers key value pairs to number1d objects
     log('converting numbers kvps to number1d objects...')
@@ -131,10 +211,11 @@ def post_result_as_number1ds(result_data, app, site_id, device_id, phantom_id, u
     else:
         log("Post failed!")
         return None
-def post_result_as_string1ds(result_data, app, site_id, device_id, phantom_id, url, log):
-    # travese the result object and collect numbers
-    log('collecting strings from the result file...')
-    kvps = obj_helper.traverse_and_collect_strings(result_data)
+def post_result_as_string1ds(result_data, app, site_id, device_id, phantom_id, url, log, kvps=None):
+    # travese the result object and collect strings, unless the caller already flattened it (obj_helper.flatten)
+    if kvps is None:
+        log('collecting strings from the result file...')
+        kvps = obj_helper.traverse_and_collect_strings(result_data)
 
     # convert the numbers key value pairs to number1d objects
     log('converting numbers kvps to number1d objects...')
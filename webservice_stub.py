@@ -0,0 +1,129 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class StubHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1, so clients keep their connections alive between requests
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.stub.count_connection()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        status, response = self.server.stub.handle(self.path, self.headers.get('Content-Type', ''), body)
+        data = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.stub.verbose:
+            super().log_message(format, *args)
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # e.g. the client closed the connection on a read timeout
+        if self.stub.verbose:
+            super().handle_error(request, client_address)
+
+class WebserviceStub:
+    '''
+    Local stand-in for the results web service, to test webservice_helper against:
+        with WebserviceStub(fail_first=2) as stub:
+            config['webservice_url'] = stub.url
+    Answers /upload with a fileName and the other POSTs with an _id. The first fail_first requests get fail_status (503),
+    to exercise the retries, and every response waits delay seconds, to exercise the read timeout.
+    Every request is recorded in requests (failed ones included, with their status and JSON body), and connections counts the TCP connections.
+    '''
+    def __init__(self, port=0, fail_first=0, fail_status=503, delay=0, verbose=False):
+        self.server = StubServer(('127.0.0.1', port), StubHandler)
+        self.server.stub = self
+        self.fail_first = fail_first
+        self.fail_status = fail_status
+        self.delay = delay
+        self.verbose = verbose
+        self.requests = []
+        self.failures = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}/api'
+
+    def count_connection(self):
+        with self.lock:
+            self.connections += 1
+
+    def handle(self, path, content_type, body):
+        with self.lock:
+            failed = self.failures < self.fail_first
+            if failed:
+                self.failures += 1
+            status = self.fail_status if failed else 201
+            self.requests.append({'path': path, 'content_type': content_type, 'size': len(body), 'status': status,
+                                  'json': json.loads(body) if content_type.startswith('application/json') else None})
+            n = len(self.requests) - self.failures
+        if self.delay:
+            time.sleep(self.delay)
+        if failed:
+            return status, {'error': 'failed'}
+        if path.endswith('/upload'):
+            return 201, {'fileName': f'upload_{n}.zip'}
+        return 201, {'_id': str(n)}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+if __name__ == '__main__':
+    # Pushes a fake result folder through webservice_helper as the GUI does, with the first 2 requests failing
+    import webservice_helper
+    import obj_helper
+
+    temp_folder = tempfile.mkdtemp()
+    try:
+        result_folder = os.path.join(temp_folder, 'case')
+        os.makedirs(result_folder)
+        with open(os.path.join(result_folder, 'result.json'), 'w') as file:
+            json.dump({'num_images': 80, 'ctp486': {'uniformity_index': 1.2, 'passed': True}, 'catphan_model': 'CatPhan604'}, file)
+
+        with WebserviceStub(fail_first=2) as stub:
+            config = {'webservice_url': stub.url, 'temp_folder': temp_folder, 'webservice': {'backoff_factor': 0.1}}
+            result_data = webservice_helper.post_analysis_result(result_folder=result_folder, config=config, url=f'{stub.url}/catphanresults', log_message=print)
+            numbers, strings = obj_helper.split_numbers_strings(obj_helper.flatten(result_data))
+            webservice_helper.post_result_as_number1ds(result_data, 'app', 'SBUH', 'TrueBeam', 'catphan', f'{stub.url}/number1ds', print, kvps=numbers)
+            webservice_helper.post_result_as_string1ds(result_data, 'app', 'SBUH', 'TrueBeam', 'catphan', f'{stub.url}/string1ds', print, kvps=strings)
+            webservice_helper.close()
+
+        print(f'{len(stub.requests)} requests on {stub.connections} connections, {stub.failures} failures retried')
+        for request in stub.requests:
+            print(f"  {request['path']:<24}{request['status']:>4}{request['size']:>8} bytes")
+        if [request['path'] for request in stub.requests if request['status'] == 201] != ['/api/upload', '/api/catphanresults', '/api/number1ds', '/api/string1ds']:
+            sys.exit(1)
+    finally:
+        shutil.rmtree(temp_folder, ignore_errors=True)